@@ -15,43 +15,13 @@ export REPO_NAME="${GITHUB_REPOSITORY##*/}"
 # BUILD DOCS #
 ##############
  
-# get a list of branches, excluding 'HEAD' and 'gh-pages'
-versions="`git for-each-ref '--format=%(refname:lstrip=-1)' refs/remotes/origin/ refs/tags | grep -viE '^(HEAD|gh-pages)$'`"
-for current_version in ${versions}; do
-   # make the current language available to conf.py
-   export current_version
-   git checkout ${current_version}
- 
-   echo "INFO: Building sites for ${current_version}"
- 
-   # skip this branch if it doesn't have our docs dir & sphinx config
-   if [ ! -e 'docs/conf.py' ]; then
-      echo -e "\tINFO: Couldn't find 'docs/conf.py' (skipped)"
-      continue
-   fi
- 
-   current_language='en'
-   # make the current language available to conf.py
-   export current_language
-
-   ##########
-   # BUILDS #
-   ##########
-   python ./build.py --force-rebuild
-
-   # HTML #
-
-   #sphinx-build -b html docs/ docs/_build/html/${current_language}/${current_version} -D language="${current_language}"
-   #mkdir -p "${docroot}/${current_language}/${current_version}"
-   #cp "docs/_build/epub/target.epub" "${docroot}/${current_language}/${current_version}/helloWorld-docs_${current_language}_${current_version}.epub"
-
-   # copy the static assets produced by the above build into our docroot
-   mkdir -p "${docroot}/${current_language}/${current_version}"
-   rsync -av "output/html/" "${docroot}/${current_language}/${current_version}/"
-done
- 
-# return to master branch
-git checkout latest
+# Build every branch and tag (except HEAD and gh-pages) that has a
+# docs/conf.py. The inventory is fetched once and shared, and versions whose
+# commit and inventory are unchanged since the cached build are reused.
+# No --optimize: GitHub Pages compresses responses itself, ignores .gz/.br
+# siblings and sets its own short cache lifetime, so the optimization stage
+# would only add files to every gh-pages push.
+python ./build.py --versions --docroot "${docroot}"
  
 #######################
 # Update GitHub Pages #
@@ -0,0 +1,54 @@
+'''
+Micro-benchmark for Plasmid construction and Quartzy date parsing.
+
+Run from the repository root:
+
+    python bench/bench_models.py [--n 20000]
+'''
+import argparse
+import datetime
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from quartzy_parser.models import Plasmid, parse_quartzy_date # type: ignore
+
+DATES = ['2021-03-04', '2021-03-04T10:00:00.000Z', '03/04/2021']
+
+def legacy_parse_quartzy_date(value: str) -> datetime.date:
+    '''The original try-every-strptime-format parser, for comparison.'''
+    for date_format in (r'%Y-%m-%d', r'%Y-%m-%dT%H:%M:%S.%fZ', r'%m/%d/%Y'):
+        try:
+            return datetime.datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+    raise ValueError(f"Can't process given Quartzy date: {value}")
+
+def plasmid_fields(i: int) -> dict:
+    return dict(
+        pKG=i, filename=f'pKG{i:05d}.rst', q_item_name=f'pKG{i}', name=f'plasmid {i}',
+        species='E. coli', resistances=['Kanamycin'], plasmid_type=['Gateway::Entry'],
+        date_stored=DATES[i % len(DATES)], vendor='Addgene' if i % 4 == 0 else None,
+        alt_name=str(i), owner_id='1', attachment_filenames=[f'map{i}.gb'], technical_details=[])
+
+def bench(label: str, fn, n: int) -> float:
+    seconds = min(timeit.repeat(fn, number=1, repeat=3))
+    print(f'{label:<36} {seconds * 1e3:>9.1f} ms  {seconds * 1e6 / n:>7.2f} us/item')
+    return seconds
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Benchmarks Plasmid construction and date parsing')
+    arg_parser.add_argument('--n', type=int, default=20000)
+    args = arg_parser.parse_args()
+
+    dates = [DATES[i % len(DATES)] for i in range(args.n)]
+    legacy = bench('legacy date parsing', lambda: [legacy_parse_quartzy_date(d) for d in dates], args.n)
+    fast = bench('parse_quartzy_date', lambda: [parse_quartzy_date(d) for d in dates], args.n)
+    print(f'  -> {legacy / fast:.1f}x faster')
+
+    fields = [plasmid_fields(i) for i in range(args.n)]
+    validated = bench('Plasmid(**fields)', lambda: [Plasmid(**f) for f in fields], args.n)
+    trusted = bench('Plasmid.from_trusted(**fields)', lambda: [Plasmid.from_trusted(**f) for f in fields], args.n)
+    print(f'  -> {validated / trusted:.1f}x faster')
+    assert [Plasmid(**f) for f in fields[:100]] == [Plasmid.from_trusted(**f) for f in fields[:100]]
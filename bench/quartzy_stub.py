@@ -0,0 +1,210 @@
+'''
+Local stand-in for the parts of the Quartzy API that quartzy_parser uses:
+
+- GET  /login                   (login page with the frontend/config/environment meta tag)
+- POST /oauth/tokens
+- GET  /groups/{id}/items       (paginated, with include=attachments and ETags; one inventory per group)
+- GET  /items/{id}/attachments
+- GET  /attachments/{id}/download (a synthetic GenBank map; the url attachment resources list)
+- GET  /users
+
+It can add per-request latency and answer a fraction of requests with 429
+and a Retry-After header so rate limiting and retries can be exercised. Run it standalone with
+
+    python bench/quartzy_stub.py --n 10000 --port 8089
+
+and point a QuartzyClient at it with app_url/api_url.
+'''
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Any, Dict, Optional
+from urllib.parse import urlparse, parse_qs, quote
+
+from synthetic import Inventory, generate_inventory, plasmid_map # type: ignore
+
+CLIENT_ID = 'stub-client-id'
+ACCESS_TOKEN = 'stub-access-token'
+
+class StubConfig:
+    def __init__(self, inventory: Inventory, latency: float=0.0, throttle_rate: float=0.0,
+            retry_after: float=0.1, compound: bool=True, max_page_size: int=1000,
+            groups: Optional[Dict[str,Inventory]]=None, throttle_first: int=0):
+        self.inventory = inventory
+        # Group ID -> inventory; other groups are served `inventory`
+        self.groups = groups or {}
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        # Seconds sent as Retry-After with every 429
+        self.retry_after = retry_after
+        # The first throttle_first requests are answered with 429 regardless of throttle_rate
+        self.throttle_first = throttle_first
+        self.compound = compound
+        self.max_page_size = max_page_size
+        inventories = [inventory, *self.groups.values()]
+        self.items_by_id = {item['id']: item for each in inventories for item in each.items}
+        self.attachments = {item_id: attachments for each in inventories for item_id, attachments in each.attachments.items()}
+        # Attachment ID -> (item, attachment)
+        self.attachments_by_id = {attachment['id']: (self.items_by_id[item_id], attachment)
+            for item_id, item_attachments in self.attachments.items() for attachment in item_attachments}
+        self.lock = threading.Lock()
+        self.counts: Dict[str,int] = {}
+        self.rng = random.Random(0)
+
+    def group(self, group_id: str) -> Inventory:
+        return self.groups.get(group_id, self.inventory)
+
+    def count(self, key: str) -> None:
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def should_throttle(self) -> bool:
+        with self.lock:
+            if self.throttle_first > 0:
+                self.throttle_first -= 1
+                return True
+            return self.rng.random() < self.throttle_rate
+
+class StubHandler(BaseHTTPRequestHandler):
+    config: StubConfig
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _send_bytes(self, body: bytes, status: int=200, content_type: str='application/json',
+            headers: Optional[Dict[str,str]]=None) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, obj: Any, status: int=200, etag: bool=False, headers: Optional[Dict[str,str]]=None) -> None:
+        body = json.dumps(obj).encode('utf-8')
+        if etag:
+            tag = '"' + hashlib.sha1(body).hexdigest() + '"'
+            if self.headers.get('If-None-Match') == tag:
+                self.send_response(304)
+                self.send_header('ETag', tag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self._send_bytes(body, status, headers={**(headers or {}), 'ETag': tag})
+        else:
+            self._send_bytes(body, status, headers=headers)
+
+    def _prelude(self, kind: str) -> bool:
+        '''Applies latency and throttling. Returns False if the request was answered with a 429.'''
+        self.config.count(kind)
+        if self.config.latency > 0:
+            time.sleep(self.config.latency)
+        if self.config.should_throttle():
+            self.config.count('throttled')
+            self._send_json({'errors': [{'status': '429'}]}, 429, headers={'Retry-After': str(self.config.retry_after)})
+            return False
+        return True
+
+    def _authorized(self) -> bool:
+        if self.headers.get('Authorization') != f'Bearer {ACCESS_TOKEN}':
+            self._send_json({'errors': [{'status': '401'}]}, 401)
+            return False
+        return True
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self._prelude('token'):
+            return
+        if urlparse(self.path).path != '/oauth/tokens':
+            return self._send_json({}, 404)
+        self._send_json({'token_type': 'Bearer', 'access_token': ACCESS_TOKEN, 'expires_in': 3600})
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/login':
+            if not self._prelude('login'):
+                return
+            env = quote(json.dumps({'api': {'clientId': CLIENT_ID}}))
+            page = f'<html><head><meta name="frontend/config/environment" content="{env}" /></head><body></body></html>'
+            return self._send_bytes(page.encode('utf-8'), content_type='text/html')
+        match = re.fullmatch(r'/groups/(\d+)/items', url.path)
+        if match is not None:
+            if not self._prelude('items') or not self._authorized():
+                return
+            return self._items(self.config.group(match.group(1)), query)
+        match = re.fullmatch(r'/items/(\w+)/attachments', url.path)
+        if match is not None:
+            if not self._prelude('attachments') or not self._authorized():
+                return
+            return self._send_json({'data': [self._with_url(a) for a in self.config.attachments.get(match.group(1), [])]})
+        match = re.fullmatch(r'/attachments/(\w+)/download', url.path)
+        if match is not None:
+            if not self._prelude('downloads') or not self._authorized():
+                return
+            if match.group(1) not in self.config.attachments_by_id:
+                return self._send_json({}, 404)
+            return self._send_bytes(plasmid_map(*self.config.attachments_by_id[match.group(1)]),
+                content_type='application/octet-stream')
+        if url.path == '/users':
+            if not self._prelude('users') or not self._authorized():
+                return
+            return self._send_json({'data': self.config.group(query.get('filter[group]', [''])[0]).users})
+        self._send_json({}, 404)
+
+    def _with_url(self, attachment: Dict[str,Any]) -> Dict[str,Any]:
+        '''An attachment resource with the URL its content is downloaded from.'''
+        url = f'http://{self.headers["Host"]}/attachments/{attachment["id"]}/download'
+        return dict(attachment, attributes=dict(attachment['attributes'], url=url))
+
+    def _items(self, inventory: Inventory, query: Dict[str,Any]) -> None:
+        page = int(query.get('page', ['1'])[0])
+        limit = min(int(query.get('limit', ['100'])[0]), self.config.max_page_size)
+        items = inventory.items
+        last = max(1, -(-len(items) // limit))
+        data = items[(page - 1) * limit:page * limit]
+        response: Dict[str,Any] = {'meta': {'pagination': {'page': {'current': page, 'last': last}}}}
+        if 'include' in query and self.config.compound:
+            included = []
+            linked = []
+            for item in data:
+                item_attachments = inventory.attachments.get(item['id'], [])
+                included.extend(self._with_url(a) for a in item_attachments)
+                linked.append(dict(item, relationships=dict(item['relationships'],
+                    attachments={'data': [{'type': a['type'], 'id': a['id']} for a in item_attachments]})))
+            response.update(data=linked, included=included)
+        else:
+            response['data'] = data
+        self._send_json(response, etag=True)
+
+def serve(config: StubConfig, host: str='127.0.0.1', port: int=0) -> ThreadingHTTPServer:
+    '''Starts the stub in a background thread. The bound port is server.server_address[1].'''
+    handler = type('ConfiguredStubHandler', (StubHandler,), {'config': config})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Runs a local Quartzy API stand-in')
+    arg_parser.add_argument('--n', type=int, default=1000, help='Number of synthetic plasmids')
+    arg_parser.add_argument('--port', type=int, default=8089)
+    arg_parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request')
+    arg_parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of requests answered with 429')
+    arg_parser.add_argument('--retry-after', type=float, default=0.1, help='Retry-After seconds sent with every 429')
+    arg_parser.add_argument('--no-compound', action='store_true', help='Ignore include=attachments')
+    args = arg_parser.parse_args()
+    server = serve(StubConfig(generate_inventory(args.n), args.latency, args.throttle_rate, args.retry_after,
+        compound=not args.no_compound), port=args.port)
+    print(f'Serving {args.n} plasmids on http://127.0.0.1:{server.server_address[1]}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,165 @@
+'''
+End-to-end benchmark of the plasmid pipeline against the local Quartzy stub.
+
+For every inventory size the fetch, lint, RST render, direct HTML render,
+file write and (optionally) Sphinx stages are timed, and the results are written as JSON so
+runs can be compared across commits. Beforehand, a throttled request checks
+that the client waits out the stub's Retry-After:
+
+    python bench/run_benchmarks.py --scales 1000,10000,100000 [--sphinx]
+'''
+import argparse
+import datetime
+import json
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+import build # type: ignore
+from quartzy_parser import QuartzyClient, get_plasmids, lint_plasmids # type: ignore
+from quartzy_parser.metrics import peak_rss_mb # type: ignore
+from quartzy_parser.ratelimit import RateLimiter # type: ignore
+from quartzy_stub import StubConfig, serve # type: ignore
+from synthetic import generate_inventory # type: ignore
+from site_builder import html_backend # type: ignore
+from site_builder.aggregate import InventoryIndex # type: ignore
+
+def git_commit() -> str:
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, capture_output=True, text=True)
+    return result.stdout.strip() or 'unknown'
+
+def check_retry_after(retry_after: float) -> Dict[str,Any]:
+    '''
+    Times a request whose first attempt the stub answers with 429 and
+    Retry-After. Raises if the client retried before the delay was up.
+    '''
+    config = StubConfig(generate_inventory(1), retry_after=retry_after, throttle_first=1)
+    server = serve(config)
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    try:
+        limiter = RateLimiter(rate=1000, max_rate=1000, burst=1000)
+        with QuartzyClient('bench', 'bench', token_cache=None, app_url=base_url, api_url=base_url,
+                rate_limiter=limiter) as client:
+            start = time.perf_counter()
+            client.get('/users').raise_for_status()
+            waited = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+    if config.counts.get('throttled') != 1 or waited < retry_after:
+        raise RuntimeError(f'Retry-After of {retry_after}s not honored: retried after {waited:.3f}s, '
+            f'{config.counts.get("throttled", 0)} throttled requests')
+    return {'retry_after': retry_after, 'waited': waited}
+
+def run_scale(n: int, args: argparse.Namespace) -> Dict[str,Any]:
+    stages: Dict[str,float] = {}
+    config = StubConfig(generate_inventory(n, seed=args.seed), latency=args.latency,
+        throttle_rate=args.throttle_rate, retry_after=args.retry_after, compound=not args.no_compound)
+    server = serve(config)
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    try:
+        start = time.perf_counter()
+        limiter = RateLimiter(rate=args.rate, max_rate=args.rate, burst=args.rate)
+        with QuartzyClient('bench', 'bench', token_cache=None, app_url=base_url, api_url=base_url,
+                rate_limiter=limiter) as client:
+            plasmids = get_plasmids(client, max_workers=args.workers, page_size=args.page_size)
+        stages['fetch'] = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    start = time.perf_counter()
+    lint_plasmids(plasmids)
+    stages['lint'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pages = {plasmid.filename: build.plasmid_rst(plasmid) for plasmid in plasmids}
+    index = InventoryIndex(plasmids)
+    categories = build.index_categories(index)
+    index_page = build.build_index_page(index, [f'by_{alt_cat}' for alt_cat in categories])
+    stages['render'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    nav, html_pages = build.html_index_pages(index, categories, 'Benchmark', args.nav_shard_size, {})
+    html_pages.extend(html_backend.plasmid_page(plasmid, [('plasmids/index.html', 'By pKG')]) for plasmid in plasmids)
+    for _ in html_backend.render_pages(html_backend.SiteInfo('Benchmark', '', nav), html_pages):
+        pass
+    stages['render_html'] = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp:
+        docs = Path(tmp) / 'docs'
+        shutil.copytree(REPO / 'docs', docs, ignore=shutil.ignore_patterns('pKG*.rst', 'by_*.rst', 'index.rst'))
+        plasmid_dir = docs / 'plasmids'
+        plasmid_dir.mkdir(exist_ok=True)
+        for label in ('write', 'rewrite_unchanged'):
+            writer = build.DocWriter()
+            start = time.perf_counter()
+            for filename, content in pages.items():
+                writer.write(plasmid_dir / filename, content)
+            build.write_pkg_index(plasmids, plasmid_dir, writer, args.nav_shard_size)
+            build.write_alt_name_lists(index, categories, plasmid_dir, writer)
+            writer.write(docs / 'index.rst', index_page)
+            stages[label] = time.perf_counter() - start
+
+        if args.sphinx:
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-m', 'sphinx.cmd.build', '-q', '-b', 'html', '-j', 'auto',
+                str(docs), str(Path(tmp) / 'html')], check=True)
+            stages['sphinx'] = time.perf_counter() - start
+
+    return {
+        'n_plasmids': n,
+        'n_fetched': len(plasmids),
+        'stages': stages,
+        'total': sum(stages.values()),
+        'requests': dict(config.counts),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Benchmarks the plasmid pipeline against a local Quartzy stub')
+    arg_parser.add_argument('--scales', default='1000,10000,100000', help='Comma-separated inventory sizes')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--workers', type=int, default=8, help='Concurrent fetch requests')
+    arg_parser.add_argument('--page-size', type=int, default=500)
+    arg_parser.add_argument('--nav-shard-size', type=int, default=500, help='pKG numbers per By pKG range page')
+    arg_parser.add_argument('--rate', type=float, default=1000.0, help='Client rate limit (requests/second)')
+    arg_parser.add_argument('--latency', type=float, default=0.0, help='Stub latency per request (seconds)')
+    arg_parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of stub requests answered with 429')
+    arg_parser.add_argument('--retry-after', type=float, default=0.5, help='Retry-After seconds the stub sends with a 429')
+    arg_parser.add_argument('--no-compound', action='store_true', help='Make the stub ignore include=attachments')
+    arg_parser.add_argument('--sphinx', action='store_true', help='Also time a full Sphinx HTML build')
+    arg_parser.add_argument('--output', type=Path, default=None, help='Result file (default: bench/results/<commit>.json)')
+    args = arg_parser.parse_args()
+
+    commit = git_commit()
+    retry_check = check_retry_after(args.retry_after)
+    print(f"Retry-After {retry_check['retry_after']}s honored: retried after {retry_check['waited']:.2f}s")
+    results: List[Dict[str,Any]] = []
+    for n in [int(scale) for scale in args.scales.split(',')]:
+        result = run_scale(n, args)
+        results.append(result)
+        print(f'{n:>7} plasmids: ' + ', '.join(f'{stage} {seconds:.2f}s' for stage, seconds in result['stages'].items()) +
+            f" ({sum(result['requests'].values())} requests)")
+
+    output = args.output if args.output is not None else REPO / 'bench' / 'results' / f'{commit}.json'
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with output.open('w') as f:
+        json.dump({
+            'commit': commit,
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'options': {k: str(v) if isinstance(v, Path) else v for k, v in vars(args).items()},
+            'retry_after_check': retry_check,
+            'results': results,
+        }, f, indent=2)
+    print(f'Results written to {output}')
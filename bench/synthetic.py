@@ -0,0 +1,119 @@
+'''
+Synthetic Quartzy inventory generator.
+
+Produces raw JSON:API item, attachment and user records shaped like the ones
+Quartzy returns, with a realistic mix of vendors, duplicate pKG numbers and
+lint violations. Generation is deterministic for a given seed.
+'''
+import random
+from typing import Any, Dict, List, NamedTuple
+
+VENDORS = ['Addgene'] * 6 + [None] * 10 + ['Thermo Fisher', 'Takara', 'IDT', 'Lab stock']
+ALT_PREFIXES = ['pPV', 'pShip', 'pHarbor', 'pENTR', 'pDEST', 'pLenti']
+SPECIES = ['E. coli', 'E. coli', 'E. coli', 'Human', 'Mouse', 'Synthetic']
+RESISTANCES = [['Kanamycin'], ['Ampicillin'], ['Chloramphenicol'], ['Ampicillin', 'Chloramphenicol'], ['Spectinomycin']]
+# Deprecated entries that lint_antibiotic flags
+BAD_RESISTANCES = [['Amp'], ['Kan'], ['KanamycinR'], ['Chloramphenicol/Ampicillin']]
+PLASMID_TYPES = [['Gateway::Entry'], ['Gateway::Dest'], ['Golden Gate::pPV'], ['Golden Gate::pShip'],
+    ['Golden Gate::Harbor'], ['Viral'], ['Viral', 'Helper'], ['Expression']]
+# Map labels of the resistance genes, as plasmid map software annotates them
+RESISTANCE_GENES = {'Kanamycin': 'KanR', 'Ampicillin': 'AmpR', 'Chloramphenicol': 'CmR', 'Spectinomycin': 'SmR'}
+DATE_FORMATS = ['{y:04d}-{m:02d}-{d:02d}', '{y:04d}-{m:02d}-{d:02d}T12:00:00.000Z', '{m:02d}/{d:02d}/{y:04d}']
+
+class Inventory(NamedTuple):
+    items: List[Dict[str,Any]]
+    attachments: Dict[str,List[Dict[str,Any]]]
+    users: List[Dict[str,Any]]
+
+def generate_inventory(n: int, seed: int=0, n_users: int=25, dup_rate: float=0.01,
+        violation_rate: float=0.05, id_prefix: str='') -> Inventory:
+    '''
+    Generates n items, sorted the way Quartzy returns them (`sort=-name`).
+
+    About dup_rate of the items reuse an existing pKG number, and each kind
+    of lint violation occurs in about violation_rate of the items. Item and
+    attachment IDs start with id_prefix, so inventories of several groups
+    can be served together.
+    '''
+    rng = random.Random(seed)
+    users = [{
+        'type': 'user',
+        'id': str(100 + i),
+        'attributes': {
+            'first_name': f'First{i}',
+            'last_name': f'Last{i}',
+            'full_name': 'Galloway Lab' if i == 0 else f'First{i} Last{i}'}}
+        for i in range(n_users)]
+
+    items: List[Dict[str,Any]] = []
+    attachments: Dict[str,List[Dict[str,Any]]] = {}
+    next_attachment_id = 1
+    for i in range(n):
+        item_id = f'{id_prefix}{500000 + i}'
+        pKG = rng.randrange(1, i + 1) if i > 0 and rng.random() < dup_rate else i + 1
+        name_pKG = pKG + 1 if rng.random() < violation_rate else pKG
+        vendor = rng.choice(VENDORS)
+        if vendor == 'Addgene':
+            catalog = f'#{rng.randrange(1000, 200000)}' if rng.random() < violation_rate else str(rng.randrange(1000, 200000))
+        elif rng.random() < 0.5:
+            catalog = f'{rng.choice(ALT_PREFIXES)}{rng.randrange(1, 400):03d}'
+        else:
+            catalog = None
+        y, m, d = rng.randrange(2015, 2025), rng.randrange(1, 13), rng.randrange(1, 29)
+        n_attachments = 0 if rng.random() < violation_rate else rng.choice([1, 1, 1, 2, 3])
+        attachments[item_id] = []
+        for k in range(n_attachments):
+            attachments[item_id].append({
+                'type': 'attachment',
+                'id': f'{id_prefix}{next_attachment_id}',
+                'attributes': {'file_name': f'pKG{pKG:05d}_{k}.gb'}})
+            next_attachment_id += 1
+        items.append({
+            'type': 'item',
+            'id': item_id,
+            'attributes': {
+                'name': f'pKG{name_pKG}',
+                'updated_at': f'{y:04d}-{m:02d}-{d:02d}T12:00:00.000Z',
+                'vendor_name': vendor,
+                'catalog_number': catalog,
+                'technical_details': 'no_map' if n_attachments == 0 and rng.random() < 0.5 else None,
+                'custom_fields': {
+                    'pKG#': str(pKG),
+                    'Plasmid': '' if rng.random() < violation_rate else f'p{rng.choice(ALT_PREFIXES)[1:]}-{i}',
+                    'Species': rng.choice(SPECIES),
+                    'Resistance markers': rng.choice(BAD_RESISTANCES) if rng.random() < violation_rate else rng.choice(RESISTANCES),
+                    'Plasmid type': rng.choice(PLASMID_TYPES),
+                    'Date stored': rng.choice(DATE_FORMATS).format(y=y, m=m, d=d)}},
+            'relationships': {
+                'owned_by': {'data': {'type': 'user', 'id': rng.choice(users)['id'] if rng.random() > 0.02 else '999999'}}}})
+    items.sort(key=lambda item: item['attributes']['name'], reverse=True)
+    return Inventory(items, attachments, users)
+
+def plasmid_map(item: Dict[str,Any], attachment: Dict[str,Any], violation_rate: float=0.05, length: int=5000) -> bytes:
+    '''
+    A GenBank map for an attachment of item, annotating the genes of its
+    resistance markers. About violation_rate of the maps miss one.
+    Deterministic for a given attachment.
+    '''
+    rng = random.Random(attachment['id'])
+    labels = [RESISTANCE_GENES[resistance] for resistance in item['attributes']['custom_fields']['Resistance markers']
+        if resistance in RESISTANCE_GENES]
+    if labels and rng.random() < violation_rate:
+        labels.pop()
+    name = attachment['attributes']['file_name'].rsplit('.', 1)[0]
+    lines = [f'LOCUS       {name:<16} {length} bp    DNA     circular SYN',
+        'FEATURES             Location/Qualifiers',
+        f'     source          1..{length}',
+        '     rep_origin      100..688',
+        '                     /label=ori']
+    for i, label in enumerate(labels):
+        start = 1000 + 1000 * i
+        lines += [f'     promoter        {start - 100}..{start - 1}', f'                     /label={label} promoter',
+            f'     CDS             {start}..{start + 800}', f'                     /label={label}']
+    lines.append('ORIGIN')
+    sequence = ''.join(rng.choice('acgt') for _ in range(length))
+    for offset in range(0, length, 60):
+        chunk = sequence[offset:offset + 60]
+        lines.append(f'{offset + 1:>9} ' + ' '.join(chunk[k:k + 10] for k in range(0, len(chunk), 10)))
+    lines.append('//')
+    return ('\n'.join(lines) + '\n').encode('utf-8')
@@ -1,19 +1,157 @@
 import argparse
+import contextlib
+import hashlib
 import shutil
 import os
 import json
-import re
+import runpy
 import subprocess
 import sys
+import threading
+import time
+import traceback
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 import textwrap
-import itertools
 
-from typing import List, Dict, Tuple, Optional
+import requests
+
+from typing import List, Dict, Tuple, Optional, Set, Iterator, NamedTuple, Union
+
+from quartzy_parser import DEFAULT_GROUP_ID, QuartzyClient, Snapshot, iter_groups, Plasmid, lint_plasmid
+from quartzy_parser.attachments import AttachmentStore, DEFAULT_ATTACHMENT_CACHE, PlasmidMaps, sync_attachments
+from quartzy_parser.linter import LintStats, CrossRecordIndex, Findings, apply_findings, lint_sequences, merge_findings, ruleset_fingerprint
+from quartzy_parser.lint_cache import LintCache, DEFAULT_LINT_CACHE
+from quartzy_parser.metrics import METRICS, profiled
+from site_builder import html_backend, optimize, versions
+from site_builder.aggregate import InventoryIndex, LintGroups
+from site_builder.search_index import SearchIndex
+
+
+def group_arg(value: str) -> Tuple[str,str]:
+    '''Parses a GROUP_ID[=TITLE] argument into (group ID, title).'''
+    group_id, _, title = value.partition('=')
+    return group_id, title or f'Group {group_id}'
+
 
-from quartzy_parser import get_plasmids, Plasmid, lint_plasmids
 parser = argparse.ArgumentParser(description="Generates HTML and PDFs from Markdown files")
 parser.add_argument('--force-rebuild', action='store_true')
+parser.add_argument('--fetch-workers', type=int, default=4,
+    help='Maximum number of concurrent Quartzy requests while fetching plasmids')
+parser.add_argument('--page-size', type=int, default=500,
+    help='Number of items requested per Quartzy page')
+parser.add_argument('--offline', action='store_true',
+    help='Build from the local inventory snapshot without contacting Quartzy')
+parser.add_argument('--groups', type=group_arg, nargs='+', default=[group_arg(DEFAULT_GROUP_ID)], metavar='GROUP_ID[=TITLE]',
+    help='Quartzy groups whose inventories are fetched and built together. With several groups, each gets its own '
+        f'By pKG page tree titled TITLE under plasmids/GROUP_ID/ (default: {DEFAULT_GROUP_ID})')
+parser.add_argument('--snapshot', type=Path, default=None,
+    help='Inventory snapshot file (default: quartzy_snapshot.json next to build.py)')
+parser.add_argument('--metrics', type=Path, default=None,
+    help='Where to write build metrics as JSON (default: output/metrics.json)')
+parser.add_argument('--prometheus', type=Path, default=None,
+    help='Also write build metrics in Prometheus text format to this file')
+parser.add_argument('--profile', action='store_true',
+    help='Run the Python stages under cProfile and dump output/profile.pstats')
+parser.add_argument('--backend', choices=['rst', 'html'], default='rst',
+    help='Render plasmid, vendor list and index pages as RST for Sphinx, or directly to HTML')
+parser.add_argument('--nav-shard-size', type=int, default=500,
+    help='Number of consecutive pKG numbers grouped under each range page of the By pKG index')
+parser.add_argument('--lint-cache', type=Path, nargs='?', const=DEFAULT_LINT_CACHE, default=None, metavar='PATH',
+    help=f'Reuse lint results of plasmids whose Quartzy item is unchanged from an on-disk cache (default path: {DEFAULT_LINT_CACHE})')
+parser.add_argument('--attachments', type=Path, nargs='?', const=DEFAULT_ATTACHMENT_CACHE, default=None, metavar='DIR',
+    help='Download plasmid maps into a content-addressed cache (only new ones; none with --offline) and lint '
+        f'plasmids against their map features (default cache: {DEFAULT_ATTACHMENT_CACHE})')
+parser.add_argument('--versions', nargs='*', default=None, metavar='REF',
+    help='Build the docs of these branches and tags (default: all remote branches and tags) from one '
+        'shared inventory fetch, reusing cached builds of versions whose commit and inventory are unchanged')
+parser.add_argument('--version-cache', type=Path, default=None,
+    help='Where built versions are cached (default: output/versions)')
+parser.add_argument('--version-jobs', type=int, default=None,
+    help='Number of versions built in parallel (default: one per core)')
+parser.add_argument('--docroot', type=Path, default=None,
+    help='With --versions, copy every version to DOCROOT/en/<version>/')
+parser.add_argument('--render-processes', type=int, default=None,
+    help='Worker processes for the html backend and --optimize (default: one per core)')
+parser.add_argument('--optimize', action='store_true',
+    help='After building, minify the pages and search index, fingerprint the static assets and write .gz/.br '
+        'siblings, redoing only files that changed since the last build (with --versions, of every version)')
+parser.add_argument('--watch', type=float, nargs='?', const=60.0, default=None, metavar='SECONDS',
+    help='Keep running and serve the site: poll Quartzy every SECONDS (default: 60; with --offline, watch the '
+        'snapshot file) and rebuild only what changed. Uses the lint cache; best with --backend html')
+parser.add_argument('--host', default='127.0.0.1', help='Address the --watch server listens on')
+parser.add_argument('--port', type=int, default=8000, help='Port the --watch server listens on')
+
+class PlasmidSummary(NamedTuple):
+    '''
+    The few plasmid fields the index pages need. Kept instead of full
+    Plasmid records so memory stays small while plasmids stream through.
+    '''
+    pKG: int
+    filename: str
+    name: str
+    vendor: Optional[str]
+    alt_name: str
+    errors: List[Tuple[str,str]]
+    warnings: List[Tuple[str,str]]
+
+    @classmethod
+    def of(cls, plasmid: Plasmid) -> 'PlasmidSummary':
+        return cls(plasmid.pKG, plasmid.filename, plasmid.name, plasmid.vendor,
+            plasmid.alt_name, list(plasmid.errors), list(plasmid.warnings))
+
+PlasmidLike = Union[Plasmid, PlasmidSummary]
+
+class DocWriter:
+    '''
+    Writes generated documents, leaving files whose content is unchanged
+    untouched so their mtimes (and Sphinx's incremental build) are preserved.
+    Writes go through a temporary file and an atomic rename.
+    '''
+    def __init__(self):
+        self.written: Set[Path] = set()
+        self.n_changed = 0
+        self.n_unchanged = 0
+        self.n_pruned = 0
+
+    def keep(self, path: Path) -> None:
+        '''Counts path as written unchanged without comparing it, e.g. because its content is known to match.'''
+        if path not in self.written:
+            self.written.add(path)
+            self.n_unchanged += 1
+
+    def write(self, path: Path, content: str) -> bool:
+        '''
+        Writes content to path if it differs from what is on disk. Returns True
+        if written. A page written again in the same run is only counted once.
+        '''
+        first = path not in self.written
+        self.written.add(path)
+        data = content.encode('utf-8')
+        try:
+            if path.stat().st_size == len(data) and path.read_bytes() == data:
+                self.n_unchanged += first
+                return False
+        except FileNotFoundError:
+            # New page, possibly in a new group directory
+            path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'.{path.name}.tmp')
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+        self.n_changed += first
+        return True
+
+    def prune(self, directory: Path, patterns: List[str]) -> None:
+        '''Deletes files matching patterns in directory that were not written this run.'''
+        for pattern in patterns:
+            for path in directory.glob(pattern):
+                if path not in self.written:
+                    path.unlink()
+                    self.n_pruned += 1
+
+    def summary(self) -> str:
+        return f'{self.n_changed} pages changed, {self.n_unchanged} unchanged, {self.n_pruned} stale pages removed'
 
 def plasmid_rst(plasmid: Plasmid) -> str:
     # Process subentries
@@ -53,101 +191,116 @@ def plasmid_rst(plasmid: Plasmid) -> str:
     )
 
 
-def summarize_linting(plasmids:List[Plasmid]) -> str:
-    error_map: Dict[str,List[Tuple[str,str]]] = {}
-    warn_map: Dict[str,List[Tuple[str,str]]] = {}
+def _lint_table(kind: str, n_plasmids: int, groups: Dict[str,List[PlasmidLike]]) -> str:
+    if n_plasmids == 0:
+        return ''
+    rows = [f'.. {kind}::\n\n\tThere are {n_plasmids} plasmids with {kind}s.\n\n\t.. list-table::\n']
+    for lint_type, plasmids in groups.items():
+        rows.append(f'\n\t\t* - {lint_type}\n\t\t  - ')
+        rows.append(', '.join([f':doc:`pKG{plasmid.pKG} </plasmids/{plasmid.filename.split(".")[0]}>`'
+            for plasmid in plasmids]))
+    return ''.join(rows)
 
-    for plasmid in plasmids:
-        for error_type, _ in plasmid.errors:
-            if error_type not in error_map:
-                error_map[error_type] = []
-            error_map[error_type].append((plasmid.filename, str(plasmid.pKG)))
-        for warn_type, _ in plasmid.warnings:
-            if warn_type not in warn_map:
-                warn_map[warn_type] = []
-            warn_map[warn_type].append((plasmid.filename, str(plasmid.pKG)))
-
-    n_error_plasmids = len(set(itertools.chain.from_iterable(error_map.values())))
-    n_warn_plasmids = len(set(itertools.chain.from_iterable(warn_map.values())))
-
-    if n_error_plasmids == 0:
-        error_str = ''
-    else:
-        error_base = (
-            f'.. error::\n\n\tThere are {n_error_plasmids} plasmids with errors.' +
-            '\n\n\t.. list-table::\n'
-        )
-
-        error_str = error_base
-        for error_type, error_plasmids in error_map.items():
-            doc_accum = [f':doc:`pKG{pKG} </plasmids/{filename.split(".")[0]}>`' for filename, pKG in error_plasmids]
-            error_str = (
-                error_str +
-                f'\n\t\t* - {error_type}\n\t\t  - {", ".join(doc_accum)}'
-            )
-
-    if n_warn_plasmids == 0:
-        warn_str = ''
-    else:
-        warn_base = (
-            f'.. warning::\n\n\tThere are {n_warn_plasmids} plasmids with warnings.' +
-            '\n\n\t.. list-table::\n'
-        )
-
-        warn_str = warn_base
-        for warn_type, warn_plasmids in warn_map.items():
-            doc_accum = [f':doc:`pKG{pKG} </plasmids/{filename.split(".")[0]}>`' for filename, pKG in warn_plasmids]
-            warn_str = (
-                warn_str +
-                f'\n\t\t* - {warn_type}\n\t\t  - {", ".join(doc_accum)}'
-            )
-    return error_str + '\n' + warn_str
-
-def summarize_alt_names(plasmids: List[Plasmid]) -> Dict[str,List[Plasmid]]:
-    result: Dict[str,List[Plasmid]] = {}
-    # Iterate over plasmids, accumulating alternate names
-    for plasmid in plasmids:
-        # The alternate category is the vendor name, if given
-        alt_cat: Optional[str] = None
-        if plasmid.vendor is not None:
-            alt_cat = plasmid.vendor
-        else:
-            # Try to use a regex to match
-            alt_match = re.match(r'^(?P<alt_category>p[a-zA-Z]+)(?P<alt_name>.*)$', plasmid.alt_name)
-            if alt_match is not None:
-                alt_cat = alt_match.group('alt_category')
-        if alt_cat is None:
-            continue
-        if alt_cat not in result:
-            result[alt_cat] = []
-        result[alt_cat].append(plasmid)
-    return result
-
-def write_alt_name_lists(alt_names: Dict[str,List[Plasmid]], plasmid_path: Path) -> List[str]:
+def summarize_linting(lint: LintGroups) -> str:
+    return _lint_table('error', lint.n_errors, lint.errors) + '\n' + _lint_table('warning', lint.n_warnings, lint.warnings)
+
+def index_categories(index: InventoryIndex) -> List[str]:
+    '''Categories with more than one plasmid, largest first.'''
+    categories = [category for category, plasmids in index.categories.items() if len(plasmids) > 1]
+    return sorted(categories, key=lambda category: -len(index.categories[category]))
+
+def write_alt_name_lists(index: InventoryIndex, categories: List[str], plasmid_path: Path, writer: DocWriter) -> List[str]:
     alt_indexes: List[str] = []
-    for alt_cat, plasmids in alt_names.items():
+    for alt_cat in categories:
+        plasmids = index.categories[alt_cat]
         title = f'By {alt_cat} ({len(plasmids)} plasmids)'
         idx_filename = f'by_{alt_cat}'
         alt_indexes.append(idx_filename)
-        sorted_plasmids = sorted(plasmids, key=lambda p: p.alt_name)
-        alternate_index = (
-            f'{"="*len(title)}\n{title}\n{"="*len(title)}\n' + '\n\n' + summarize_linting(sorted_plasmids) + '\n\n' +
-            '\n'.join([f'- :doc:`{plasmid.vendor + " " if plasmid.vendor is not None else ""}{plasmid.alt_name} (pKG{plasmid.pKG}) - {plasmid.name} <{plasmid.filename.split(".")[0]}>`'
-                for plasmid in sorted_plasmids])
-        )
-        with (plasmid_path / f'{idx_filename}.rst').open('w') as f:
-            f.write(alternate_index)
+        alternate_index = '\n'.join([
+            f'{"="*len(title)}\n{title}\n{"="*len(title)}\n\n\n{summarize_linting(index.category_lint[alt_cat])}\n',
+            *[f'- :doc:`{plasmid.vendor + " " if plasmid.vendor is not None else ""}{plasmid.alt_name} (pKG{plasmid.pKG}) - {plasmid.name} <{plasmid.filename.split(".")[0]}>`'
+                for plasmid in plasmids]])
+        writer.write(plasmid_path / f'{idx_filename}.rst', alternate_index)
     return alt_indexes
 
 
-def build_index_page(plasmids: List[Plasmid], alt_indexes: List[str]) -> str:
+def pkg_range(pKG: int, shard_size: int) -> Tuple[str,str]:
+    '''Page name and title of the pKG range page listing pKG.'''
+    start = pKG // shard_size * shard_size
+    end = start + shard_size - 1
+    return f'range_{start:05d}-{end:05d}', f'pKG{start} - pKG{end}'
+
+def pkg_ranges(plasmids: List[PlasmidLike], shard_size: int) -> List[Tuple[str,str,List[PlasmidLike]]]:
+    '''Groups plasmids by pKG range as (page name, title, plasmids sorted by filename), in pKG order.'''
+    ranges: Dict[Tuple[str,str],List[PlasmidLike]] = {}
+    for plasmid in plasmids:
+        key = pkg_range(plasmid.pKG, shard_size)
+        if key not in ranges:
+            ranges[key] = []
+        ranges[key].append(plasmid)
+    return [(name, title, sorted(members, key=lambda p: p.filename))
+        for (name, title), members in sorted(ranges.items())]
+
+def group_dir(filename: str) -> str:
+    '''The group directory of a plasmid page ('' when a single group is built).'''
+    return os.path.dirname(filename)
+
+def group_title(directory: str, group_titles: Dict[str,str]) -> str:
+    return group_titles.get(directory, f'Group {directory}')
+
+def plasmids_by_group(plasmids: List[PlasmidLike]) -> Dict[str,List[PlasmidLike]]:
+    '''Plasmids by group directory, in inventory order.'''
+    groups: Dict[str,List[PlasmidLike]] = {}
+    for plasmid in plasmids:
+        groups.setdefault(group_dir(plasmid.filename), []).append(plasmid)
+    return groups
+
+def toctree_page(title: str, docnames: List[str]) -> str:
+    return (f'{"="*len(title)}\n{title}\n{"="*len(title)}\n\n' +
+        '.. toctree::\n   :maxdepth: 1\n\n' + '\n'.join(f'   {docname}' for docname in docnames) + '\n')
+
+def write_pkg_index(plasmids: List[PlasmidLike], plasmid_path: Path, writer: DocWriter, shard_size: int,
+        title: str='By pKG') -> None:
+    '''
+    Writes the By pKG index as a list of pKG range pages, each listing its
+    plasmids. The range pages put their plasmids in a hidden toctree, so
+    Sphinx stops at the ranges when it builds the sidebar of every page
+    instead of walking all plasmids.
+    '''
+    ranges = pkg_ranges(plasmids, shard_size)
+    writer.write(plasmid_path / 'index.rst', toctree_page(title, [name for name, _, _ in ranges]))
+    for name, title, members in ranges:
+        title = f'{title} ({len(members)} plasmids)'
+        docnames = [os.path.basename(plasmid.filename).split('.')[0] for plasmid in members]
+        writer.write(plasmid_path / f'{name}.rst',
+            f'{"="*len(title)}\n{title}\n{"="*len(title)}\n\n' +
+            '.. toctree::\n   :hidden:\n\n' + '\n'.join(f'   {docname}' for docname in docnames) + '\n\n' +
+            '\n'.join(f'- :doc:`{docname}`' for docname in docnames) + '\n')
+
+def write_group_indexes(plasmids: List[PlasmidLike], plasmid_path: Path, writer: DocWriter, shard_size: int,
+        group_titles: Dict[str,str]) -> None:
+    '''
+    Writes the By pKG index. With several groups, every group gets its own
+    index and range pages in its directory, and the By pKG index lists the
+    groups.
+    '''
+    groups = plasmids_by_group(plasmids)
+    if list(groups) in ([], ['']):
+        write_pkg_index(plasmids, plasmid_path, writer, shard_size)
+        return
+    for directory, members in groups.items():
+        write_pkg_index(members, plasmid_path / directory, writer, shard_size,
+            group_title(directory, group_titles))
+    writer.write(plasmid_path / 'index.rst', toctree_page('By pKG', [f'{directory}/index' for directory in groups]))
+
+def build_index_page(index: InventoryIndex, alt_indexes: List[str]) -> str:
     return (textwrap.dedent('''
             .. Galloway Lab plasmids.
 
             Galloway Lab Plasmids
             ==========================
 
-            ''') + summarize_linting(plasmids) + textwrap.dedent('''
+            ''') + summarize_linting(index.lint) + textwrap.dedent('''
             .. toctree::
                 :maxdepth: 1
                 :glob:
@@ -157,46 +310,228 @@ def build_index_page(plasmids: List[Plasmid], alt_indexes: List[str]) -> str:
             ''') + '\n'.join([f'    plasmids/{alt_idx}' for alt_idx in alt_indexes])
     )
 
-if __name__ == '__main__':
-    args = parser.parse_args()
-    base = Path(__file__).resolve().parent
-
+# Root document Sphinx builds with the html backend; its content is replaced by the rendered index page
+HTML_BACKEND_INDEX = textwrap.dedent('''
+    .. Galloway Lab plasmids. Rendered by the html backend in build.py.
+
+    Galloway Lab Plasmids
+    ==========================
+    ''')
+
+def html_range_pages(plasmids: List[PlasmidLike], directory: str, shard_size: int,
+        breadcrumbs: List[html_backend.Link]) -> Tuple[List[html_backend.Link], List[html_backend.Page]]:
+    '''The pKG range pages of the html backend in directory, and the links to them.'''
+    links: List[html_backend.Link] = []
+    pages: List[html_backend.Page] = []
+    for name, title, members in pkg_ranges(plasmids, shard_size):
+        path = f'{directory}/{name}.html'
+        title = f'{title} ({len(members)} plasmids)'
+        links.append((path, title))
+        pages.append(html_backend.list_page(path, title,
+            [(html_backend.page_path(plasmid.filename), html_backend.plasmid_title(plasmid)) for plasmid in members],
+            simple=True, section='plasmids/index.html', breadcrumbs=breadcrumbs))
+    return links, pages
+
+def html_index_pages(index: InventoryIndex, categories: List[str],
+        project: str, shard_size: int, group_titles: Dict[str,str]) -> Tuple[List[html_backend.Link], List[html_backend.Page]]:
+    '''
+    The by-pKG, (per-group) pKG range, by-vendor and index pages for the
+    html backend, plus the sidebar links to them.
+    '''
+    nav = [('plasmids/index.html', 'By pKG')]
+    pages: List[html_backend.Page] = []
+    for alt_cat in categories:
+        alt_plasmids = index.categories[alt_cat]
+        path = f'plasmids/by_{alt_cat}.html'
+        title = f'By {alt_cat} ({len(alt_plasmids)} plasmids)'
+        nav.append((path, title))
+        links = [(html_backend.page_path(plasmid.filename),
+            f'{plasmid.vendor + " " if plasmid.vendor is not None else ""}{plasmid.alt_name} (pKG{plasmid.pKG}) - {plasmid.name}')
+            for plasmid in alt_plasmids]
+        pages.append(html_backend.list_page(path, title, links, lint=html_backend.lint_summary(index.category_lint[alt_cat]),
+            simple=True, section=path))
+    by_pkg: List[html_backend.Link] = [('plasmids/index.html', 'By pKG')]
+    groups = plasmids_by_group(index.plasmids)
+    if list(groups) in ([], ['']):
+        range_links, range_pages = html_range_pages(index.plasmids, 'plasmids', shard_size, by_pkg)
+        pages.extend(range_pages)
+    else:
+        range_links = []
+        for directory, members in groups.items():
+            path = f'plasmids/{directory}/index.html'
+            title = group_title(directory, group_titles)
+            group_links, range_pages = html_range_pages(members, f'plasmids/{directory}', shard_size,
+                [*by_pkg, (path, title)])
+            pages.extend(range_pages)
+            pages.append(html_backend.list_page(path, title, group_links, section='plasmids/index.html', breadcrumbs=by_pkg))
+            range_links.append((path, f'{title} ({len(members)} plasmids)'))
+    pages.append(html_backend.list_page('plasmids/index.html', 'By pKG', range_links, section='plasmids/index.html'))
+    pages.append(html_backend.list_page('index.html', project, nav, lint=html_backend.lint_summary(index.lint)))
+    return nav, pages
+
+def load_credentials(base: Path) -> Dict[str,str]:
     if Path(base / 'credentials.json').is_file():
-        with open('credentials.json') as cred_file:
-            credentials = json.load(cred_file)
+        with open(base / 'credentials.json') as cred_file:
+            return json.load(cred_file)
     elif 'QUARTZY_USERNAME' in os.environ and 'QUARTZY_PASSWORD' in os.environ:
-        credentials = {
+        return {
             'username': os.environ['QUARTZY_USERNAME'],
             'password': os.environ['QUARTZY_PASSWORD']
         }
-    else:
-        raise ValueError("Cannot find credentials!")
-    plasmids = get_plasmids(credentials['username'], credentials['password'])#[::20]
-    lint_plasmids(plasmids)
-
-    alt_names_map = summarize_alt_names(plasmids)
-    # Filter out alt names with only one entry
-    alt_names_map = {k:v for k,v in alt_names_map.items() if len(v) > 1}
-    # Sort alt names by # of plasmids
-    sorted_alt_names_map = dict(sorted(alt_names_map.items(), key=lambda item: -len(item[1])))
-
-    alt_indexes = write_alt_name_lists(sorted_alt_names_map, base / 'docs' / 'plasmids')
-
-
-    with (base / 'docs' / 'index.rst').open('w', encoding='utf-8') as index_file:
-        index_file.write(build_index_page(plasmids, alt_indexes))
-
+    raise ValueError("Cannot find credentials!")
+
+class GeneratedDocs(NamedTuple):
+    '''What generate_docs leaves to be written into the Sphinx output.'''
+    search_index: SearchIndex
+    # Only set with the html backend
+    site: Optional[html_backend.SiteInfo]
+    html_pages: List[html_backend.Page]
+
+def cross_record_findings(snapshot: Snapshot) -> Findings:
+    '''The cross-record findings of the inventory as stored in snapshot.'''
+    index = CrossRecordIndex()
+    for plasmid in snapshot.iter_plasmids():
+        index.add(plasmid)
+    return index.findings()
+
+def generate_docs(args: argparse.Namespace, base: Path) -> GeneratedDocs:
+    '''
+    Fetches (or loads) the inventory and writes all generated RST.
+
+    With the html backend, only the root page is written for Sphinx and the
+    pages are returned to be rendered after the Sphinx build instead.
+    '''
+    snapshot = Snapshot.load(args.snapshot if args.snapshot is not None else base / 'quartzy_snapshot.json')
     plasmid_dir = base / 'docs' / 'plasmids'
     plasmid_dir.mkdir(exist_ok=True)
-    for plasmid in plasmids:
-        with open(plasmid_dir / plasmid.filename, 'w', encoding='utf-8') as f:
-            f.write(plasmid_rst(plasmid))
-
-
-
-
-    if args.force_rebuild and (base / 'output').is_dir():
-        shutil.rmtree(base / 'output')
+    writer = DocWriter()
+
+    # Fetch, lint and write plasmid pages as a stream, so network, CPU and
+    # disk work overlap. Only small summaries are kept for the index pages.
+    summaries: List[PlasmidSummary] = []
+    # Keyed by filename, so pages re-rendered after the cross-record checks keep their place
+    plasmid_pages: Dict[str,html_backend.Page] = {}
+    search_index = SearchIndex()
+    lint_stats = LintStats()
+    cross_index = CrossRecordIndex()
+    # The cross-record and sequence checks need the whole inventory, so their
+    # findings are predicted from the stored snapshot and applied to the
+    # plasmids as they stream past. Only plasmids whose findings turn out
+    # different (because the inventory changed) are emitted a second time.
+    map_findings: Findings = {}
+    predicted_maps: List[PlasmidMaps] = []
+    if args.attachments is not None and not snapshot.is_empty():
+        with METRICS.span('build.attachments'):
+            predicted_maps = sync_attachments(snapshot, AttachmentStore(args.attachments))
+            map_findings = lint_sequences(predicted_maps, args.attachments)
+    predicted = merge_findings(cross_record_findings(snapshot), map_findings)
+
+    group_titles = dict(args.groups)
+
+    def emit(plasmid: Plasmid) -> None:
+        if args.backend == 'html':
+            # Rendered after Sphinx, once the sidebar entries are known
+            range_name, range_title = pkg_range(plasmid.pKG, args.nav_shard_size)
+            breadcrumbs = [('plasmids/index.html', 'By pKG')]
+            directory = group_dir(plasmid.filename)
+            if directory:
+                breadcrumbs.append((f'plasmids/{directory}/index.html', group_title(directory, group_titles)))
+            breadcrumbs.append((f'plasmids/{directory + "/" if directory else ""}{range_name}.html', range_title))
+            plasmid_pages[plasmid.filename] = html_backend.plasmid_page(plasmid, breadcrumbs)
+        else:
+            with METRICS.span('build.render'):
+                page = plasmid_rst(plasmid)
+            with METRICS.span('build.write'):
+                writer.write(plasmid_dir / plasmid.filename, page)
+
+    with contextlib.ExitStack() as stack:
+        lint_cache = stack.enter_context(LintCache(args.lint_cache, ruleset_fingerprint())) if args.lint_cache is not None else None
+        plasmid_stream: Iterator[Plasmid]
+        client: Optional[QuartzyClient] = None
+        if args.offline:
+            if snapshot.is_empty():
+                raise ValueError(f"No inventory snapshot at {snapshot.path}! Run once without --offline first.")
+            plasmid_stream = snapshot.iter_plasmids()
+        else:
+            credentials = load_credentials(base)
+            client = stack.enter_context(QuartzyClient(credentials['username'], credentials['password']))
+            plasmid_stream = iter_groups(client, [group_id for group_id, _ in args.groups],
+                max_workers=args.fetch_workers, page_size=args.page_size, snapshot=snapshot)
+        for plasmid in METRICS.timed_iter('build.fetch', plasmid_stream):
+            with METRICS.span('build.lint'):
+                lint_plasmid(plasmid, lint_stats, lint_cache)
+                cross_index.add(plasmid)
+            # The summary keeps the plasmid's own lint results; the final findings are added below
+            summaries.append(PlasmidSummary.of(plasmid))
+            apply_findings(plasmid, predicted)
+            emit(plasmid)
+            search_index.add(plasmid, html_backend.page_path(plasmid.filename))
+
+        if args.attachments is not None and client is not None:
+            with METRICS.span('build.attachments'):
+                store = AttachmentStore(args.attachments)
+                plasmid_maps = sync_attachments(snapshot, store, client, max_workers=args.fetch_workers)
+            # The sequence lints only depend on the maps and the fields in
+            # PlasmidMaps, so the predicted findings still hold if neither changed
+            if plasmid_maps != predicted_maps:
+                map_findings = lint_sequences(plasmid_maps, args.attachments)
+
+    # Plasmids whose findings differ from the predicted ones are reloaded from
+    # the (now complete) snapshot and emitted again
+    with METRICS.span('build.cross_lint'):
+        findings = merge_findings(cross_index.findings(), map_findings)
+        changed = {filename for filename in findings.keys() | predicted.keys()
+            if findings.get(filename) != predicted.get(filename)}
+        summary_map = {summary.filename: summary for summary in summaries}
+        for summary in summaries:
+            apply_findings(summary, findings)
+        if changed:
+            for plasmid in snapshot.iter_plasmids():
+                if plasmid.filename in changed:
+                    summary = summary_map[plasmid.filename]
+                    plasmid.errors, plasmid.warnings = summary.errors, summary.warnings
+                    emit(plasmid)
+    METRICS.add('build.cross_lint_flagged', len(findings))
+    METRICS.add('build.cross_lint_reemitted', len(changed))
+    if not args.offline:
+        with METRICS.span('build.snapshot_save'):
+            snapshot.save()
+    print(f'lint rule timings:\n{lint_stats.report()}')
+    if lint_cache is not None:
+        print(lint_cache.report())
+
+    with METRICS.span('build.index_pages'):
+        index = InventoryIndex(summaries)
+        categories = index_categories(index)
+
+        site: Optional[html_backend.SiteInfo] = None
+        html_pages: List[html_backend.Page] = []
+        if args.backend == 'html':
+            conf = runpy.run_path(str(base / 'docs' / 'conf.py'))
+            nav, index_pages = html_index_pages(index, categories, conf['project'], args.nav_shard_size, group_titles)
+            site = html_backend.SiteInfo(conf['project'], conf['copyright'], nav)
+            html_pages = [*plasmid_pages.values(), *index_pages]
+            writer.write(base / 'docs' / 'index.rst', HTML_BACKEND_INDEX)
+        else:
+            write_group_indexes(summaries, plasmid_dir, writer, args.nav_shard_size, group_titles)
+            alt_indexes = write_alt_name_lists(index, categories, plasmid_dir, writer)
+
+            writer.write(base / 'docs' / 'index.rst', build_index_page(index, alt_indexes))
+
+        # Remove pages of deleted plasmids, emptied vendor categories and dropped groups
+        writer.prune(plasmid_dir, ['**/pKG*.rst', 'by_*.rst', '**/range_*.rst', '*/index.rst'])
+    METRICS.add('build.pages_changed', writer.n_changed)
+    METRICS.add('build.pages_unchanged', writer.n_unchanged)
+    print(f'docs written: {writer.summary()}')
+    return GeneratedDocs(search_index, site, html_pages)
+
+def run_sphinx(base: Path, force_rebuild: bool, exclude: Optional[List[str]]=None) -> None:
+    if force_rebuild:
+        # Only the Sphinx output; the version cache, optimize manifest and
+        # metrics next to it stay valid
+        for stale in ('html', 'doctrees'):
+            if (base / 'output' / stale).is_dir():
+                shutil.rmtree(base / 'output' / stale)
     if not (base / 'output').is_dir():
         (base / 'output').mkdir()
 
@@ -205,4 +540,228 @@ if __name__ == '__main__':
     docs_path = base / 'docs'
     html_path = base / 'output' / 'html'
     html_args = [python_exe, '-m', 'sphinx.cmd.build', '-b', 'html', '-j', 'auto', str(docs_path), str(html_path)]
-    subprocess.run(html_args)
+    if exclude:
+        html_args[3:3] = ['-D', f'exclude_patterns={",".join(exclude)}']
+    with METRICS.span('build.sphinx'):
+        subprocess.run(html_args)
+
+def write_html_pages(base: Path, site: html_backend.SiteInfo, pages: List[html_backend.Page],
+        processes: Optional[int], rendered: Optional[Dict[str,str]]=None,
+        optimizer: Optional[optimize.PageOptimizer]=None) -> None:
+    '''
+    Renders the html backend pages into the Sphinx output, pruning pages of
+    deleted plasmids.
+
+    rendered maps page paths to a digest of the context they were last
+    rendered from. If given, pages whose context is unchanged are not
+    rendered again, and it is updated with this run's digests. Pages are
+    written through optimizer if given (with --optimize).
+    '''
+    html_path = base / 'output' / 'html'
+    (html_path / 'plasmids').mkdir(parents=True, exist_ok=True)
+    writer = DocWriter()
+    with METRICS.span('build.html'):
+        if rendered is not None:
+            site_key = json.dumps(site, default=str)
+            digests = {page['path']: hashlib.sha256((site_key + json.dumps(page, sort_keys=True, default=str))
+                .encode('utf-8')).hexdigest() for page in pages}
+            unchanged = [page for page in pages if rendered.get(page['path']) == digests[page['path']]
+                and (html_path / page['path']).is_file()]
+            for page in unchanged:
+                writer.keep(html_path / page['path'])
+            pages = [page for page in pages if html_path / page['path'] not in writer.written]
+            rendered.clear()
+            rendered.update(digests)
+            METRICS.add('build.html_pages_skipped', len(unchanged))
+        for path, content in html_backend.render_pages(site, pages, processes):
+            writer.write(html_path / path, optimizer.optimize(path, content) if optimizer is not None else content)
+        writer.prune(html_path / 'plasmids', ['**/pKG*.html', 'by_*.html', '**/range_*.html', '*/index.html'])
+    METRICS.add('build.html_pages_changed', writer.n_changed)
+    METRICS.add('build.html_pages_unchanged', writer.n_unchanged)
+    print(f'html written: {writer.summary()}')
+
+def write_search_index(base: Path, search_index: SearchIndex) -> None:
+    '''Writes the plasmid search index into the Sphinx output, removing stale shards.'''
+    index_path = base / 'output' / 'html' / '_search'
+    index_path.mkdir(parents=True, exist_ok=True)
+    writer = DocWriter()
+    with METRICS.span('build.search_index'):
+        for filename, content in search_index.files():
+            writer.write(index_path / filename, content)
+        writer.prune(index_path, ['*.json'])
+    print(f'search index written: {writer.summary()}')
+
+def write_site(args: argparse.Namespace, base: Path, generated: GeneratedDocs, sphinx: bool=True,
+        rendered: Optional[Dict[str,str]]=None) -> None:
+    '''
+    Builds the site from the generated docs: Sphinx, then (html backend) the
+    rendered pages, then the search index and, with --optimize, the
+    optimization stage. With the html backend, Sphinx only builds the
+    hand-written pages, so sphinx=False skips it once those are built. See
+    write_html_pages for rendered.
+    '''
+    html_path = base / 'output' / 'html'
+    optimizer: Optional[optimize.PageOptimizer] = None
+    if generated.site is not None:
+        # Sphinx only builds the hand-written pages; the rest are rendered directly
+        if sphinx:
+            run_sphinx(base, args.force_rebuild, exclude=['plasmids/**'])
+        if args.optimize:
+            # Rendered pages are written optimized, so unchanged ones are left alone
+            optimizer = optimize.PageOptimizer(html_path, base / 'output' / 'optimize_manifest.json')
+        write_html_pages(base, generated.site, generated.html_pages, args.render_processes, rendered, optimizer)
+    else:
+        run_sphinx(base, args.force_rebuild and sphinx)
+    write_search_index(base, generated.search_index)
+    if args.optimize:
+        optimize_html(html_path, base / 'output' / 'optimize_manifest.json', args.render_processes, optimizer)
+
+def optimize_html(html_path: Path, manifest_path: Path, processes: Optional[int],
+        pages: Optional[optimize.PageOptimizer]=None) -> None:
+    '''Runs the post-build optimization stage on a built site and reports the bytes it saved.'''
+    with METRICS.span('build.optimize'):
+        stats = optimize.optimize_site(html_path, manifest_path, processes, pages)
+    METRICS.add('build.optimize_files_changed', stats.n_changed)
+    METRICS.add('build.optimize_minify_bytes_saved', stats.run.minify)
+    METRICS.add('build.optimize_gzip_bytes_saved', stats.run.gzip)
+    METRICS.add('build.optimize_brotli_bytes_saved', stats.run.brotli)
+    print(f'{html_path} optimized: {stats.summary()}')
+
+def fetch_snapshot(args: argparse.Namespace, client: QuartzyClient, snapshot: Snapshot) -> None:
+    '''Brings the snapshot (and with --attachments, the attachment cache) up to date. The caller saves it.'''
+    with METRICS.span('build.fetch'):
+        for _ in iter_groups(client, [group_id for group_id, _ in args.groups],
+                max_workers=args.fetch_workers, page_size=args.page_size, snapshot=snapshot):
+            pass
+    if args.attachments is not None:
+        with METRICS.span('build.attachments'):
+            sync_attachments(snapshot, AttachmentStore(args.attachments), client, max_workers=args.fetch_workers)
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args) -> None:
+        pass
+
+def serve_site(html_path: Path, host: str, port: int) -> ThreadingHTTPServer:
+    '''Serves html_path from a background thread. Pages are replaced atomically, so rebuilds never serve partial files.'''
+    server = ThreadingHTTPServer((host, port), partial(QuietHandler, directory=str(html_path)))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def watch(args: argparse.Namespace, base: Path) -> None:
+    '''
+    Serves the site and keeps it up to date until interrupted.
+
+    Every args.watch seconds, Quartzy is polled with conditional requests, so
+    unchanged item pages cost a 304 each and no parsing (with --offline, the
+    snapshot file is reloaded when it changes instead). The site is only
+    rebuilt when the inventory fingerprint changed, and then from the
+    snapshot: plasmids of unchanged items reuse their results from the lint
+    cache, DocWriter leaves unchanged files alone, and html pages are only
+    rendered again if their content changed, so the changed plasmids and the
+    index pages listing them are all that is redone.
+    '''
+    snapshot_path = (args.snapshot if args.snapshot is not None else base / 'quartzy_snapshot.json').resolve()
+    build_args = argparse.Namespace(**{**vars(args), 'offline': True, 'snapshot': snapshot_path,
+        'lint_cache': args.lint_cache if args.lint_cache is not None else DEFAULT_LINT_CACHE})
+    html_path = base / 'output' / 'html'
+    html_path.mkdir(parents=True, exist_ok=True)
+    server = serve_site(html_path, args.host, args.port)
+    print(f'serving {html_path} on http://{args.host}:{server.server_address[1]}/')
+
+    rendered: Dict[str,str] = {}
+    built: Optional[str] = None
+    # Offline, the first round loads the snapshot file
+    snapshot = Snapshot(snapshot_path) if args.offline else Snapshot.load(snapshot_path)
+    snapshot_mtime: Optional[int] = None
+    with contextlib.ExitStack() as stack:
+        client: Optional[QuartzyClient] = None
+        if not args.offline:
+            credentials = load_credentials(base)
+            client = stack.enter_context(QuartzyClient(credentials['username'], credentials['password']))
+        while True:
+            METRICS.add('watch.polls')
+            try:
+                if client is not None:
+                    try:
+                        fetch_snapshot(args, client, snapshot)
+                    except requests.RequestException as e:
+                        # Try again next round; the site keeps serving the last build
+                        print(f'polling Quartzy failed: {e}')
+                elif snapshot_path.is_file() and snapshot_path.stat().st_mtime_ns != snapshot_mtime:
+                    snapshot_mtime = snapshot_path.stat().st_mtime_ns
+                    snapshot = Snapshot.load(snapshot_path)
+                fingerprint = snapshot.fingerprint()
+                if fingerprint != built and not snapshot.is_empty():
+                    if client is not None:
+                        snapshot.save()
+                    with METRICS.span('watch.rebuild'):
+                        write_site(build_args, base, generate_docs(build_args, base), sphinx=built is None, rendered=rendered)
+                    built = fingerprint
+                    print(f'site rebuilt at {time.strftime("%H:%M:%S")}')
+            except Exception:
+                # E.g. a malformed response or snapshot, or a failing build
+                # step; the site keeps serving the last build and the next
+                # round retries
+                METRICS.add('watch.rebuild_errors')
+                print(f'rebuilding the site failed at {time.strftime("%H:%M:%S")}:')
+                traceback.print_exc()
+            time.sleep(args.watch)
+
+def build_all_versions(args: argparse.Namespace, base: Path) -> Dict[str,str]:
+    '''
+    Fetches the inventory once, then builds every requested version against
+    it. Returns the build status of each version.
+    '''
+    snapshot_path = (args.snapshot if args.snapshot is not None else base / 'quartzy_snapshot.json').resolve()
+    snapshot = Snapshot.load(snapshot_path)
+    if not args.offline:
+        credentials = load_credentials(base)
+        with QuartzyClient(credentials['username'], credentials['password']) as client:
+            fetch_snapshot(args, client, snapshot)
+        snapshot.save()
+    elif snapshot.is_empty():
+        raise ValueError(f"No inventory snapshot at {snapshot.path}! Run once without --offline first.")
+
+    names = args.versions if len(args.versions) > 0 else versions.list_versions(base)
+    cache_dir = args.version_cache if args.version_cache is not None else base / 'output' / 'versions'
+    builder = versions.VersionBuilder(base, cache_dir.resolve(), snapshot_path, snapshot.fingerprint())
+    with METRICS.span('build.versions'):
+        status = versions.build_versions(builder, versions.resolve_versions(base, names), args.version_jobs)
+    for name, state in status.items():
+        print(f'{name}: {state}')
+        METRICS.add(f'build.versions_{state}')
+        # Older versions' build.py has no --optimize, so their cached output is optimized here
+        if args.optimize and (builder.cache_dir / name / 'html').is_dir():
+            optimize_html(builder.cache_dir / name / 'html', builder.cache_dir / name / 'optimize_manifest.json',
+                args.render_processes)
+    if args.docroot is not None:
+        versions.publish(builder.cache_dir, list(status), args.docroot / 'en')
+    return status
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    base = Path(__file__).resolve().parent
+
+    if args.watch is not None and args.versions is None:
+        try:
+            watch(args, base)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    status: Dict[str,str] = {}
+    if args.versions is not None:
+        with profiled(base / 'output' / 'profile.pstats' if args.profile else None):
+            status = build_all_versions(args, base)
+    else:
+        with profiled(base / 'output' / 'profile.pstats' if args.profile else None):
+            generated = generate_docs(args, base)
+        write_site(args, base, generated)
+
+    metrics_path = args.metrics if args.metrics is not None else base / 'output' / 'metrics.json'
+    METRICS.write_json(metrics_path)
+    if args.prometheus is not None:
+        METRICS.write_prometheus(args.prometheus)
+    print(f'build metrics ({metrics_path}):\n{METRICS.summary()}')
+    sys.exit(1 if 'failed' in status.values() else 0)
@@ -0,0 +1,159 @@
+/*
+ * Plasmid search against the prebuilt index in _search/ (see
+ * site_builder/search_index.py). Only the manifest, the token shards for the
+ * query terms and the document chunks for the shown results are fetched.
+ */
+(function () {
+    'use strict';
+
+    var MAX_RESULTS = 100;
+    var container = document.getElementById('plasmid-search');
+    var root = container.getAttribute('data-root');
+    var base = root + '_search/';
+    var cache = {};
+
+    function load(name) {
+        if (!(name in cache)) {
+            cache[name] = fetch(base + name).then(function (response) {
+                if (!response.ok) {
+                    throw new Error('Could not load ' + name);
+                }
+                return response.json();
+            });
+        }
+        return cache[name];
+    }
+
+    // Kept in step with tokenize() in search_index.py
+    function tokenize(text) {
+        return (text.toLowerCase().match(/[a-z0-9]+/g) || []).map(function (token) {
+            // pKG numbers without leading zeros, as they are indexed
+            if (/^pkg[0-9]+$/.test(token)) {
+                return String(parseInt(token.slice(3), 10));
+            }
+            return token.replace(/^pkg(?=[0-9])/, '');
+        });
+    }
+
+    function decode(deltas) {
+        var ids = [];
+        var id = 0;
+        for (var i = 0; i < deltas.length; i++) {
+            id += deltas[i];
+            ids.push(id);
+        }
+        return ids;
+    }
+
+    // Sorted ids of documents with a token starting with term, and the set of
+    // those where a token equals term
+    function matchTerm(manifest, term) {
+        var keys = manifest.shards.filter(function (key) {
+            return term.length >= manifest.shard_prefix ? key === term.slice(0, manifest.shard_prefix)
+                : key.slice(0, term.length) === term;
+        });
+        return Promise.all(keys.map(function (key) { return load('t_' + key + '.json'); })).then(function (shards) {
+            var ids = new Set();
+            var exact = new Set();
+            shards.forEach(function (shard) {
+                Object.keys(shard).forEach(function (token) {
+                    if (token.slice(0, term.length) === term) {
+                        decode(shard[token]).forEach(function (id) {
+                            ids.add(id);
+                            if (token === term) {
+                                exact.add(id);
+                            }
+                        });
+                    }
+                });
+            });
+            return {ids: Array.from(ids).sort(function (a, b) { return a - b; }), exact: exact};
+        });
+    }
+
+    // Ids matching every term, those matching more terms exactly first
+    function intersect(matches) {
+        var lists = matches.map(function (match) { return match.ids; });
+        lists.sort(function (a, b) { return a.length - b.length; });
+        var ids = lists[0].filter(function (id) {
+            return lists.every(function (list) { return binarySearch(list, id); });
+        });
+        var score = {};
+        ids.forEach(function (id) {
+            score[id] = matches.filter(function (match) { return match.exact.has(id); }).length;
+        });
+        return ids.sort(function (a, b) { return score[b] - score[a] || a - b; });
+    }
+
+    function binarySearch(list, id) {
+        var lo = 0;
+        var hi = list.length - 1;
+        while (lo <= hi) {
+            var mid = (lo + hi) >> 1;
+            if (list[mid] === id) {
+                return true;
+            }
+            if (list[mid] < id) {
+                lo = mid + 1;
+            } else {
+                hi = mid - 1;
+            }
+        }
+        return false;
+    }
+
+    function render(manifest, ids) {
+        var status = document.getElementById('plasmid-search-status');
+        var results = document.getElementById('plasmid-search-results');
+        results.innerHTML = '';
+        status.textContent = ids.length === 1 ? '1 plasmid found.' : ids.length + ' plasmids found.';
+        if (ids.length > MAX_RESULTS) {
+            status.textContent += ' Showing the first ' + MAX_RESULTS + '.';
+        }
+        var shown = ids.slice(0, MAX_RESULTS);
+        var chunks = Array.from(new Set(shown.map(function (id) { return Math.floor(id / manifest.doc_chunk); })));
+        return Promise.all(chunks.map(function (n) { return load('d_' + n + '.json'); })).then(function (loaded) {
+            var docs = {};
+            chunks.forEach(function (n, i) { docs[n] = loaded[i]; });
+            shown.forEach(function (id) {
+                var doc = docs[Math.floor(id / manifest.doc_chunk)][id % manifest.doc_chunk];
+                var item = document.createElement('li');
+                var paragraph = document.createElement('p');
+                var link = document.createElement('a');
+                link.className = 'reference internal';
+                link.href = root + doc[0];
+                link.textContent = doc[1];
+                paragraph.appendChild(link);
+                if (doc[2]) {
+                    paragraph.appendChild(document.createTextNode(' (' + doc[2] + ')'));
+                }
+                item.appendChild(paragraph);
+                results.appendChild(item);
+            });
+        });
+    }
+
+    function search(query) {
+        var terms = tokenize(query);
+        if (terms.length === 0) {
+            return;
+        }
+        load('manifest.json').then(function (manifest) {
+            return Promise.all(terms.map(function (term) { return matchTerm(manifest, term); })).then(function (matches) {
+                return render(manifest, intersect(matches));
+            });
+        }).catch(function (error) {
+            document.getElementById('plasmid-search-status').textContent = error.message;
+        });
+    }
+
+    var input = document.getElementById('plasmid-search-query');
+    var query = new URLSearchParams(window.location.search).get('q') || '';
+    input.value = query;
+    search(query);
+    document.getElementById('plasmid-search-form').addEventListener('submit', function (event) {
+        event.preventDefault();
+        window.history.replaceState(null, '', '?q=' + encodeURIComponent(input.value));
+        search(input.value);
+    });
+})();
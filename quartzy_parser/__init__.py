@@ -1,3 +1,5 @@
-from .parser import get_plasmids, get_users # type: ignore
-from .models import Plasmid, User # type: ignore
-from .linter import lint_plasmids # type: ignore
\ No newline at end of file
+from .client import QuartzyClient # type: ignore
+from .parser import get_plasmids, iter_plasmids, iter_groups, get_users # type: ignore
+from .models import DEFAULT_GROUP_ID, Plasmid, User # type: ignore
+from .snapshot import Snapshot # type: ignore
+from .linter import lint_plasmid, lint_plasmids # type: ignore
\ No newline at end of file
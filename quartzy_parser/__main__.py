@@ -1,92 +1,211 @@
-from typing import List, Dict
+from typing import List, Optional, TextIO, Tuple
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import argparse
+import contextlib
 import os
 import json
+import sys
 
+from . import client
 from . import models
 from . import parser
+from . import snapshot
 from . import linter
+from . import lint_cache
+from . import attachments
+from . import store
+from . import report as lint_report
+from . import metrics
 
 """
 Specify:
 - errors, warnings, or both (default)
 - specific user(s) or all users (default)
+- text, JSON Lines or CSV output
+
+or, with the `query` subcommand, filters to select plasmids from the local
+inventory store that every report run updates.
 """
 
-def get_flags(users: List[models.User], plasmids: List[models.Plasmid]):
-    
+def lint_maps(inventory: snapshot.Snapshot, cache_dir: Path, quartzy: Optional[client.QuartzyClient]=None) -> linter.Findings:
+    '''Syncs the attachment cache (downloading only with a client) and lints plasmids against their maps.'''
+    store = attachments.AttachmentStore(cache_dir)
+    return linter.lint_sequences(attachments.sync_attachments(inventory, store, quartzy, max_workers=8), cache_dir)
+
+def load_inventory(args: argparse.Namespace) -> Tuple[List[models.User],List[models.Plasmid],linter.Findings]:
+    '''
+    The users and plasmids (from the snapshot, or fetched into it) and, with
+    --attachments, the findings of the map lints.
+    '''
+    inventory = snapshot.Snapshot.load(args.snapshot)
+    if args.offline:
+        if inventory.is_empty() or len(inventory.user_fields) == 0:
+            arg_parser.exit(1, f'No usable inventory snapshot at {args.snapshot}! Run once without --offline first.\n')
+        map_findings = lint_maps(inventory, args.attachments) if args.attachments is not None else {}
+        return inventory.users(), inventory.plasmids(), map_findings
+
+    # Access Quartzy database using locally specified credentials
+    if Path('credentials.json').is_file():
+        with open('credentials.json') as cred_file:
+            credentials = json.load(cred_file)
+    elif 'QUARTZY_USERNAME' in os.environ and 'QUARTZY_PASSWORD' in os.environ:
+        credentials = {
+            'username': os.environ['QUARTZY_USERNAME'],
+            'password': os.environ['QUARTZY_PASSWORD']
+        }
+    else:
+        arg_parser.exit(1, 'Cannot find credentials! Create a `credentials.json` file that looks like\n{"username": "blah", "password": "blah"}\n')
+
+    print("found credentials")
+
+    # Users and plasmids are fetched at the same time, sharing the login and rate limit
+    with client.QuartzyClient(credentials['username'], credentials['password']) as quartzy, \
+            ThreadPoolExecutor(max_workers=1) as pool:
+        users = pool.submit(parser.get_users, quartzy, inventory, args.groups)
+        plasmids = parser.get_plasmids(quartzy, max_workers=args.fetch_workers, snapshot=inventory, group_ids=args.groups)
+        all_users = users.result()
+        map_findings = lint_maps(inventory, args.attachments, quartzy) if args.attachments is not None else {}
+    inventory.save()
+    return all_users, plasmids, map_findings
+
+def snapshot_key(snapshot_path: Path) -> str:
+    '''Identifies a snapshot file version and lint rule set, to tell whether the store is up to date.'''
+    stat = snapshot_path.stat()
+    return f'{snapshot_path.resolve()}:{stat.st_mtime_ns}:{stat.st_size}:{linter.ruleset_fingerprint()}'
+
+def report(args: argparse.Namespace, out: TextIO) -> None:
+    all_users, plasmids, map_findings = load_inventory(args)
+
+    if args.lint_cache is not None:
+        with lint_cache.LintCache(args.lint_cache, linter.ruleset_fingerprint()) as cache:
+            linter.lint_plasmids(plasmids, cache=cache)
+    else:
+        linter.lint_plasmids(plasmids)
+    if map_findings:
+        for plasmid in plasmids:
+            linter.apply_findings(plasmid, map_findings)
+
+    if args.store is not None:
+        with store.InventoryStore(args.store) as inventory_store:
+            inventory_store.replace(all_users, plasmids, snapshot_key(args.snapshot))
+
+    lints = lint_report.LintReport(all_users, plasmids)
+    try:
+        owner_ids = lints.select(args.user) if args.user else None
+    except KeyError as e:
+        arg_parser.exit(1, f'No user named {e.args[0]}!\n')
+    severities = [severity for severity in lint_report.SEVERITIES
+        if not (severity == linter.ERROR and args.only_warnings) and not (severity == linter.WARNING and args.only_errors)]
+    with metrics.METRICS.span('report.write'):
+        if args.format == 'json':
+            lint_report.write_json(lints.findings(owner_ids, severities), out)
+        elif args.format == 'csv':
+            lint_report.write_csv(lints.findings(owner_ids, severities), out)
+        else:
+            lint_report.write_text(lints, out, owner_ids, severities)
+
+def refresh_store(inventory_store: store.InventoryStore, snapshot_path: Path) -> None:
+    '''Rebuilds the store from the snapshot (linting every plasmid) if the snapshot changed since it was written.'''
+    if not snapshot_path.is_file():
+        return
+    key = snapshot_key(snapshot_path)
+    if inventory_store.source_key() == key:
+        return
+    print(f'updating {inventory_store.path} from {snapshot_path}...')
+    inventory = snapshot.Snapshot.load(snapshot_path)
+    plasmids = inventory.plasmids()
     linter.lint_plasmids(plasmids)
-    warnings: Dict[str,List[models.Plasmid]] = {}
-    errors: Dict[str,List[models.Plasmid]] = {}
-
-    # Set a default user for plasmids with now-defunct users
-    default_user: models.User = None
-
-    # Create a dict of (user_id, User) pairs
-    users_by_id: Dict[str,models.User] = {}
-    for user in users:
-        users_by_id[user.id] = user
-        if user.full_name == 'Galloway Lab': default_user = user
-
-    # Loop over all plasmids, storing plasmids with warnings/errors by user
-    for plasmid in plasmids:
-        if plasmid.owner_id in list(users_by_id.keys()):
-            user = users_by_id[plasmid.owner_id].full_name
-        else: user = default_user.full_name
-        
-        if plasmid.warnings:
-            if user not in list(warnings.keys()): warnings[user] = [plasmid]
-            else: warnings[user].append(plasmid)
-        if plasmid.errors: 
-            if user not in list(errors.keys()): errors[user] = [plasmid]
-            else: errors[user].append(plasmid)
-
-    return warnings, errors
+    inventory_store.replace(inventory.users(), plasmids, key)
+
+def query(args: argparse.Namespace) -> None:
+    with store.InventoryStore(args.store) as inventory_store:
+        refresh_store(inventory_store, args.snapshot)
+        if inventory_store.source_key() is None:
+            arg_parser.exit(1, f'No inventory store at {args.store} and no snapshot to build it from! Run a report first.\n')
+        users = inventory_store.users()
+        matches = list(inventory_store.query(store.PlasmidQuery(
+            pKG=args.pkg, group_id=args.group, vendor=args.vendor, catalog_number=args.catalog, owner=args.owner,
+            resistance=args.resistance, plasmid_type=args.type, name=args.name, lint_category=args.lint,
+            with_errors=args.with_errors, with_warnings=args.with_warnings, limit=args.limit)))
+    if args.count:
+        print(len(matches))
+        return
+    for plasmid in matches:
+        owner = users[plasmid.owner_id].full_name if plasmid.owner_id in users else plasmid.owner_id
+        print('\t'.join([f'pKG{plasmid.pKG}', plasmid.name, f'{plasmid.vendor or ""} {plasmid.alt_name}'.strip(), owner,
+            ', '.join(plasmid.resistances), ', '.join(plasmid.plasmid_type),
+            f'{len(plasmid.errors)} errors, {len(plasmid.warnings)} warnings']))
+        if args.show_lint:
+            for category, message in plasmid.errors:
+                print(f'    error: {category}: {message}')
+            for category, message in plasmid.warnings:
+                print(f'    warning: {category}: {message}')
 
 arg_parser = argparse.ArgumentParser(description="Displays plasmids with errors/warnings by user")
 group = arg_parser.add_mutually_exclusive_group()
 group.add_argument('--only-errors', action='store_true', help='Display only errors')
 group.add_argument('--only-warnings', action='store_true', help='Display only warnings')
-arg_parser.add_argument('--user', help='Specify user(s) to display, default all')
-
-args = arg_parser.parse_args()
-
-# Access Quartzy database using locally specified credentials
-if Path('credentials.json').is_file():
-    with open('credentials.json') as cred_file:
-        credentials = json.load(cred_file)
-elif 'QUARTZY_USERNAME' in os.environ and 'QUARTZY_PASSWORD' in os.environ:
-    credentials = {
-        'username': os.environ['QUARTZY_USERNAME'],
-        'password': os.environ['QUARTZY_PASSWORD']
-    }
-else:
-    arg_parser.exit(1, 'Cannot find credentials! Create a `credentials.json` file that looks like\n{"username": "blah", "password": "blah"}\n')
-
-print("found credentials")
-
-# Parse arguments
-all_users = parser.get_users(credentials['username'], credentials['password'])
-plasmids = parser.get_plasmids(credentials['username'], credentials['password'])
-users = []
-if not args.user:
-    users = all_users
-else:
-    for u in all_users:
-        if u.full_name in args.user: users.append(u)
-
-# Get list of errors/warnings by user
-errors, warnings = get_flags(users, plasmids)
-
-# Display errors/warnings
-if not args.only_errors:
-    print('\nWarnings\n--------\n')
-    for user, plasmid_list in errors.items():
-        if len(plasmid_list) > 0:
-            print(f'{user}:\n  ' + '\n  '.join([str(p.pKG) for p in plasmid_list]) + '\n')
-if not args.only_warnings:
-    print('\nErrors\n------\n')
-    for user, plasmid_list in warnings.items():
-        if len(plasmid_list) > 0:
-            print(f'{user}:\n  ' + '\n  '.join([str(p.pKG) for p in plasmid_list]) + '\n')
\ No newline at end of file
+arg_parser.add_argument('--user', nargs='+', metavar='NAME',
+    help='Only report these users, by exact full name or user ID (default: all users)')
+arg_parser.add_argument('--format', choices=['text', 'json', 'csv'], default='text',
+    help='Report as text by user and lint category, or one finding per line as JSON Lines or CSV')
+arg_parser.add_argument('--output', type=Path, help='Write the report to this file instead of stdout')
+arg_parser.add_argument('--fetch-workers', type=int, default=4,
+    help='Maximum number of concurrent Quartzy requests while fetching plasmids')
+arg_parser.add_argument('--offline', action='store_true', help='Use the local inventory snapshot instead of contacting Quartzy')
+arg_parser.add_argument('--snapshot', type=Path, default=Path('quartzy_snapshot.json'), help='Inventory snapshot file')
+arg_parser.add_argument('--groups', nargs='+', default=[models.DEFAULT_GROUP_ID], metavar='GROUP_ID',
+    help=f'Quartzy groups whose inventories are fetched and reported together (default: {models.DEFAULT_GROUP_ID})')
+arg_parser.add_argument('--store', type=Path, metavar='PATH',
+    help='Local inventory database: reports also write the plasmids to it, and `query` (which requires it) reads it')
+arg_parser.add_argument('--lint-cache', type=Path, nargs='?', const=lint_cache.DEFAULT_LINT_CACHE,
+    help=f'Reuse lint results of plasmids whose Quartzy item is unchanged from an on-disk cache (default path: {lint_cache.DEFAULT_LINT_CACHE})')
+arg_parser.add_argument('--attachments', type=Path, nargs='?', const=attachments.DEFAULT_ATTACHMENT_CACHE,
+    help=f'Also lint plasmids against their cached plasmid maps, downloading new ones unless --offline (default cache: {attachments.DEFAULT_ATTACHMENT_CACHE})')
+arg_parser.add_argument('--metrics', type=Path, help='Write run metrics as JSON to this file and print a summary')
+arg_parser.add_argument('--prometheus', type=Path, help='Also write run metrics in Prometheus text format to this file')
+arg_parser.add_argument('--profile', type=Path, help='Run under cProfile and dump the stats to this file')
+
+subparsers = arg_parser.add_subparsers(dest='command', metavar='{query}')
+query_parser = subparsers.add_parser('query', help='Select plasmids from the local inventory store',
+    description='Lists the plasmids in the local inventory store that match all given filters. The store is '
+        'rebuilt from the snapshot first if the snapshot changed since it was written.')
+query_parser.add_argument('--pkg', type=int, nargs='+', help='pKG number(s)')
+query_parser.add_argument('--group', help='Quartzy group ID')
+query_parser.add_argument('--vendor', help='Vendor, e.g. Addgene')
+query_parser.add_argument('--catalog', help='Vendor catalog number')
+query_parser.add_argument('--owner', help='Owner full name or user ID')
+query_parser.add_argument('--resistance', action='append', help='Resistance marker, e.g. Kanamycin (repeat to require several)')
+query_parser.add_argument('--type', action='append', help='Plasmid type, e.g. Gateway::Entry (repeat to require several)')
+query_parser.add_argument('--name', help='Text contained in the plasmid name')
+query_parser.add_argument('--lint', help='Error or warning category, e.g. "Missing plasmid map"')
+query_parser.add_argument('--with-errors', action='store_true', help='Only plasmids with errors')
+query_parser.add_argument('--with-warnings', action='store_true', help='Only plasmids with warnings')
+query_parser.add_argument('--limit', type=int, help='Show at most this many plasmids')
+query_parser.add_argument('--count', action='store_true', help='Only print the number of matching plasmids')
+query_parser.add_argument('--show-lint', action='store_true', help='Also print the errors and warnings of each plasmid')
+
+def main() -> None:
+    args = arg_parser.parse_args()
+    if args.command == 'query' and args.store is None:
+        arg_parser.error('query needs the inventory store: --store PATH')
+    with contextlib.ExitStack() as stack:
+        out = stack.enter_context(args.output.open('w', encoding='utf-8', newline='')) if args.output is not None else sys.stdout
+        if args.command != 'query' and args.format != 'text' and args.output is None:
+            # Keep stdout machine-readable: progress messages go to stderr
+            stack.enter_context(contextlib.redirect_stdout(sys.stderr))
+        with metrics.profiled(args.profile):
+            if args.command == 'query':
+                query(args)
+            else:
+                report(args, out)
+
+        if args.metrics is not None:
+            metrics.METRICS.write_json(args.metrics)
+            print(f'run metrics ({args.metrics}):\n{metrics.METRICS.summary()}')
+        if args.prometheus is not None:
+            metrics.METRICS.write_prometheus(args.prometheus)
+
+if __name__ == '__main__':
+    main()
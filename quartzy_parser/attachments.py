@@ -0,0 +1,231 @@
+'''
+Content-addressed local cache of plasmid-map attachments.
+
+Downloads are streamed to objects/<2 hex digits>/<sha256>, and index.json maps
+each Quartzy attachment ID to the hash of its content. Replacing a file on
+Quartzy creates a new attachment, so attachments already in the index are
+never downloaded again, and identical files are stored once. Once filled,
+the cache alone is enough to lint offline.
+
+Only the feature tables of GenBank and SnapGene files are read, from a
+memory map of the file so sequence data is never loaded. The parsed features
+are stored next to the object as <sha256>.features.json, so each distinct
+file is parsed once.
+'''
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+import hashlib
+import json
+import mmap
+import os
+import struct
+import xml.etree.ElementTree as ET
+
+from requests import RequestException
+
+from .client import QuartzyClient
+from .metrics import METRICS
+from .snapshot import Snapshot
+
+DEFAULT_ATTACHMENT_CACHE = Path.home() / '.cache' / 'quartzy_parser' / 'attachments'
+GENBANK_EXTENSIONS = frozenset(['.gb', '.gbk', '.genbank', '.ape'])
+SNAPGENE_EXTENSIONS = frozenset(['.dna'])
+CHUNK_SIZE = 1 << 16
+# SnapGene files are a sequence of (type byte, big-endian length, payload) packets
+SNAPGENE_FEATURES_PACKET = 10
+
+class Feature(NamedTuple):
+    '''An annotated feature of a plasmid map: its type (e.g. CDS) and label.'''
+    type: str
+    label: str
+
+class PlasmidMaps(NamedTuple):
+    '''A plasmid with cached map files: the Plasmid fields the sequence lints use, and (file name, sha256) per map.'''
+    filename: str
+    resistances: List[str]
+    plasmid_type: List[str]
+    maps: List[Tuple[str,str]]
+
+def is_map(file_name: str) -> bool:
+    suffix = os.path.splitext(file_name)[1].lower()
+    return suffix in GENBANK_EXTENSIONS or suffix in SNAPGENE_EXTENSIONS
+
+class AttachmentStore:
+    '''The on-disk attachment cache. Index updates are thread-safe; save() writes the index.'''
+    def __init__(self, root: Path):
+        root.mkdir(parents=True, exist_ok=True)
+        self.root = root
+        self._lock = Lock()
+        try:
+            with (root / 'index.json').open(encoding='utf-8') as index_file:
+                self.index: Dict[str,str] = json.load(index_file)
+        except FileNotFoundError:
+            self.index = {}
+
+    def object_path(self, digest: str) -> Path:
+        return object_path(self.root, digest)
+
+    def digest(self, attachment_id: str) -> Optional[str]:
+        '''The content hash of a cached attachment, or None if it is not cached.'''
+        return self.index.get(attachment_id)
+
+    def download(self, client: QuartzyClient, attachment_id: str, url: str) -> str:
+        '''
+        Streams an attachment from its download URL into the cache, hashing it
+        on the way. Returns its sha256. The token is only sent if the URL is on
+        the API host.
+        '''
+        tmp_path = self.root / f'.{attachment_id}.{os.getpid()}.tmp'
+        digest = hashlib.sha256()
+        get = client.get_external if client.is_external(url) else client.get
+        with METRICS.span('attachments.download'):
+            try:
+                with get(url, stream=True) as response:
+                    response.raise_for_status()
+                    with tmp_path.open('wb') as tmp_file:
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            digest.update(chunk)
+                            tmp_file.write(chunk)
+            except BaseException:
+                tmp_path.unlink(missing_ok=True)
+                raise
+        hexdigest = digest.hexdigest()
+        path = self.object_path(hexdigest)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.index[attachment_id] = hexdigest
+        return hexdigest
+
+    def save(self) -> None:
+        tmp_path = self.root / 'index.json.tmp'
+        with self._lock, tmp_path.open('w', encoding='utf-8') as index_file:
+            json.dump(self.index, index_file)
+        os.replace(tmp_path, self.root / 'index.json')
+
+def sync_attachments(snapshot: Snapshot, store: AttachmentStore, client: Optional[QuartzyClient]=None,
+        max_workers: int=1) -> List[PlasmidMaps]:
+    '''
+    Brings the cache up to date with the map attachments in snapshot,
+    downloading those not cached yet with max_workers parallel requests from
+    the download URL Quartzy listed for them. Without a client (offline),
+    uncached maps are skipped, as are maps listed without a URL. A failed
+    download is reported and skipped; the maps downloaded so far are kept.
+
+    Returns the plasmids that have at least one cached map.
+    '''
+    items = list(snapshot.iter_attachments())
+    missing = {attachment[0]: attachment for _, attachments in items
+        for attachment in attachments if is_map(attachment[1]) and store.digest(attachment[0]) is None}
+    if client is not None and missing:
+        urls = {attachment_id: attachment[2] for attachment_id, attachment in missing.items()
+            if len(attachment) > 2 and attachment[2]}
+        for attachment_id, attachment in missing.items():
+            if attachment_id not in urls:
+                print(f'warning: attachment {attachment_id} ({attachment[1]}) has no download URL, skipping it')
+
+        def download(attachment_id: str) -> bool:
+            try:
+                store.download(client, attachment_id, urls[attachment_id])
+                return True
+            except (RequestException, OSError) as e:
+                print(f'warning: could not download attachment {attachment_id} ({missing[attachment_id][1]}): {e}')
+                return False
+
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                downloaded = sum(pool.map(download, urls))
+        finally:
+            store.save()
+        METRICS.add('attachments.downloaded', downloaded)
+        METRICS.add('attachments.failed', len(urls) - downloaded)
+        METRICS.add('attachments.no_url', len(missing) - len(urls))
+    else:
+        METRICS.add('attachments.missing', len(missing))
+
+    result: List[PlasmidMaps] = []
+    for fields, attachments in items:
+        maps = [(attachment[1], store.digest(attachment[0])) for attachment in attachments
+            if is_map(attachment[1]) and store.digest(attachment[0]) is not None]
+        if maps:
+            result.append(PlasmidMaps(fields['filename'], fields['resistances'], fields['plasmid_type'], maps))
+    return result
+
+def object_path(root: Path, digest: str) -> Path:
+    return root / 'objects' / digest[:2] / digest
+
+def map_features(root: Path, digest: str, file_name: str) -> List[Feature]:
+    '''
+    Features of the cached map with the given hash, parsed on first use and
+    memoized next to it. Takes the cache root rather than an AttachmentStore
+    so it can run in worker processes.
+    '''
+    path = object_path(root, digest)
+    parsed_path = path.with_name(f'{digest}.features.json')
+    try:
+        with parsed_path.open(encoding='utf-8') as parsed_file:
+            return [Feature(*entry) for entry in json.load(parsed_file)]
+    except FileNotFoundError:
+        pass
+    features = parse_features(path, file_name)
+    tmp_path = parsed_path.with_name(f'.{parsed_path.name}.{os.getpid()}.tmp')
+    with tmp_path.open('w', encoding='utf-8') as parsed_file:
+        json.dump(features, parsed_file)
+    os.replace(tmp_path, parsed_path)
+    return features
+
+def parse_features(path: Path, file_name: str) -> List[Feature]:
+    '''Reads the feature table of a GenBank or SnapGene file. Unreadable files have no features.'''
+    with path.open('rb') as map_file:
+        if os.fstat(map_file.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(map_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            try:
+                if os.path.splitext(file_name)[1].lower() in SNAPGENE_EXTENSIONS:
+                    return list(_snapgene_features(data))
+                return list(_genbank_features(data))
+            except (ValueError, struct.error, ET.ParseError):
+                return []
+
+def _genbank_features(data: mmap.mmap) -> Iterator[Feature]:
+    '''Features between the FEATURES header and ORIGIN (where the sequence starts).'''
+    start = data.find(b'\nFEATURES')
+    if start < 0:
+        return
+    end = data.find(b'\nORIGIN', start)
+    if end < 0:
+        end = data.find(b'\n//', start)
+    table = data[start:end if end >= 0 else len(data)].decode('utf-8', 'replace')
+
+    feature_type: Optional[str] = None
+    qualifiers: Dict[str,str] = {}
+    for line in table.splitlines()[1:]:
+        if line[:5] == ' ' * 5 and line[5:6].strip():
+            if feature_type is not None:
+                yield Feature(feature_type, _genbank_label(qualifiers))
+            feature_type, qualifiers = line[5:21].strip(), {}
+        elif line[:21].strip() == '' and line[21:22] == '/':
+            name, _, value = line[22:].partition('=')
+            qualifiers.setdefault(name, value.strip().strip('"'))
+    if feature_type is not None:
+        yield Feature(feature_type, _genbank_label(qualifiers))
+
+def _genbank_label(qualifiers: Dict[str,str]) -> str:
+    for name in ('label', 'gene', 'product', 'note'):
+        if qualifiers.get(name):
+            return qualifiers[name]
+    return ''
+
+def _snapgene_features(data: mmap.mmap) -> Iterator[Feature]:
+    '''Features of the XML features packet; the sequence packet is skipped over.'''
+    offset = 0
+    while offset + 5 <= len(data):
+        packet_type, length = struct.unpack_from('>BI', data, offset)
+        offset += 5
+        if packet_type == SNAPGENE_FEATURES_PACKET:
+            for feature in ET.fromstring(data[offset:offset + length]).iter('Feature'):
+                yield Feature(feature.get('type', ''), feature.get('name', ''))
+            return
+        offset += length
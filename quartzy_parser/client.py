@@ -0,0 +1,217 @@
+from typing import Optional, Dict, Any
+from pathlib import Path
+from requests import Session, Response, RequestException
+from requests.adapters import HTTPAdapter
+from urllib.parse import unquote, quote, urlparse
+from gazpacho.soup import Soup
+from threading import Lock
+import json
+import os
+import time
+
+from .metrics import METRICS
+from .ratelimit import RateLimiter, RETRY_STATUSES, parse_retry_after, backoff_delay
+
+DEFAULT_TOKEN_CACHE = Path.home() / '.cache' / 'quartzy_parser' / 'tokens.json'
+# Refresh tokens this many seconds before they actually expire
+TOKEN_EXPIRY_MARGIN = 60
+
+class QuartzyClient:
+    '''
+    Authenticated Quartzy API session that can be shared across calls.
+
+    Connections are pooled and kept alive. The client ID scraped from the
+    login page and the OAuth access token are cached on disk (see
+    token_cache; None disables the cache) until the token expires, so repeated
+    runs do not need to log in again. A 401 response triggers one transparent
+    re-login and retry. URLs on other hosts (such as presigned storage links
+    of attachments) are fetched with get_external(), without the token.
+
+    Every request goes through a shared adaptive RateLimiter. Throttled (429)
+    and server-error responses, as well as connection errors, are retried up
+    to max_retries times with jittered exponential backoff, honoring any
+    Retry-After header; after that the HTTP error is raised.
+    '''
+    def __init__(self, username: str, password: str,
+            token_cache: Optional[Path]=DEFAULT_TOKEN_CACHE,
+            app_url: str='https://app.quartzy.com',
+            api_url: str='https://io.quartzy.com',
+            pool_size: int=16,
+            rate_limiter: Optional[RateLimiter]=None,
+            max_retries: int=5):
+        self.username = username
+        self.password = password
+        self.token_cache = token_cache
+        self.app_url = app_url.rstrip('/')
+        self.api_url = api_url.rstrip('/')
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.max_retries = max_retries
+        self.session = Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:96.0) Gecko/20100101 Firefox/96.0',
+            'Origin': self.app_url,
+            'Referer': self.app_url + '/'
+        })
+        self._lock = Lock()
+        self._token: Optional[Dict[str,Any]] = None
+        self._load_cached_token()
+
+    def __enter__(self) -> 'QuartzyClient':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.session.close()
+
+    def _cache_key(self) -> str:
+        return f'{self.api_url} {self.username}'
+
+    def _read_cache(self) -> Dict[str,Any]:
+        if self.token_cache is None or not self.token_cache.is_file():
+            return {}
+        try:
+            with self.token_cache.open() as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _load_cached_token(self) -> None:
+        token = self._read_cache().get(self._cache_key())
+        if token is not None:
+            self._token = token
+            if self._token_expired():
+                # The client ID is still good, only the token is stale
+                self._token = {'client_id': token['client_id']}
+
+    def _store_token(self) -> None:
+        if self.token_cache is None:
+            return
+        cache = self._read_cache()
+        # Drop expired entries while we are rewriting the file anyway
+        cache = {k: v for k, v in cache.items() if v['expires_at'] is None or v['expires_at'] > time.time()}
+        cache[self._cache_key()] = self._token
+        self.token_cache.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.token_cache.with_suffix('.tmp')
+        with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as cache_file:
+            json.dump(cache, cache_file)
+        os.replace(tmp_path, self.token_cache)
+
+    def _send(self, method: str, url: str, **kwargs) -> Response:
+        '''Sends a rate-limited request, retrying transient failures.'''
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except RequestException:
+                METRICS.add('http_errors')
+                if attempt >= self.max_retries:
+                    raise
+                METRICS.add('http_retries')
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+            METRICS.add('http_requests')
+            # Streamed bodies are left unread; their size is taken from the headers
+            METRICS.add('http_bytes', int(response.headers.get('Content-Length', 0)) if kwargs.get('stream')
+                else len(response.content))
+            METRICS.observe('http_latency_seconds', time.perf_counter() - start)
+            if response.status_code not in RETRY_STATUSES:
+                self.rate_limiter.on_success()
+                return response
+            if attempt >= self.max_retries:
+                response.raise_for_status()
+            METRICS.add('http_retries')
+            response.close()
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if response.status_code == 429:
+                METRICS.add('http_throttled')
+                self.rate_limiter.on_throttle(retry_after)
+            time.sleep(retry_after if retry_after is not None else backoff_delay(attempt))
+            attempt += 1
+
+    def _client_id(self) -> str:
+        '''Returns the OAuth client ID, scraping the login page if it is not cached.'''
+        if self._token is not None and 'client_id' in self._token:
+            return self._token['client_id']
+        # Request the login page to get the client ID.
+        login_page_env = Soup(self._send('GET', f'{self.app_url}/login').text).find('meta', {'name': 'frontend/config/environment'}, mode='first')
+        if type(login_page_env) is not Soup or login_page_env.attrs is None:
+            raise RuntimeError("Couldn't load Quartzy environment!")
+        login_env = json.loads(unquote(login_page_env.attrs['content']))
+        return login_env['api']['clientId']
+
+    def login(self) -> None:
+        '''Requests a fresh access token and stores it in the token cache.'''
+        with METRICS.span('login'):
+            client_id = self._client_id()
+            token_response = self._send('POST', f'{self.api_url}/oauth/tokens',
+                data=f'grant_type=password&client_id={client_id}&username={quote(self.username)}&password={self.password.replace(" ", "%20")}',
+                headers={'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8'})
+        # Throttling and server errors were retried by _send; what is left (e.g. bad credentials) is raised here
+        token_response.raise_for_status()
+        response = token_response.json()
+        if 'access_token' not in response:
+            raise RuntimeError(f"Couldn't log in to Quartzy: {response}")
+        expires_in = response.get('expires_in')
+        self._token = {
+            'client_id': client_id,
+            'token_type': response['token_type'],
+            'access_token': response['access_token'],
+            'expires_at': time.time() + int(expires_in) - TOKEN_EXPIRY_MARGIN if expires_in is not None else None
+        }
+        self._store_token()
+
+    def _auth_header(self, stale: Optional[str]=None) -> str:
+        '''
+        Returns the current Authorization header, logging in if needed.
+
+        If stale is given and still current, it has been rejected by the server
+        and a new token is requested.
+        '''
+        with self._lock:
+            current = self._token_header()
+            if current is None or current == stale or self._token_expired():
+                self.login()
+            return self._token_header()
+
+    def _token_expired(self) -> bool:
+        expires_at = self._token.get('expires_at') if self._token is not None else None
+        return expires_at is not None and expires_at <= time.time()
+
+    def _token_header(self) -> Optional[str]:
+        if self._token is None or 'access_token' not in self._token:
+            return None
+        return f"{self._token['token_type']} {self._token['access_token']}"
+
+    def url(self, path: str) -> str:
+        '''Expands an API path (e.g. `/users`) to a full URL.'''
+        return path if path.startswith('http') else self.api_url + path
+
+    def is_external(self, path: str) -> bool:
+        '''True if path is an absolute URL on a host other than the API's.'''
+        return path.startswith('http') and urlparse(path).netloc != urlparse(self.api_url).netloc
+
+    def get(self, path: str, headers: Optional[Dict[str,str]]=None, **kwargs) -> Response:
+        '''Sends an authenticated GET request to the Quartzy API.'''
+        headers = dict(headers) if headers is not None else {}
+        auth_header = self._auth_header()
+        response = self._send('GET', self.url(path), headers={**headers, 'Authorization': auth_header}, **kwargs)
+        if response.status_code == 401:
+            auth_header = self._auth_header(stale=auth_header)
+            response = self._send('GET', self.url(path), headers={**headers, 'Authorization': auth_header}, **kwargs)
+        return response
+
+    def get_external(self, url: str, headers: Optional[Dict[str,str]]=None, **kwargs) -> Response:
+        '''
+        Sends an unauthenticated GET request to a URL outside the API, e.g. a
+        presigned download link, so the access token never leaves Quartzy.
+        It is still rate-limited and retried like any other request.
+        '''
+        return self._send('GET', url, headers=headers, **kwargs)
@@ -0,0 +1,69 @@
+from typing import List, Optional, Dict, Tuple, Any
+from pathlib import Path
+import json
+import os
+
+from .metrics import METRICS
+
+DEFAULT_LINT_CACHE = Path.home() / '.cache' / 'quartzy_parser' / 'lint.json'
+
+LintResult = Tuple[List[Tuple[str,str]], List[Tuple[str,str]]]
+
+class LintCache:
+    '''
+    On-disk memo of per-plasmid lint results in JSON, one entry per Quartzy
+    item with the updated_at timestamp of the item version it was linted
+    from (see Plasmid._revision).
+
+    Quartzy bumps updated_at whenever an item or its attachments change, so
+    a lookup is one dict access and a string comparison rather than a hash
+    of the plasmid. The whole cache is dropped when the rule set changes
+    (see linter.ruleset_fingerprint), and each item keeps only its latest
+    result, so the file never outgrows the inventory.
+    '''
+    def __init__(self, path: Path, ruleset: str):
+        self.path = path
+        self.ruleset = ruleset
+        self.hits = 0
+        self.misses = 0
+        # Item ID -> [updated_at, errors, warnings]
+        self.items: Dict[str,List[Any]] = {}
+        try:
+            with path.open(encoding='utf-8') as cache_file:
+                data = json.load(cache_file)
+            if data.get('ruleset') == ruleset:
+                self.items = data['items']
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+    def __enter__(self) -> 'LintCache':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.save()
+
+    def get(self, revision: Tuple[str,str]) -> Optional[LintResult]:
+        '''The cached results of the given (item ID, updated_at), if any.'''
+        entry = self.items.get(revision[0])
+        if entry is None or entry[0] != revision[1]:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [tuple(error) for error in entry[1]], [tuple(warning) for warning in entry[2]] # type: ignore
+
+    def put(self, revision: Tuple[str,str], errors: List[Tuple[str,str]], warnings: List[Tuple[str,str]]) -> None:
+        self.items[revision[0]] = [revision[1], errors, warnings]
+
+    def save(self) -> None:
+        '''Atomically writes the cache back to its path and adds the hit counts to METRICS.'''
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with tmp_path.open('w', encoding='utf-8') as cache_file:
+            json.dump({'ruleset': self.ruleset, 'items': self.items}, cache_file)
+        os.replace(tmp_path, self.path)
+        METRICS.add('lint_cache_hits', self.hits)
+        METRICS.add('lint_cache_misses', self.misses)
+
+    def report(self) -> str:
+        total = self.hits + self.misses
+        return f'lint cache: {self.hits} hits, {self.misses} misses ({self.hits / max(total, 1):.0%} hit rate)'
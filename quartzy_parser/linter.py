@@ -1,11 +1,69 @@
+import hashlib
+import inspect
 import re
-from typing import List, Optional
+import functools
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, List, Optional, Dict, Tuple, Callable, NamedTuple
+from .attachments import Feature, PlasmidMaps, map_features
+from .lint_cache import LintCache
+from .metrics import METRICS
 from .models import Plasmid
 
+ERROR = 'error'
+WARNING = 'warning'
+
+class LintRule(NamedTuple):
+    '''A registered single-plasmid lint check.'''
+    name: str
+    category: str
+    severity: str
+    check: Callable[[Plasmid], Optional[str]]
+
+# Registered rules, in the order they are applied
+RULES: List[LintRule] = []
+
+def lint_rule(category: str, severity: str) -> Callable[[Callable[[Plasmid], Optional[str]]], Callable[[Plasmid], Optional[str]]]:
+    '''
+    Registers a lint check. The check returns a message if the plasmid fails,
+    which is recorded under category in the plasmid's errors or warnings.
+    '''
+    def register(check: Callable[[Plasmid], Optional[str]]) -> Callable[[Plasmid], Optional[str]]:
+        RULES.append(LintRule(check.__name__, category, severity, check))
+        return check
+    return register
+
+class LintStats:
+    '''Per-rule call counts and cumulative run time.'''
+    def __init__(self):
+        self.calls: Dict[str,int] = {}
+        self.seconds: Dict[str,float] = {}
+
+    def record(self, rule: str, calls: int, seconds: float) -> None:
+        self.calls[rule] = self.calls.get(rule, 0) + calls
+        self.seconds[rule] = self.seconds.get(rule, 0.0) + seconds
+
+    def merge(self, other: 'LintStats') -> None:
+        for rule in other.calls:
+            self.record(rule, other.calls[rule], other.seconds[rule])
+
+    def report(self) -> str:
+        lines = [f'{"rule":<32} {"calls":>8} {"total ms":>10} {"us/call":>8}']
+        for rule in sorted(self.calls, key=lambda r: -self.seconds[r]):
+            calls, seconds = self.calls[rule], self.seconds[rule]
+            lines.append(f'{rule:<32} {calls:>8} {seconds * 1e3:>10.2f} {seconds * 1e6 / max(calls, 1):>8.2f}')
+        return '\n'.join(lines)
+
+PKG_ITEM_NAME = re.compile(r'^pKG(?P<pKG>\d+)$')
+ADDGENE_CATALOG_NUMBER = re.compile(r'^\d+$')
+INVALID_RESISTANCES = frozenset(['AMP', 'Kanamycin/chlor', 'Ampicillin /Chloramphenicol', 'KanamycinR', 'Chloramphenicol&Amp', 'Chloramphenicol/Ampicillin', 'Kan', 'Amp'])
+
+@lint_rule('Inconsistent pKG numbers', ERROR)
 def lint_pKG_number(plasmid: Plasmid) -> Optional[str]:
     '''Checks if the item-name pKG number matches the pKG metadata entry.'''
     # Try to extract pKG number
-    match = re.match(r'^pKG(?P<pKG>\d+)$', plasmid.q_item_name)
+    match = PKG_ITEM_NAME.match(plasmid.q_item_name)
     if match is not None:
         item_name_pKG = int(match['pKG'])
         if item_name_pKG != plasmid.pKG:
@@ -13,11 +71,12 @@ def lint_pKG_number(plasmid: Plasmid) -> Optional[str]:
                 f' Item name: pKG{item_name_pKG}, metadata pKG: pKG{plasmid.pKG}')
     return None
 
+@lint_rule('Suspicious Addgene catalog number', ERROR)
 def lint_addgene_alt_names(plasmid: Plasmid) -> Optional[str]:
     '''Checks to see if the Addgene item name is properly set.'''
     if plasmid.vendor is None or plasmid.vendor != 'Addgene':
         return None
-    if re.match(r'^\d+$', plasmid.alt_name) is None:
+    if ADDGENE_CATALOG_NUMBER.match(plasmid.alt_name) is None:
         return f'Plasmid has the Vendor field set to Addgene, but has a suspicious catalog number: {plasmid.alt_name}. The catalog number should just be the Addgene number!'
     return None
 
@@ -29,12 +88,14 @@ def lint_addgene_map(plasmid: Plasmid) -> Optional[str]:
         return f'Addgene plasmid is missing a plasmid map! Please add a sequence downloaded from the entry on Addgene.'
     return None
 
+@lint_rule('Empty plasmid name', WARNING)
 def lint_plasmid_name(plasmid: Plasmid) -> Optional[str]:
     '''Checks to make sure the plasmid name is non-empty'''
     if len(plasmid.name) == 0:
         return f'Plasmid has an empty plasmid name field!'
     return None
 
+@lint_rule('Missing plasmid map', WARNING)
 def lint_attachments(plasmid: Plasmid) -> Optional[str]:
     '''Checks if there is at least one attachment'''
     if len(plasmid.attachment_filenames) > 0 or 'no_map' in plasmid.technical_details:
@@ -42,11 +103,11 @@ def lint_attachments(plasmid: Plasmid) -> Optional[str]:
     return (f"Plasmid is missing a plasmid-map attachment! If this is intended, add `no_map` to Technical Details")
 
 # Lint antibiotic resistances
+@lint_rule('Deprecated antibiotic resistance', WARNING)
 def lint_antibiotic(plasmid: Plasmid) -> Optional[str]:
     '''Checks to see that we aren't specifying combination antibiotics or short names'''
-    invalid_resistances = ['AMP', 'Kanamycin/chlor', 'Ampicillin /Chloramphenicol', 'KanamycinR', 'Chloramphenicol&Amp', 'Chloramphenicol/Ampicillin', 'Kan', 'Amp']
     for resistance in plasmid.resistances:
-        if resistance in invalid_resistances:
+        if resistance in INVALID_RESISTANCES:
             return(f"Plasmid has an invalid (shortened or dual-resistance) antibiotic resistance entry: {resistance}")
 
 def lint_antibiotics_match_type(plasmid: Plasmid) -> Optional[str]:
@@ -61,26 +122,321 @@ def lint_antibiotics_match_type(plasmid: Plasmid) -> Optional[str]:
     - Golden Gate::Harbor - Amp/Chlor
     - Viral (not Helper) - Amp
 
+    Not registered yet; decorate with lint_rule once implemented.
+    '''
+
+def ruleset_fingerprint() -> str:
+    '''
+    Hash of the registered rules: their names, categories, severities and
+    source, plus the module-level constants they reference. Changes whenever
+    a rule is added, removed or edited.
+    '''
+    digest = hashlib.sha256()
+    for rule in RULES:
+        digest.update(f'{rule.name}|{rule.category}|{rule.severity}|'.encode('utf-8'))
+        try:
+            digest.update(inspect.getsource(rule.check).encode('utf-8'))
+        except OSError:
+            digest.update(rule.check.__code__.co_code)
+        for name in rule.check.__code__.co_names:
+            value = rule.check.__globals__.get(name)
+            if isinstance(value, (frozenset, set)):
+                digest.update(repr(sorted(value)).encode('utf-8'))
+            elif isinstance(value, (str, int, float, tuple, re.Pattern)):
+                digest.update(repr(value).encode('utf-8'))
+    return digest.hexdigest()
+
+def _apply_rules(plasmid: Plasmid, rules: List[LintRule], stats: Optional[LintStats]) -> None:
+    for rule in rules:
+        start = time.perf_counter()
+        message = rule.check(plasmid)
+        if stats is not None:
+            stats.record(rule.name, 1, time.perf_counter() - start)
+        if message:
+            (plasmid.errors if rule.severity == ERROR else plasmid.warnings).append((rule.category, message))
+
+def lint_plasmid(plasmid: Plasmid, stats: Optional[LintStats]=None, cache: Optional[LintCache]=None) -> None:
+    '''
+    Checks a single plasmid for consistency, appending lint results to its
+    errors and warnings in place. With a cache, the results of plasmids whose
+    Quartzy item is unchanged are reused instead of rerunning the rules.
     '''
+    revision = plasmid._revision if cache is not None else None
+    if revision is None:
+        _apply_rules(plasmid, RULES, stats)
+        return
+    cached = cache.get(revision)
+    if cached is not None:
+        plasmid.errors.extend(cached[0])
+        plasmid.warnings.extend(cached[1])
+        return
+    n_errors, n_warnings = len(plasmid.errors), len(plasmid.warnings)
+    _apply_rules(plasmid, RULES, stats)
+    cache.put(revision, plasmid.errors[n_errors:], plasmid.warnings[n_warnings:])
 
-def lint_plasmids(plasmids:List[Plasmid]) -> None:
+def _lint_chunk(plasmids: List[Plasmid]) -> Tuple[List[Tuple[List[Tuple[str,str]],List[Tuple[str,str]]]], LintStats]:
+    '''Process-pool worker: lints a chunk of plasmids and returns their results.'''
+    stats = LintStats()
+    for plasmid in plasmids:
+        _apply_rules(plasmid, RULES, stats)
+    return [(plasmid.errors, plasmid.warnings) for plasmid in plasmids], stats
+
+def lint_plasmids(plasmids:List[Plasmid], stats: Optional[LintStats]=None,
+        processes: Optional[int]=None, chunk_size: int=2000, cache: Optional[LintCache]=None) -> None:
     '''
     Checks plasmids for consistency. Updates the plasmid list in place with
     lint results.
+
+    All registered rules run over the batch in one pass. If processes is
+    given and the batch is larger than chunk_size, it is split into chunks
+    that are linted in a process pool. With a cache, only plasmids without
+    cached results are linted. The cross-record checks then run over the
+    whole batch.
+    '''
+    with METRICS.span('lint'):
+        if cache is None:
+            _lint_batch(plasmids, stats, processes, chunk_size)
+        else:
+            misses: List[Tuple[Plasmid,int,int]] = []
+            for plasmid in plasmids:
+                cached = cache.get(plasmid._revision) if plasmid._revision is not None else None
+                if cached is not None:
+                    plasmid.errors.extend(cached[0])
+                    plasmid.warnings.extend(cached[1])
+                else:
+                    misses.append((plasmid, len(plasmid.errors), len(plasmid.warnings)))
+            _lint_batch([plasmid for plasmid, _, _ in misses], stats, processes, chunk_size)
+            for plasmid, n_errors, n_warnings in misses:
+                if plasmid._revision is not None:
+                    cache.put(plasmid._revision, plasmid.errors[n_errors:], plasmid.warnings[n_warnings:])
+        lint_cross_record(plasmids, stats)
+
+def _lint_batch(plasmids:List[Plasmid], stats: Optional[LintStats], processes: Optional[int], chunk_size: int) -> None:
+    if processes is None or processes <= 1 or len(plasmids) <= chunk_size:
+        for plasmid in plasmids:
+            _apply_rules(plasmid, RULES, stats)
+        return
+    chunks = [plasmids[i:i + chunk_size] for i in range(0, len(plasmids), chunk_size)]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for chunk, (results, chunk_stats) in zip(chunks, pool.map(_lint_chunk, chunks)):
+            for plasmid, (errors, warnings) in zip(chunk, results):
+                plasmid.errors = errors
+                plasmid.warnings = warnings
+            if stats is not None:
+                stats.merge(chunk_stats)
+
+# Cross-record lint: checks that compare plasmids with each other. They need
+# the whole inventory, so they run after the per-plasmid rules.
+DUPLICATE_PKG = 'Duplicate pKG number'
+DUPLICATE_ADDGENE = 'Duplicate Addgene catalog number'
+CONFLICTING_NAME = 'Conflicting plasmids with the same name'
+# Fields that must agree between plasmids with the same name
+NAME_METADATA_FIELDS = ['species', 'resistances', 'plasmid_type']
+# Other plasmids listed in a cross-record message before it is truncated
+MAX_LISTED = 10
+
+# Plasmid filename -> (errors, warnings) found by a whole-inventory check
+Findings = Dict[str,Tuple[List[Tuple[str,str]],List[Tuple[str,str]]]]
+
+def _others(entries: List[Tuple[Any,...]], filename: str) -> str:
+    '''
+    Lists the pKG numbers of the other entries of a group. Only the first few
+    are looked at, so large groups don't take quadratic time.
+    '''
+    listed = [f'pKG{entry[1]}' for entry in entries[:MAX_LISTED + 1] if entry[0] != filename][:MAX_LISTED]
+    n_more = len(entries) - 1 - len(listed)
+    return ', '.join(listed) + (f' and {n_more} more' if n_more > 0 else '')
+
+class CrossRecordIndex:
+    '''
+    Hash indexes over the fields the cross-record checks compare, built as
+    plasmids stream past. findings() then checks every group once, so the
+    whole pass is linear in the number of plasmids.
+
+    Each index maps a key to its first entry; a group list is only made once
+    a second plasmid with the same key turns up. Entries are flat tuples, so
+    a large inventory creates few objects for the garbage collector to scan.
+
+    Keys are scoped by Quartzy group: every group numbers and names its own
+    plasmids, so only repeats within one group are flagged.
     '''
+    def __init__(self):
+        # (group ID, pKG) -> (filename, pKG, item name)
+        self.by_pKG = _GroupIndex()
+        # (group ID, Addgene catalog number) -> (filename, pKG)
+        self.by_addgene = _GroupIndex()
+        # (group ID, plasmid name) -> (filename, pKG, metadata)
+        self.by_name = _GroupIndex()
+
+    def add(self, plasmid: Plasmid) -> bool:
+        '''Indexes a plasmid. Returns True if it shares a key with an earlier one.'''
+        repeated = self.by_pKG.add((plasmid.group_id, plasmid.pKG), (plasmid.filename, plasmid.pKG, plasmid.q_item_name))
+        if plasmid.vendor == 'Addgene' and plasmid.alt_name:
+            repeated |= self.by_addgene.add((plasmid.group_id, plasmid.alt_name), (plasmid.filename, plasmid.pKG))
+        if plasmid.name:
+            metadata = tuple(_comparable(getattr(plasmid, field)) for field in NAME_METADATA_FIELDS)
+            repeated |= self.by_name.add((plasmid.group_id, plasmid.name), (plasmid.filename, plasmid.pKG, metadata))
+        return repeated
+
+    def findings(self) -> Findings:
+        '''The errors and warnings of every plasmid a cross-record check flags.'''
+        results: Findings = {}
+        def flag(filename: str, severity: str, category: str, message: str) -> None:
+            errors, warnings = results.setdefault(filename, ([], []))
+            (errors if severity == ERROR else warnings).append((category, message))
+
+        for (_, pKG), items in self.by_pKG.groups.items():
+            item_names = ', '.join(item_name for _, _, item_name in items[:MAX_LISTED])
+            for filename, _, _ in items:
+                flag(filename, ERROR, DUPLICATE_PKG,
+                    f'pKG{pKG} is used by {len(items)} items ({item_names}). Every plasmid needs its own pKG number!')
+        for (_, catalog_number), entries in self.by_addgene.groups.items():
+            for filename, _ in entries:
+                flag(filename, WARNING, DUPLICATE_ADDGENE,
+                    f'Addgene catalog number {catalog_number} is also used by {_others(entries, filename)}.')
+        for (_, name), entries in self.by_name.groups.items():
+            if len({metadata for _, _, metadata in entries}) < 2:
+                continue
+            differing = [field for i, field in enumerate(NAME_METADATA_FIELDS)
+                if len({metadata[i] for _, _, metadata in entries}) > 1]
+            for filename, _, _ in entries:
+                flag(filename, WARNING, CONFLICTING_NAME,
+                    f'Plasmid name {name} is also used by {_others(entries, filename)}, but their {", ".join(differing)} differ.')
+        return results
+
+class _GroupIndex:
+    '''Key -> entries, keeping only the first entry until a key repeats.'''
+    def __init__(self):
+        self.first: Dict[Any,Tuple[Any,...]] = {}
+        # Keys seen more than once -> all their entries
+        self.groups: Dict[Any,List[Tuple[Any,...]]] = {}
+
+    def add(self, key: Any, entry: Tuple[Any,...]) -> bool:
+        first = self.first.setdefault(key, entry)
+        if first is entry:
+            return False
+        self.groups.setdefault(key, [first]).append(entry)
+        return True
+
+def _comparable(value: Any) -> Any:
+    # Lists are compared sorted so entry order doesn't count as a conflict
+    return tuple(sorted(value)) if isinstance(value, list) else value
+
+def merge_findings(*all_findings: Findings) -> Findings:
+    merged: Findings = {}
+    for findings in all_findings:
+        for filename, (errors, warnings) in findings.items():
+            merged_errors, merged_warnings = merged.setdefault(filename, ([], []))
+            merged_errors.extend(errors)
+            merged_warnings.extend(warnings)
+    return merged
+
+def apply_findings(plasmid: Any, findings: Findings) -> None:
+    '''Appends the cross-record findings for a plasmid (or plasmid summary) to its errors and warnings.'''
+    if plasmid.filename in findings:
+        errors, warnings = findings[plasmid.filename]
+        plasmid.errors.extend(errors)
+        plasmid.warnings.extend(warnings)
+
+def lint_cross_record(plasmids: List[Plasmid], stats: Optional[LintStats]=None) -> None:
+    '''Runs the cross-record checks over plasmids, appending the results in place.'''
+    start = time.perf_counter()
+    index = CrossRecordIndex()
+    for plasmid in plasmids:
+        index.add(plasmid)
+    findings = index.findings()
     for plasmid in plasmids:
-        pKG_lint = lint_pKG_number(plasmid)
-        if pKG_lint:
-            plasmid.errors.append(('Inconsistent pKG numbers', pKG_lint))
-        addgene_lint = lint_addgene_alt_names(plasmid)
-        if addgene_lint:
-            plasmid.errors.append(('Suspicious Addgene catalog number', addgene_lint))
-        name_lint = lint_plasmid_name(plasmid)
-        if name_lint:
-            plasmid.warnings.append(('Empty plasmid name', name_lint))
-        attachment_lint = lint_attachments(plasmid)
-        if attachment_lint:
-            plasmid.warnings.append(('Missing plasmid map', attachment_lint))
-        antibiotic_lint = lint_antibiotic(plasmid)
-        if antibiotic_lint:
-            plasmid.warnings.append(('Deprecated antibiotic resistance', antibiotic_lint))
+        apply_findings(plasmid, findings)
+    if stats is not None:
+        stats.record('cross_record', len(plasmids), time.perf_counter() - start)
+
+# Sequence lint: checks of a plasmid against the features annotated on its
+# map files, read from the attachment cache (see attachments.py).
+class SequenceRule(NamedTuple):
+    '''A registered check of a plasmid against the features of its maps.'''
+    name: str
+    category: str
+    severity: str
+    check: Callable[[PlasmidMaps, List[Feature]], Optional[str]]
+
+SEQUENCE_RULES: List[SequenceRule] = []
+
+def sequence_rule(category: str, severity: str) -> Callable[[Callable[[PlasmidMaps, List[Feature]], Optional[str]]], Callable[[PlasmidMaps, List[Feature]], Optional[str]]]:
+    '''Registers a sequence check, which returns a message if the plasmid fails (see lint_rule).'''
+    def register(check: Callable[[PlasmidMaps, List[Feature]], Optional[str]]) -> Callable[[PlasmidMaps, List[Feature]], Optional[str]]:
+        SEQUENCE_RULES.append(SequenceRule(check.__name__, category, severity, check))
+        return check
+    return register
+
+# Words in the feature labels of the genes that confer each resistance
+RESISTANCE_GENES = {
+    'Ampicillin': frozenset(['ampr', 'bla']),
+    'Carbenicillin': frozenset(['ampr', 'bla']),
+    'Kanamycin': frozenset(['kanr', 'neor', 'aph', 'nptii']),
+    'Chloramphenicol': frozenset(['cmr', 'camr', 'cat']),
+    'Spectinomycin': frozenset(['specr', 'smr', 'aada']),
+    'Streptomycin': frozenset(['strr', 'smr', 'aada']),
+    'Gentamicin': frozenset(['gmr', 'gentr', 'aacc1']),
+    'Tetracycline': frozenset(['tetr', 'teta']),
+    'Zeocin': frozenset(['bler', 'zeor', 'ble']),
+    'Hygromycin': frozenset(['hygr', 'hph']),
+    'Puromycin': frozenset(['puror', 'pac']),
+    'Blasticidin': frozenset(['bsr', 'bsd']),
+}
+# Feature types that annotate parts around a gene (e.g. "AmpR promoter") rather than the gene
+NON_GENE_FEATURES = frozenset(['promoter', 'terminator', 'primer_bind', 'RBS', 'rep_origin'])
+FEATURE_WORD = re.compile(r'[a-z0-9]+')
+
+@sequence_rule('Unannotated plasmid map', WARNING)
+def lint_map_annotated(plasmid: PlasmidMaps, features: List[Feature]) -> Optional[str]:
+    '''Checks that the maps have features to check the plasmid against.'''
+    if len(features) == 0:
+        return (f'The plasmid map ({", ".join(file_name for file_name, _ in plasmid.maps)}) has no annotated features'
+            ' (or could not be read), so it could not be checked.')
+    return None
+
+@sequence_rule('Resistance marker missing from map', WARNING)
+def lint_map_resistances(plasmid: PlasmidMaps, features: List[Feature]) -> Optional[str]:
+    '''Checks that every listed resistance has a matching gene annotated on the map.'''
+    if len(features) == 0:
+        return None
+    words = set()
+    for feature in features:
+        if feature.type not in NON_GENE_FEATURES:
+            words.update(FEATURE_WORD.findall(feature.label.lower()))
+    missing = [resistance for resistance in plasmid.resistances
+        if resistance in RESISTANCE_GENES and words.isdisjoint(RESISTANCE_GENES[resistance])]
+    if missing:
+        return f'Plasmid lists {", ".join(missing)} resistance, but no matching resistance gene is annotated on its map.'
+    return None
+
+def _lint_maps_chunk(cache_root: Path, plasmids: List[PlasmidMaps]) -> Findings:
+    '''Process-pool worker: parses (or loads) the maps of a chunk of plasmids and applies the sequence rules.'''
+    findings: Findings = {}
+    for plasmid in plasmids:
+        features = [feature for file_name, digest in plasmid.maps for feature in map_features(cache_root, digest, file_name)]
+        errors: List[Tuple[str,str]] = []
+        warnings: List[Tuple[str,str]] = []
+        for rule in SEQUENCE_RULES:
+            message = rule.check(plasmid, features)
+            if message:
+                (errors if rule.severity == ERROR else warnings).append((rule.category, message))
+        if errors or warnings:
+            findings[plasmid.filename] = (errors, warnings)
+    return findings
+
+def lint_sequences(plasmids: List[PlasmidMaps], cache_root: Path, processes: Optional[int]=None,
+        chunk_size: int=200) -> Findings:
+    '''
+    Runs the sequence rules over plasmids with cached maps (see
+    attachments.sync_attachments). Chunks of plasmids are linted in a process
+    pool of the given size (default: one worker per core), where maps not
+    parsed before are parsed; processes=1 lints in this process.
+    '''
+    with METRICS.span('lint.sequences'):
+        chunks = [plasmids[i:i + chunk_size] for i in range(0, len(plasmids), chunk_size)]
+        lint_chunk = functools.partial(_lint_maps_chunk, cache_root)
+        if processes == 1 or len(chunks) <= 1:
+            return merge_findings(*map(lint_chunk, chunks))
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            return merge_findings(*pool.map(lint_chunk, chunks))
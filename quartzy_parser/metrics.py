@@ -0,0 +1,170 @@
+from typing import Dict, List, Iterator, Iterable, TypeVar, Any, Optional
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+import bisect
+import cProfile
+import json
+import pstats
+import sys
+import time
+try:
+    import resource
+except ImportError: # Windows
+    resource = None # type: ignore
+
+T = TypeVar('T')
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf')]
+
+class Metrics:
+    '''
+    Thread-safe collection of timed spans, counters and histograms.
+
+    Spans with the same name accumulate call counts and total wall time, so
+    they can wrap per-item work as well as whole stages.
+    '''
+    def __init__(self):
+        self._lock = Lock()
+        self.span_calls: Dict[str,int] = {}
+        self.span_seconds: Dict[str,float] = {}
+        self.counters: Dict[str,float] = {}
+        self.histograms: Dict[str,List[int]] = {}
+        self.histogram_sums: Dict[str,float] = {}
+        self.started = time.time()
+
+    def reset(self) -> None:
+        self.__init__()
+
+    def record_span(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.span_calls[name] = self.span_calls.get(name, 0) + 1
+            self.span_seconds[name] = self.span_seconds.get(name, 0.0) + seconds
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        '''Times the enclosed block under name.'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_span(name, time.perf_counter() - start)
+
+    def timed_iter(self, name: str, items: Iterable[T]) -> Iterator[T]:
+        '''Yields from items, timing how long each item takes to produce.'''
+        iterator = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.record_span(name, time.perf_counter() - start)
+                return
+            self.record_span(name, time.perf_counter() - start)
+            yield item
+
+    def add(self, name: str, value: float=1) -> None:
+        '''Increments a counter.'''
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float) -> None:
+        '''Records a value in a histogram with LATENCY_BUCKETS.'''
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = [0] * len(LATENCY_BUCKETS)
+                self.histogram_sums[name] = 0.0
+            self.histograms[name][bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+            self.histogram_sums[name] += value
+
+    def to_dict(self) -> Dict[str,Any]:
+        with self._lock:
+            return {
+                'wall_seconds': time.time() - self.started,
+                'peak_rss_mb': peak_rss_mb(),
+                'spans': {name: {'calls': self.span_calls[name], 'seconds': self.span_seconds[name]}
+                    for name in self.span_calls},
+                'counters': dict(self.counters),
+                'histograms': {name: {
+                    'buckets': [[le if le != float('inf') else '+Inf', count] for le, count in zip(LATENCY_BUCKETS, counts)],
+                    'count': sum(counts),
+                    'sum': self.histogram_sums[name]}
+                    for name, counts in self.histograms.items()},
+            }
+
+    def write_json(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open('w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def write_prometheus(self, path: Path) -> None:
+        '''Writes the metrics in the Prometheus text exposition format.'''
+        data = self.to_dict()
+        lines = [
+            f'quartzy_wall_seconds {data["wall_seconds"]}',
+            f'quartzy_peak_rss_bytes {int(data["peak_rss_mb"] * 2**20)}']
+        for name, span in data['spans'].items():
+            lines.append(f'quartzy_span_calls_total{{span="{name}"}} {span["calls"]}')
+            lines.append(f'quartzy_span_seconds_total{{span="{name}"}} {span["seconds"]}')
+        for name, value in data['counters'].items():
+            lines.append(f'quartzy_{_metric_name(name)}_total {value}')
+        for name, histogram in data['histograms'].items():
+            metric = f'quartzy_{_metric_name(name)}'
+            lines.append(f'# TYPE {metric} histogram')
+            cumulative = 0
+            for le, count in histogram['buckets']:
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{le}"}} {cumulative}')
+            lines.append(f'{metric}_sum {histogram["sum"]}')
+            lines.append(f'{metric}_count {histogram["count"]}')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text('\n'.join(lines) + '\n')
+
+    def summary(self) -> str:
+        '''Short human-readable summary of the slowest spans and HTTP traffic.'''
+        data = self.to_dict()
+        lines = [f'wall time {data["wall_seconds"]:.1f}s, peak memory {data["peak_rss_mb"]:.0f} MB']
+        for name, span in sorted(data['spans'].items(), key=lambda item: -item[1]['seconds'])[:10]:
+            lines.append(f'  {name:<28} {span["seconds"]:>9.2f}s  ({span["calls"]} calls)')
+        counters = data['counters']
+        if 'http_requests' in counters:
+            latency = data['histograms'].get('http_latency_seconds', {'sum': 0.0, 'count': 1})
+            lines.append(f'  http: {int(counters["http_requests"])} requests, '
+                f'{counters.get("http_bytes", 0) / 2**20:.1f} MB, '
+                f'{int(counters.get("http_retries", 0))} retries, '
+                f'mean latency {latency["sum"] / max(latency["count"], 1) * 1e3:.0f} ms')
+        return '\n'.join(lines)
+
+def _metric_name(name: str) -> str:
+    return ''.join(c if c.isalnum() else '_' for c in name)
+
+def peak_rss_mb() -> float:
+    '''Peak resident memory of this process in MB.'''
+    if resource is None:
+        return 0.0
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20
+
+@contextmanager
+def profiled(path: Optional[Path]) -> Iterator[None]:
+    '''
+    Runs the enclosed block under cProfile if path is given, dumping the
+    stats to path and printing the top functions by cumulative time.
+    '''
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(str(path))
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+
+# Process-wide metrics shared by the parser, linter and build scripts
+METRICS = Metrics()
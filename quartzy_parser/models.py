@@ -1,6 +1,34 @@
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Union
 import datetime
-from pydantic import BaseModel, validator # type: ignore
+from pydantic import BaseModel, PrivateAttr, validator # type: ignore
+
+# Slower formats that Quartzy dates have been seen in, tried in order after
+# the ISO fast path. The last format that worked is tried first next time.
+_DATE_FORMATS = [r'%Y-%m-%d', r'%Y-%m-%dT%H:%M:%S.%fZ', r'%m/%d/%Y']
+_last_date_format = _DATE_FORMATS[0]
+
+# Quartzy group of the Galloway Lab inventory
+DEFAULT_GROUP_ID = '190392'
+
+def parse_quartzy_date(value: Union[str, datetime.date]) -> datetime.date:
+    '''Parses the date formats Quartzy uses for custom date fields.'''
+    global _last_date_format
+    if isinstance(value, datetime.date):
+        return value
+    # Fast path for YYYY-MM-DD, optionally followed by a THH:MM:SS.fffZ time
+    if len(value) >= 10 and value[4:5] == '-' and (len(value) == 10 or (value[10] == 'T' and value[19:20] == '.' and value[-1] == 'Z')):
+        try:
+            return datetime.date.fromisoformat(value[:10])
+        except ValueError:
+            pass
+    for date_format in [_last_date_format] + [f for f in _DATE_FORMATS if f != _last_date_format]:
+        try:
+            result = datetime.datetime.strptime(value, date_format).date()
+        except ValueError:
+            continue
+        _last_date_format = date_format
+        return result
+    raise ValueError(f"Can't process given Quartzy date: {value}")
 
 class Plasmid(BaseModel):
     pKG: int
@@ -15,34 +43,29 @@ class Plasmid(BaseModel):
     alt_name: str
     owner_id: str
     attachment_filenames: List[str] = []
+    group_id: str = DEFAULT_GROUP_ID
     technical_details: List[str]
     warnings: List[Tuple[str,str]] = []
     errors: List[Tuple[str,str]] = []
+    # (Quartzy item ID, updated_at) of the item version this was parsed from, if known; not serialized
+    _revision: Optional[Tuple[str,str]] = PrivateAttr(default=None)
 
     @validator('date_stored', pre=True)
     def parse_quartzy_date(cls, value: str) -> datetime.date:
-        try:
-            return datetime.datetime.strptime(
-                value,
-                r'%Y-%m-%d',
-            ).date()
-        except ValueError:
-            pass
-        try:
-            return datetime.datetime.strptime(
-                value,
-                r'%Y-%m-%dT%H:%M:%S.%fZ'
-            ).date()
-        except ValueError:
-            pass
-        try:
-            return datetime.datetime.strptime(
-                value,
-                r'%m/%d/%Y'
-            ).date()
-        except ValueError:
-            pass
-        raise ValueError(f"Can't process given Quartzy date: {value}")
+        return parse_quartzy_date(value)
+
+    @classmethod
+    def from_trusted(cls, **fields) -> 'Plasmid':
+        '''
+        Builds a Plasmid from fields that have already been validated (e.g.
+        loaded back from a snapshot), skipping pydantic validation.
+        '''
+        if not isinstance(fields['date_stored'], datetime.date):
+            fields['date_stored'] = parse_quartzy_date(fields['date_stored'])
+        # Linting appends to these, which must not change the source of the fields
+        fields['errors'] = list(fields.get('errors', []))
+        fields['warnings'] = list(fields.get('warnings', []))
+        return cls.construct(**fields)
 
 class User(BaseModel):
     first_name: str
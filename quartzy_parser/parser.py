@@ -1,109 +1,340 @@
-from typing import List, Optional, Dict
-from requests import Session
-from urllib.parse import unquote, quote
-from gazpacho.soup import Soup
-from time import sleep
+from typing import List, Optional, Dict, Any, Callable, Deque, Iterable, Iterator, TypeVar, Union
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+import itertools
 import json
+import queue
+import threading
 
-from .models import Plasmid, User
-
-def get_plasmids(username: str, password: str, plasmid_limit: Optional[int]=None) -> List[Plasmid]:
-    result: List[Plasmid] = []
-    with Session() as s:
-        s.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:96.0) Gecko/20100101 Firefox/96.0',
-            'Origin': 'https://app.quartzy.com',
-            'Referer': 'https://app.quartzy.com/'
-        })
-        # Request the login page to get the client ID.
-        login_page_env = Soup(s.get('https://app.quartzy.com/login').text).find('meta', {'name': 'frontend/config/environment'}, mode='first')
-        if type(login_page_env) is not Soup or login_page_env.attrs is None:
-            raise RuntimeError("Couldn't load Quartzy environment!")
-        login_env = json.loads(unquote(login_page_env.attrs['content']))
-        response = s.post('https://io.quartzy.com/oauth/tokens',
-            data=f'grant_type=password&client_id={login_env["api"]["clientId"]}&username={quote(username)}&password={password.replace(" ", "%20")}',
-            headers={'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8'}).json()
-        auth_header = f"{response['token_type']} {response['access_token']}"
-        s.headers.update({'Authorization': auth_header})
-
-        pKG_count_map: Dict[int,int] = {}
-
-        # Dump plasmids
-        page = 1
-        end_page = 1e10
-        while page < end_page:
-            if plasmid_limit is not None and len(result) > plasmid_limit:
-                break
-            sleep(0.1) # Sleep to prevent getting rate-limited
-            response = s.get('https://io.quartzy.com/groups/190392/items', params={
-                'page': page,
-                'limit': '100',
-                'sort': '-name'}).json()
-            end_page = int(response['meta']['pagination']['page']['last'])
-            page = page + 1
-            for elem in response['data']:
-                data = elem['attributes']
-                attachments_json = s.get(f'https://io.quartzy.com/items/{elem["id"]}/attachments').json()
-                sleep(0.05)
-                attachments: List[str] = [a['attributes']['file_name'] for a in attachments_json['data'] if a['type'] == 'attachment']
+from .client import QuartzyClient
+from .metrics import METRICS
+from .models import DEFAULT_GROUP_ID, Plasmid, User
+from .snapshot import Snapshot, item_revision
 
+T = TypeVar('T')
+R = TypeVar('R')
+
+ITEM_PAGE_SIZE = 100
+COMPOUND_PAGE_SIZE = 500
+# Plasmids a group fetched by iter_groups may get ahead of the consumer
+GROUP_BUFFER = 2000
+# Item attributes/relationships actually consumed when building a Plasmid
+ITEM_FIELDS = 'name,updated_at,custom_fields,vendor_name,catalog_number,technical_details,owned_by,attachments'
+# Attachment attributes kept: the file name and the URL its content is served at
+ATTACHMENT_FIELDS = 'file_name,url'
+GROUP_ITEMS = '/groups/{group_id}/items'
+GROUP_USERS = '/users?filter[has_items]=1&filter[group]={group_id}'
+
+def _fetch_item_page(client: QuartzyClient, page: int, page_size: int=ITEM_PAGE_SIZE, compound: bool=False,
+        snapshot: Optional[Snapshot]=None, group_id: str=DEFAULT_GROUP_ID) -> Optional[Dict[str,Any]]:
+    '''
+    Fetches one page of the items of a group.
+
+    Returns a dict with the page count ('last'), the page 'etag' and a list of
+    'records', each holding the raw 'item' and its 'attachments' as
+    [attachment id, file name, download URL] (None if they still need to be fetched).
+    Records of an unchanged page also carry the stored 'plasmid' fields.
+
+    If compound is set, asks for a sparse JSON:API compound document that
+    carries each item's attachments inline. Returns None if the server
+    rejects or ignores the compound request.
+
+    If a snapshot is given, the page is requested conditionally; unchanged
+    pages, and the attachments of unchanged items, are taken from the snapshot.
+
+    Rate limiting and retries of transient failures happen in the client, so a
+    throttled page is retried in place rather than restarting the fetch.
+    '''
+    params = {
+        'page': page,
+        'limit': str(page_size),
+        'sort': '-name'}
+    if compound:
+        params.update({
+            'include': 'attachments',
+            'fields[item]': ITEM_FIELDS,
+            'fields[attachment]': ATTACHMENT_FIELDS})
+    etag = snapshot.page_etag(group_id, [compound, page_size], page) if snapshot is not None else None
+    with METRICS.span('fetch.page'):
+        response = client.get(GROUP_ITEMS.format(group_id=group_id), params=params,
+            headers={'If-None-Match': etag} if etag is not None else {})
+    if response.status_code == 304:
+        METRICS.add('fetch.pages_unchanged')
+    if response.status_code == 304 and snapshot is not None:
+        cached = snapshot.groups[group_id]['pages'][str(page)]
+        return {'last': cached['last'], 'etag': etag, 'records': [
+            {'item': snapshot.items[item_id]['raw'], 'attachments': snapshot.items[item_id]['attachments'],
+                'plasmid': snapshot.items[item_id]['plasmid']}
+            for item_id in cached['item_ids']]}
+    if compound and not response.ok:
+        return None
+    response.raise_for_status()
+    response_json = response.json()
+    all_attachments = _included_attachments(response_json) if compound else [None] * len(response_json['data'])
+    if all_attachments is None:
+        return None
+    records = []
+    for elem, attachments in zip(response_json['data'], all_attachments):
+        if attachments is None and snapshot is not None:
+            attachments = snapshot.cached_attachments(elem)
+        records.append({'item': elem, 'attachments': attachments})
+    return {
+        'last': int(response_json['meta']['pagination']['page']['last']),
+        'etag': response.headers.get('ETag'),
+        'records': records}
+
+def _fetch_attachments(client: QuartzyClient, item_id: str) -> List[List[Optional[str]]]:
+    '''Fetches the [attachment id, file name, download URL] of the attachments of a single item.'''
+    with METRICS.span('fetch.attachments'):
+        response = client.get(f'/items/{item_id}/attachments')
+    response.raise_for_status()
+    attachments_json = response.json()
+    return [_attachment_entry(a) for a in attachments_json['data'] if a['type'] == 'attachment']
+
+def _attachment_entry(attachment: Dict[str,Any]) -> List[Optional[str]]:
+    '''[attachment id, file name, download URL] of an attachment resource. The URL is None if it has none.'''
+    return [attachment['id'], attachment['attributes']['file_name'], attachment['attributes'].get('url')]
+
+def _included_attachments(response: Dict[str,Any]) -> Optional[List[List[List[Optional[str]]]]]:
+    '''
+    Extracts per-item [attachment id, file name, download URL] from a compound item page.
+
+    Returns None if the page does not carry attachment linkage for every item,
+    e.g. because the server ignored the include parameter.
+    '''
+    entries: Dict[str,List[Optional[str]]] = {
+        a['id']: _attachment_entry(a)
+        for a in response.get('included', []) if a['type'] == 'attachment'}
+    result: List[List[List[Optional[str]]]] = []
+    for elem in response['data']:
+        linkage = elem.get('relationships', {}).get('attachments', {}).get('data')
+        if linkage is None or any(a['id'] not in entries for a in linkage if a['type'] == 'attachment'):
+            return None
+        result.append([entries[a['id']] for a in linkage if a['type'] == 'attachment'])
+    return result
+
+def _parse_plasmid(elem: Dict[str,Any], attachments: List[List[Optional[str]]], filename: str, group_id: str) -> Plasmid:
+    '''Builds a Plasmid from a raw Quartzy item.'''
+    data = elem['attributes']
+    return Plasmid(
+        pKG=int(data['custom_fields']['pKG#']),
+        filename=filename,
+        q_item_name=data['name'],
+        name=data['custom_fields']['Plasmid'],
+        species=data['custom_fields']['Species'],
+        resistances=data['custom_fields']['Resistance markers'],
+        plasmid_type=data['custom_fields']['Plasmid type'],
+        date_stored=data['custom_fields']['Date stored'],
+        technical_details=data['technical_details'].split(';') if data['technical_details'] is not None else [],
+        attachment_filenames=[attachment[1] for attachment in attachments],
+        vendor=data['vendor_name'],
+        alt_name=data['catalog_number'] if data['catalog_number'] is not None else '',
+        owner_id=elem['relationships']['owned_by']['data']['id'],
+        group_id=group_id)
+
+def _prefetch_map(pool: ThreadPoolExecutor, fn: Callable[[T], R], items: Iterable[T], window: int) -> Iterator[R]:
+    '''Like pool.map, but keeps at most window calls in flight ahead of the consumer.'''
+    pending: Deque[Future] = deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def iter_plasmids(client: QuartzyClient, plasmid_limit: Optional[int]=None, max_workers: int=1,
+        compound: bool=True, page_size: int=COMPOUND_PAGE_SIZE, snapshot: Optional[Snapshot]=None,
+        group_id: str=DEFAULT_GROUP_ID, subdirectory: Optional[str]=None) -> Iterator[Plasmid]:
+    '''
+    Downloads the plasmids in the inventory of a group, yielding each one as
+    soon as its page (and attachment list) has arrived. With a subdirectory,
+    filenames are put in it (e.g. `<subdirectory>/pKG00012.rst`).
+
+    max_workers sets how many page/attachment requests may be in flight at
+    once; the default of 1 fetches serially. Only a few pages are fetched
+    ahead of the consumer. The yielded sequence (including `_dupN` filename
+    assignment) is identical regardless of max_workers.
+
+    If compound is set, each page of page_size items is requested together
+    with its attachments, so no per-item attachment calls are needed. If the
+    server rejects or ignores this, we fall back to 100-item pages with one
+    attachment request per item.
+
+    If a snapshot is given, only pages and attachment lists that changed
+    since the snapshot are downloaded, and the snapshot is updated in place
+    with the result once the iterator is exhausted (the caller is responsible
+    for saving it). Only the group's part of the snapshot is replaced.
+    '''
+    prefix = f'{subdirectory}/' if subdirectory is not None else ''
+    pKG_count_map: Dict[int,int] = {}
+    fetched_pages: Dict[str,Dict[str,Any]] = {}
+    fetched_items: Dict[str,Dict[str,Any]] = {}
+    n_plasmids = 0
+
+    # Dump plasmids. The first page tells us how many pages there are; the
+    # remaining pages and the per-item attachment lookups are independent,
+    # so they can be spread over a worker pool. Results are consumed in
+    # request order so filenames come out exactly as in a serial fetch.
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        first_page = _fetch_item_page(client, 1, page_size, True, snapshot, group_id) if compound else None
+        if first_page is None:
+            compound = False
+            page_size = ITEM_PAGE_SIZE
+            first_page = _fetch_item_page(client, 1, snapshot=snapshot, group_id=group_id)
+        end_page = first_page['last']
+        if plasmid_limit is not None:
+            # Mirror the serial behavior: keep fetching pages until we have
+            # more than plasmid_limit plasmids.
+            end_page = min(end_page, plasmid_limit // page_size + 1)
+        pages = itertools.chain(
+            [first_page],
+            _prefetch_map(pool, lambda page: _fetch_item_page(client, page, page_size, compound, snapshot, group_id),
+                range(2, end_page + 1), window=max(2, max_workers)))
+        for page_number, page in enumerate(pages, start=1):
+            if page is None:
+                raise RuntimeError('Quartzy rejected a compound item page!')
+            missing = [record for record in page['records'] if record['attachments'] is None]
+            for record, attachments in zip(missing, pool.map(lambda record: _fetch_attachments(client, record['item']['id']), missing)):
+                record['attachments'] = attachments
+            fetched_pages[str(page_number)] = {
+                'etag': page['etag'],
+                'last': page['last'],
+                'item_ids': [record['item']['id'] for record in page['records']]}
+            for record in page['records']:
                 # Dump pKG and compute filename
-                pKG = int(data['custom_fields']['pKG#'])
+                pKG = int(record['item']['attributes']['custom_fields']['pKG#'])
                 if pKG not in pKG_count_map:
                     pKG_count_map[pKG] = 1
-                    filename = f'pKG{pKG:05d}.rst'
+                    filename = f'{prefix}pKG{pKG:05d}.rst'
                 else:
-                    filename = f'pKG{pKG:05d}_dup{pKG_count_map[pKG]}.rst'
+                    filename = f'{prefix}pKG{pKG:05d}_dup{pKG_count_map[pKG]}.rst'
                     pKG_count_map[pKG] += 1
 
-                result.append(Plasmid(
-                    pKG=pKG,
-                    filename=filename,
-                    q_item_name=data['name'],
-                    name=data['custom_fields']['Plasmid'],
-                    species=data['custom_fields']['Species'],
-                    resistances=data['custom_fields']['Resistance markers'],
-                    plasmid_type=data['custom_fields']['Plasmid type'],
-                    date_stored=data['custom_fields']['Date stored'],
-                    technical_details=data['technical_details'].split(';') if data['technical_details'] is not None else [],
-                    attachment_filenames=attachments,
-                    vendor=data['vendor_name'],
-                    alt_name=data['catalog_number'] if data['catalog_number'] is not None else '',
-                    owner_id=elem['relationships']['owned_by']['data']['id']))
+                if 'plasmid' in record:
+                    # Unchanged page: the stored fields are still valid, only
+                    # the filename depends on the pages before this one
+                    fields = dict(record['plasmid'], filename=filename, group_id=group_id)
+                    plasmid = Plasmid.from_trusted(**fields)
+                else:
+                    plasmid = _parse_plasmid(record['item'], record['attachments'], filename, group_id)
+                    fields = None
+                plasmid._revision = item_revision(record['item'])
+                if snapshot is not None:
+                    fetched_items[record['item']['id']] = {
+                        'raw': record['item'],
+                        'attachments': record['attachments'],
+                        'plasmid': fields if fields is not None else json.loads(plasmid.json())}
+                n_plasmids += 1
+                yield plasmid
                 #print('.', end='', flush=True)
-        print('plasmids done!')
-    return result
+    if snapshot is not None:
+        snapshot.update_group(group_id, [compound, page_size], fetched_pages, fetched_items)
+    # Runs in a worker thread with several groups, so the count goes to METRICS rather than stdout
+    METRICS.add('fetch.plasmids', n_plasmids)
 
-def get_users(username: str, password: str) -> List[User]:
-    result: List[User] = []
+def iter_groups(client: QuartzyClient, group_ids: List[str], plasmid_limit: Optional[int]=None, max_workers: int=1,
+        compound: bool=True, page_size: int=COMPOUND_PAGE_SIZE, snapshot: Optional[Snapshot]=None) -> Iterator[Plasmid]:
+    '''
+    Downloads the plasmids of several groups as one inventory, group by
+    group in the given order.
+
+    The groups are fetched concurrently, each by iter_plasmids in its own
+    thread with a share of max_workers. They all go through the one client,
+    so they share its login and rate limit. Plasmids of later groups are
+    buffered until the earlier groups have been yielded, so the sequence is
+    the same as fetching the groups one after the other; a group pauses
+    once GROUP_BUFFER of its plasmids are waiting.
+
+    pKG numbers belong to a group, so with several groups the `_dupN`
+    suffixes are counted per group, and each group's filenames are put in a
+    directory named after the group ID. A single group keeps flat filenames.
 
-    # Start session, copied from get_plasmids
-    with Session() as s:
-        s.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:96.0) Gecko/20100101 Firefox/96.0',
-            'Origin': 'https://app.quartzy.com',
-            'Referer': 'https://app.quartzy.com/'
-        })
-        # Request the login page to get the client ID.
-        login_page_env = Soup(s.get('https://app.quartzy.com/login').text).find('meta', {'name': 'frontend/config/environment'}, mode='first')
-        if type(login_page_env) is not Soup or login_page_env.attrs is None:
-            raise RuntimeError("Couldn't load Quartzy environment!")
-        login_env = json.loads(unquote(login_page_env.attrs['content']))
-        response = s.post('https://io.quartzy.com/oauth/tokens',
-            data=f'grant_type=password&client_id={login_env["api"]["clientId"]}&username={quote(username)}&password={password.replace(" ", "%20")}',
-            headers={'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8'}).json()
-        auth_header = f"{response['token_type']} {response['access_token']}"
-        s.headers.update({'Authorization': auth_header})
-
-        # Dump users
-        response = s.get('https://io.quartzy.com/users?filter[has_items]=1&filter[group]=190392').json()
-        for elem in response['data']:
-            data = elem['attributes']
-            result.append(User(
-                id=elem['id'],
-                first_name=data['first_name'],
-                last_name=data['last_name'],
-                full_name=data['full_name']))
-            #print('.', end='', flush=True)
-        print('users done!')
+    If a snapshot is given, it ends up holding exactly these groups.
+    '''
+    if len(group_ids) == 1:
+        yield from iter_plasmids(client, plasmid_limit, max_workers, compound, page_size, snapshot, group_ids[0])
+    else:
+        group_workers = max(1, max_workers // len(group_ids))
+        results: List[queue.Queue] = [queue.Queue(maxsize=GROUP_BUFFER) for _ in group_ids]
+        # Set when the consumer stops early, so paused groups give up instead of waiting forever
+        closed = threading.Event()
+
+        def put(out: queue.Queue, result: Union[Plasmid,BaseException,None]) -> bool:
+            while not closed.is_set():
+                try:
+                    out.put(result, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetch(group_id: str, out: queue.Queue) -> None:
+            try:
+                for plasmid in iter_plasmids(client, plasmid_limit, group_workers, compound, page_size,
+                        snapshot, group_id, subdirectory=group_id):
+                    if not put(out, plasmid):
+                        return
+            except BaseException as e:
+                put(out, e)
+            else:
+                put(out, None)
+
+        for group_id, out in zip(group_ids, results):
+            threading.Thread(target=fetch, args=(group_id, out), daemon=True).start()
+        try:
+            for out in results:
+                while True:
+                    result: Union[Plasmid,BaseException,None] = out.get()
+                    if result is None:
+                        break
+                    if isinstance(result, BaseException):
+                        raise result
+                    yield result
+        finally:
+            closed.set()
+    if snapshot is not None:
+        snapshot.select_groups(group_ids)
+    print('plasmids done!')
+
+def get_plasmids(client: QuartzyClient, plasmid_limit: Optional[int]=None, max_workers: int=1,
+        compound: bool=True, page_size: int=COMPOUND_PAGE_SIZE, snapshot: Optional[Snapshot]=None,
+        group_ids: Optional[List[str]]=None) -> List[Plasmid]:
+    '''
+    Downloads all plasmids in the inventories of group_ids (default: the lab
+    group). See iter_plasmids and iter_groups for the arguments.
+    '''
+    return list(iter_groups(client, group_ids or [DEFAULT_GROUP_ID], plasmid_limit, max_workers,
+        compound, page_size, snapshot))
+
+def _fetch_users(client: QuartzyClient, group_id: str) -> List[User]:
+    with METRICS.span('fetch.users'):
+        response = client.get(GROUP_USERS.format(group_id=group_id))
+    response.raise_for_status()
+    response = response.json()
+    result: List[User] = []
+    for elem in response['data']:
+        data = elem['attributes']
+        result.append(User(
+            id=elem['id'],
+            first_name=data['first_name'],
+            last_name=data['last_name'],
+            full_name=data['full_name']))
     return result
+
+def get_users(client: QuartzyClient, snapshot: Optional[Snapshot]=None,
+        group_ids: Optional[List[str]]=None) -> List[User]:
+    '''
+    Downloads all users that own items in group_ids (default: the lab group),
+    recording them in snapshot if given. The groups are fetched concurrently,
+    and users of several groups are listed once.
+    '''
+    result: Dict[str,User] = {}
+    group_ids = group_ids or [DEFAULT_GROUP_ID]
+    with ThreadPoolExecutor(max_workers=len(group_ids)) as pool:
+        for users in pool.map(lambda group_id: _fetch_users(client, group_id), group_ids):
+            for user in users:
+                result.setdefault(user.id, user)
+    if snapshot is not None:
+        snapshot.user_fields = [user.dict() for user in result.values()]
+    print('users done!')
+    return list(result.values())
@@ -0,0 +1,73 @@
+from typing import Optional
+from email.utils import parsedate_to_datetime
+from threading import Lock
+import datetime
+import random
+import time
+
+# Status codes that indicate a transient failure worth retrying
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class RateLimiter:
+    '''
+    Thread-safe token bucket whose refill rate adapts to server feedback.
+
+    Every successful response nudges the rate up by increase (additive
+    increase), and every throttled response halves it (multiplicative
+    decrease), so the limiter settles just below whatever rate Quartzy
+    tolerates. Rates are in requests per second.
+    '''
+    def __init__(self, rate: float=10.0, min_rate: float=0.5, max_rate: float=50.0,
+            burst: float=10.0, increase: float=0.5):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = Lock()
+
+    def acquire(self) -> None:
+        '''Blocks until a request may be sent.'''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def on_success(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self, retry_after: Optional[float]=None) -> None:
+        '''Backs off after a 429, pausing all callers for retry_after seconds if given.'''
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 0)
+            if retry_after is not None:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    '''Parses a Retry-After header (delta-seconds or HTTP date) into seconds.'''
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+def backoff_delay(attempt: int, base: float=0.5, cap: float=30.0) -> float:
+    '''Exponential backoff with full jitter for the given (zero-based) retry attempt.'''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
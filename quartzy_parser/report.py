@@ -0,0 +1,126 @@
+'''
+Lint report of an inventory by owner.
+
+LintReport indexes the linted plasmids once, by owner, severity and lint
+category, so selecting owners and printing any of the formats never scans
+the inventory again. The writers stream their output a line at a time.
+'''
+from typing import List, Optional, Dict, Iterable, Iterator, NamedTuple, TextIO
+import csv
+import json
+
+from .linter import ERROR, WARNING
+from .models import Plasmid, User
+
+# Lab account that plasmids of former members (no longer listed as users) are reported under
+DEFAULT_OWNER = 'Galloway Lab'
+# In the order the report shows them
+SEVERITIES = [WARNING, ERROR]
+
+class Finding(NamedTuple):
+    '''One error or warning of one plasmid, as a row of the JSON and CSV reports.'''
+    owner: str
+    owner_id: str
+    group_id: str
+    pKG: int
+    filename: str
+    plasmid: str
+    severity: str
+    category: str
+    message: str
+
+class LintReport:
+    '''
+    Findings of linted plasmids, indexed as owner ID -> severity -> lint
+    category -> plasmids. Owners are users, looked up by ID.
+    '''
+    def __init__(self, users: Iterable[User], plasmids: Iterable[Plasmid]):
+        self.users: Dict[str,User] = {user.id: user for user in users}
+        self._by_name: Dict[str,List[str]] = {}
+        for user in self.users.values():
+            self._by_name.setdefault(user.full_name, []).append(user.id)
+        default_ids = self._by_name.get(DEFAULT_OWNER)
+        self.default_owner: Optional[str] = default_ids[0] if default_ids else None
+        self.by_owner: Dict[str,Dict[str,Dict[str,List[Plasmid]]]] = {}
+        for plasmid in plasmids:
+            self.add(plasmid)
+
+    def owner_id(self, plasmid: Plasmid) -> str:
+        '''The ID the plasmid is reported under: its owner, or the lab account if the owner is gone.'''
+        if plasmid.owner_id in self.users or self.default_owner is None:
+            return plasmid.owner_id
+        return self.default_owner
+
+    def owner_name(self, owner_id: str) -> str:
+        user = self.users.get(owner_id)
+        return user.full_name if user is not None else f'Unknown user {owner_id}'
+
+    def add(self, plasmid: Plasmid) -> None:
+        if not plasmid.errors and not plasmid.warnings:
+            return
+        severities = self.by_owner.setdefault(self.owner_id(plasmid), {})
+        for severity, findings in ((ERROR, plasmid.errors), (WARNING, plasmid.warnings)):
+            categories = severities.setdefault(severity, {})
+            # A plasmid is listed once per category, however many findings it has there
+            for category in dict.fromkeys(category for category, _ in findings):
+                categories.setdefault(category, []).append(plasmid)
+
+    def select(self, names: Iterable[str]) -> List[str]:
+        '''
+        Owner IDs for exact full names or user IDs, in the given order. Raises
+        KeyError listing any that match no user.
+        '''
+        selected: Dict[str,None] = {}
+        unknown: List[str] = []
+        for name in names:
+            ids = self._by_name.get(name) or ([name] if name in self.users else [])
+            if not ids:
+                unknown.append(name)
+            selected.update(dict.fromkeys(ids))
+        if unknown:
+            raise KeyError(', '.join(unknown))
+        return list(selected)
+
+    def owners(self, owner_ids: Optional[List[str]]=None) -> List[str]:
+        '''Owners with findings, restricted to owner_ids if given; by name otherwise.'''
+        if owner_ids is not None:
+            return [owner_id for owner_id in owner_ids if owner_id in self.by_owner]
+        return sorted(self.by_owner, key=lambda owner_id: (self.owner_name(owner_id), owner_id))
+
+    def findings(self, owner_ids: Optional[List[str]]=None, severities: Iterable[str]=SEVERITIES) -> Iterator[Finding]:
+        '''Yields every finding of the selected owners and severities, by owner, severity and category.'''
+        severities = list(severities)
+        for owner_id in self.owners(owner_ids):
+            owner = self.owner_name(owner_id)
+            for severity in severities:
+                for category, plasmids in self.by_owner[owner_id].get(severity, {}).items():
+                    for plasmid in plasmids:
+                        for finding_category, message in (plasmid.errors if severity == ERROR else plasmid.warnings):
+                            if finding_category == category:
+                                yield Finding(owner, owner_id, plasmid.group_id, plasmid.pKG, plasmid.filename,
+                                    plasmid.name, severity, category, message)
+
+def write_text(report: LintReport, out: TextIO, owner_ids: Optional[List[str]]=None,
+        severities: Iterable[str]=SEVERITIES) -> None:
+    '''Per severity and owner, the pKG numbers of the plasmids in each lint category.'''
+    for severity in severities:
+        title = 'Errors' if severity == ERROR else 'Warnings'
+        out.write(f'\n{title}\n{"-" * len(title)}\n\n')
+        for owner_id in report.owners(owner_ids):
+            categories = report.by_owner[owner_id].get(severity)
+            if not categories:
+                continue
+            out.write(f'{report.owner_name(owner_id)}:\n')
+            for category, plasmids in categories.items():
+                out.write(f'  {category}: {", ".join(f"pKG{plasmid.pKG}" for plasmid in plasmids)}\n')
+            out.write('\n')
+
+def write_json(findings: Iterable[Finding], out: TextIO) -> None:
+    '''JSON Lines: one object per finding.'''
+    for finding in findings:
+        out.write(json.dumps(finding._asdict()) + '\n')
+
+def write_csv(findings: Iterable[Finding], out: TextIO) -> None:
+    writer = csv.writer(out)
+    writer.writerow(Finding._fields)
+    writer.writerows(findings)
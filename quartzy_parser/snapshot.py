@@ -0,0 +1,154 @@
+from typing import List, Optional, Dict, Any, Iterator, Tuple
+from pathlib import Path
+import hashlib
+import json
+import os
+import threading
+
+from .models import DEFAULT_GROUP_ID, Plasmid, User
+
+# 2: attachments are stored as [attachment id, file name] pairs
+# 3: pages and item order are kept per Quartzy group
+# 4: attachments are stored as [attachment id, file name, download URL]
+SNAPSHOT_VERSION = 4
+
+def item_revision(elem: Dict[str,Any]) -> Optional[Tuple[str,str]]:
+    '''(item ID, updated_at) of a raw item, which changes whenever the item or its attachments do.'''
+    updated_at = elem['attributes'].get('updated_at')
+    return (elem['id'], updated_at) if updated_at is not None else None
+
+class Snapshot:
+    '''
+    Local copy of the Quartzy inventory from the last fetch.
+
+    For every item we keep the raw JSON:API record, its attachments (as
+    [attachment id, file name, download URL]) and the parsed Plasmid fields. Item pages are stored with the ETag the
+    server sent, so the next fetch can ask for them conditionally and only
+    re-download pages (and attachment lists of items) that actually changed.
+    Pages are kept per Quartzy group, and the inventory is the items of
+    every group, group by group. A loaded snapshot is also enough to rebuild
+    everything offline.
+    '''
+    def __init__(self, path: Path, data: Optional[Dict[str,Any]]=None):
+        self.path = path
+        if data is not None and data.get('version') == 2:
+            # Version 2 snapshots hold the default group only
+            data = {'version': 3, 'items': data.get('items', {}), 'users': data.get('users', []),
+                'groups': {DEFAULT_GROUP_ID: {
+                    'layout': data.get('layout'), 'pages': data.get('pages', {}), 'order': data.get('order', [])}}}
+        if data is not None and data.get('version') == 3:
+            # Version 3 attachments lack their download URL: keep the items for
+            # offline builds, but forget the page ETags so the next fetch
+            # downloads every page (and the URLs) again
+            data = dict(data, version=SNAPSHOT_VERSION, groups={group_id: dict(group, pages={})
+                for group_id, group in data.get('groups', {}).items()})
+        data = data if data is not None and data.get('version') == SNAPSHOT_VERSION else {}
+        # Group ID -> {'layout': the (compound, page_size) its pages were
+        # requested with, 'pages': page number (as str) -> {'etag', 'last',
+        # 'item_ids'}, 'order': its item IDs in fetch order}
+        self.groups: Dict[str,Dict[str,Any]] = data.get('groups', {})
+        # Item ID -> {'raw', 'attachments', 'plasmid'}
+        self.items: Dict[str,Dict[str,Any]] = data.get('items', {})
+        # Parsed User fields
+        self.user_fields: List[Dict[str,Any]] = data.get('users', [])
+        # Groups fetched concurrently (see parser.iter_groups) update the snapshot from their own threads
+        self._lock = threading.Lock()
+
+    @property
+    def order(self) -> List[str]:
+        '''Item IDs of all groups, in fetch order.'''
+        return [item_id for group in self.groups.values() for item_id in group['order']]
+
+    @classmethod
+    def load(cls, path: Path) -> 'Snapshot':
+        '''Loads the snapshot at path, or returns an empty one if there is none.'''
+        if not path.is_file():
+            return cls(path)
+        with path.open(encoding='utf-8') as snapshot_file:
+            return cls(path, json.load(snapshot_file))
+
+    def is_empty(self) -> bool:
+        return not any(group['order'] for group in self.groups.values())
+
+    def save(self) -> None:
+        '''Atomically writes the snapshot back to its path.'''
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with tmp_path.open('w', encoding='utf-8') as snapshot_file:
+            json.dump({
+                'version': SNAPSHOT_VERSION,
+                'groups': self.groups,
+                'items': self.items,
+                'users': self.user_fields,
+            }, snapshot_file)
+        os.replace(tmp_path, self.path)
+
+    def fingerprint(self) -> str:
+        '''
+        Hash of the inventory content: the parsed plasmids in order and the
+        users. Fetch bookkeeping such as ETags is left out, so refetching an
+        unchanged inventory gives the same fingerprint.
+        '''
+        digest = hashlib.sha256()
+        for item_id in self.order:
+            digest.update(json.dumps(self.items[item_id]['plasmid'], sort_keys=True, default=str).encode('utf-8'))
+        digest.update(json.dumps(self.user_fields, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    def page_etag(self, group_id: str, layout: List[Any], page: int) -> Optional[str]:
+        '''Returns the stored ETag of a group's page, if it was fetched with the same layout.'''
+        group = self.groups.get(group_id)
+        if group is None or group['layout'] != layout or str(page) not in group['pages']:
+            return None
+        return group['pages'][str(page)]['etag']
+
+    def update_group(self, group_id: str, layout: List[Any], pages: Dict[str,Dict[str,Any]],
+            items: Dict[str,Dict[str,Any]]) -> None:
+        '''
+        Replaces the pages and items of one group with a fresh fetch (items in
+        fetch order). Safe to call from several threads at once.
+        '''
+        with self._lock:
+            for item_id in self.groups.get(group_id, {}).get('order', []):
+                self.items.pop(item_id, None)
+            self.items.update(items)
+            self.groups[group_id] = {'layout': layout, 'pages': pages, 'order': list(items)}
+
+    def select_groups(self, group_ids: List[str]) -> None:
+        '''Keeps only the given groups, in the given order, dropping the items of the others.'''
+        for group_id in set(self.groups) - set(group_ids):
+            for item_id in self.groups.pop(group_id)['order']:
+                self.items.pop(item_id, None)
+        self.groups = {group_id: self.groups[group_id] for group_id in group_ids if group_id in self.groups}
+
+    def cached_attachments(self, elem: Dict[str,Any]) -> Optional[List[List[str]]]:
+        '''
+        Returns the stored attachments of a raw item, or None if the item is
+        new, its update timestamp changed since the snapshot, or they were
+        stored without download URLs (by an older version).
+        '''
+        cached = self.items.get(elem['id'])
+        updated_at = elem['attributes'].get('updated_at')
+        if cached is None or updated_at is None or cached['raw']['attributes'].get('updated_at') != updated_at:
+            return None
+        if any(len(attachment) < 3 for attachment in cached['attachments']):
+            return None
+        return cached['attachments']
+
+    def iter_plasmids(self) -> Iterator[Plasmid]:
+        '''Rebuilds plasmids one at a time from the stored (already validated) fields.'''
+        for item_id in self.order:
+            plasmid = Plasmid.from_trusted(**self.items[item_id]['plasmid'])
+            plasmid._revision = item_revision(self.items[item_id]['raw'])
+            yield plasmid
+
+    def iter_attachments(self) -> Iterator[Tuple[Dict[str,Any],List[List[str]]]]:
+        '''Yields the stored Plasmid fields and [attachment id, file name, download URL] of every item.'''
+        for item_id in self.order:
+            yield self.items[item_id]['plasmid'], self.items[item_id]['attachments']
+
+    def plasmids(self) -> List[Plasmid]:
+        return list(self.iter_plasmids())
+
+    def users(self) -> List[User]:
+        return [User(**user) for user in self.user_fields]
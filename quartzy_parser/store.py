@@ -0,0 +1,190 @@
+from typing import List, Optional, Dict, Any, Iterable, Iterator, Tuple, NamedTuple
+from pathlib import Path
+import contextlib
+import json
+import sqlite3
+
+from .metrics import METRICS
+from .models import Plasmid, User
+
+STORE_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE users (id TEXT PRIMARY KEY, first_name TEXT, last_name TEXT, full_name TEXT NOT NULL);
+CREATE TABLE plasmids (
+    filename TEXT PRIMARY KEY,
+    group_id TEXT NOT NULL,
+    pKG INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    vendor TEXT,
+    catalog_number TEXT NOT NULL,
+    owner_id TEXT NOT NULL,
+    n_errors INTEGER NOT NULL,
+    n_warnings INTEGER NOT NULL,
+    record TEXT NOT NULL
+);
+CREATE TABLE resistances (filename TEXT NOT NULL, resistance TEXT NOT NULL);
+CREATE TABLE plasmid_types (filename TEXT NOT NULL, plasmid_type TEXT NOT NULL);
+CREATE TABLE lint (filename TEXT NOT NULL, severity TEXT NOT NULL, category TEXT NOT NULL, message TEXT NOT NULL);
+'''
+# Created after the bulk insert, which is faster than maintaining them row by row
+INDEXES = '''
+CREATE INDEX users_name ON users (full_name COLLATE NOCASE);
+CREATE INDEX plasmids_pKG ON plasmids (pKG);
+CREATE INDEX plasmids_group ON plasmids (group_id, pKG);
+CREATE INDEX plasmids_vendor ON plasmids (vendor COLLATE NOCASE);
+CREATE INDEX plasmids_catalog ON plasmids (catalog_number COLLATE NOCASE);
+CREATE INDEX plasmids_owner ON plasmids (owner_id);
+CREATE INDEX resistances_resistance ON resistances (resistance COLLATE NOCASE, filename);
+CREATE INDEX plasmid_types_type ON plasmid_types (plasmid_type COLLATE NOCASE, filename);
+CREATE INDEX lint_category ON lint (category COLLATE NOCASE, filename);
+CREATE INDEX lint_filename ON lint (filename);
+'''
+
+class PlasmidQuery(NamedTuple):
+    '''
+    Filters for InventoryStore.query. All given filters must match; text
+    filters are case-insensitive. Owners match by full name or user ID.
+    '''
+    pKG: Optional[List[int]] = None
+    group_id: Optional[str] = None
+    vendor: Optional[str] = None
+    catalog_number: Optional[str] = None
+    owner: Optional[str] = None
+    resistance: Optional[List[str]] = None
+    plasmid_type: Optional[List[str]] = None
+    name: Optional[str] = None
+    lint_category: Optional[str] = None
+    with_errors: bool = False
+    with_warnings: bool = False
+    limit: Optional[int] = None
+
+class InventoryStore:
+    '''
+    Local SQLite copy of the inventory: users, plasmids and their lint
+    results, indexed on the fields queries filter by. replace() rewrites the
+    whole store in one transaction; source_key() tells which inventory (e.g.
+    which snapshot file) it was last written from.
+    '''
+    def __init__(self, path: Path):
+        self.path = path
+        # Autocommit mode; replace() runs as one explicit transaction
+        self._conn = sqlite3.connect(str(path), isolation_level=None)
+
+    def __enter__(self) -> 'InventoryStore':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def source_key(self) -> Optional[str]:
+        try:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+            version = self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        except sqlite3.OperationalError:
+            return None
+        if row is None or version is None or int(version[0]) != STORE_VERSION:
+            return None
+        return row[0]
+
+    def replace(self, users: Iterable[User], plasmids: Iterable[Plasmid], source_key: str) -> None:
+        '''Replaces the stored inventory with users and (linted) plasmids.'''
+        with METRICS.span('store.write'), self._transaction():
+            for (table,) in self._conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+                self._conn.execute(f'DROP TABLE {table}')
+            for statement in _statements(SCHEMA):
+                self._conn.execute(statement)
+            self._conn.executemany('INSERT INTO users VALUES (?, ?, ?, ?)',
+                [(user.id, user.first_name, user.last_name, user.full_name) for user in users])
+            plasmid_rows: List[Tuple[Any,...]] = []
+            resistance_rows: List[Tuple[str,str]] = []
+            type_rows: List[Tuple[str,str]] = []
+            lint_rows: List[Tuple[str,str,str,str]] = []
+            for plasmid in plasmids:
+                plasmid_rows.append((plasmid.filename, plasmid.group_id, plasmid.pKG, plasmid.name, plasmid.vendor, plasmid.alt_name,
+                    plasmid.owner_id, len(plasmid.errors), len(plasmid.warnings), plasmid.json()))
+                resistance_rows.extend((plasmid.filename, resistance) for resistance in plasmid.resistances)
+                type_rows.extend((plasmid.filename, plasmid_type) for plasmid_type in plasmid.plasmid_type)
+                lint_rows.extend((plasmid.filename, 'error', category, message) for category, message in plasmid.errors)
+                lint_rows.extend((plasmid.filename, 'warning', category, message) for category, message in plasmid.warnings)
+            self._conn.executemany('INSERT INTO plasmids VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', plasmid_rows)
+            self._conn.executemany('INSERT INTO resistances VALUES (?, ?)', resistance_rows)
+            self._conn.executemany('INSERT INTO plasmid_types VALUES (?, ?)', type_rows)
+            self._conn.executemany('INSERT INTO lint VALUES (?, ?, ?, ?)', lint_rows)
+            self._conn.executemany('INSERT INTO meta VALUES (?, ?)', [('version', str(STORE_VERSION)), ('source', source_key)])
+            for statement in _statements(INDEXES):
+                self._conn.execute(statement)
+        self._conn.execute('ANALYZE')
+        METRICS.add('store.plasmids_written', len(plasmid_rows))
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[None]:
+        self._conn.execute('BEGIN')
+        try:
+            yield
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+
+    def users(self) -> Dict[str,User]:
+        '''Stored users by ID.'''
+        return {row[0]: User(id=row[0], first_name=row[1], last_name=row[2], full_name=row[3])
+            for row in self._conn.execute('SELECT id, first_name, last_name, full_name FROM users')}
+
+    def query(self, query: PlasmidQuery) -> Iterator[Plasmid]:
+        '''Yields the plasmids matching query (with their lint results), by group and pKG.'''
+        conditions: List[str] = []
+        params: List[Any] = []
+        if query.pKG:
+            conditions.append(f'pKG IN ({",".join("?" * len(query.pKG))})')
+            params.extend(query.pKG)
+        if query.group_id is not None:
+            conditions.append('group_id = ?')
+            params.append(query.group_id)
+        if query.vendor is not None:
+            conditions.append('vendor = ? COLLATE NOCASE')
+            params.append(query.vendor)
+        if query.catalog_number is not None:
+            conditions.append('catalog_number = ? COLLATE NOCASE')
+            params.append(query.catalog_number)
+        if query.owner is not None:
+            conditions.append('(owner_id = ? OR owner_id IN (SELECT id FROM users WHERE full_name = ? COLLATE NOCASE))')
+            params.extend([query.owner, query.owner])
+        for resistance in query.resistance or []:
+            conditions.append('filename IN (SELECT filename FROM resistances WHERE resistance = ? COLLATE NOCASE)')
+            params.append(resistance)
+        for plasmid_type in query.plasmid_type or []:
+            conditions.append('filename IN (SELECT filename FROM plasmid_types WHERE plasmid_type = ? COLLATE NOCASE)')
+            params.append(plasmid_type)
+        if query.name is not None:
+            conditions.append("name LIKE ? ESCAPE '\\'")
+            params.append('%' + query.name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+        if query.lint_category is not None:
+            conditions.append('filename IN (SELECT filename FROM lint WHERE category = ? COLLATE NOCASE)')
+            params.append(query.lint_category)
+        if query.with_errors:
+            conditions.append('n_errors > 0')
+        if query.with_warnings:
+            conditions.append('n_warnings > 0')
+        sql = 'SELECT record FROM plasmids'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY group_id, pKG, filename'
+        if query.limit is not None:
+            sql += ' LIMIT ?'
+            params.append(query.limit)
+        with METRICS.span('store.query'):
+            rows = self._conn.execute(sql, params).fetchall()
+        for (record,) in rows:
+            fields = json.loads(record)
+            fields['errors'] = [tuple(entry) for entry in fields['errors']]
+            fields['warnings'] = [tuple(entry) for entry in fields['warnings']]
+            yield Plasmid.from_trusted(**fields)
+
+def _statements(script: str) -> List[str]:
+    return [statement.strip() for statement in script.split(';') if statement.strip()]
@@ -0,0 +1,76 @@
+'''
+Aggregation index over the plasmid summaries that the index pages render from.
+
+One pass over the inventory groups the plasmids by vendor or alternate name
+category and by error and warning type. Each category's plasmids are then
+sorted once and grouped by lint type too, so the root index and every
+vendor page read prebuilt groups instead of rescanning the inventory.
+'''
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Alternate names like "pUC19" fall into the category "pUC"
+ALT_CATEGORY = re.compile(r'^(?P<alt_category>p[a-zA-Z]+)(?P<alt_name>.*)$')
+
+def alt_category(plasmid: Any) -> Optional[str]:
+    '''The vendor if given, else the alternate name prefix, else None.'''
+    if plasmid.vendor is not None:
+        return plasmid.vendor
+    alt_match = ALT_CATEGORY.match(plasmid.alt_name)
+    if alt_match is None:
+        return None
+    return alt_match.group('alt_category')
+
+class LintGroups:
+    '''Plasmids grouped by error and warning type, in the order they were added.'''
+    def __init__(self):
+        self.errors: Dict[str,List[Any]] = {}
+        self.warnings: Dict[str,List[Any]] = {}
+        # Number of plasmids with at least one error / warning
+        self.n_errors = 0
+        self.n_warnings = 0
+
+    def add(self, plasmid: Any) -> None:
+        if plasmid.errors:
+            self.n_errors += 1
+        if plasmid.warnings:
+            self.n_warnings += 1
+        for error_type, _ in plasmid.errors:
+            self.errors.setdefault(error_type, []).append(plasmid)
+        for warn_type, _ in plasmid.warnings:
+            self.warnings.setdefault(warn_type, []).append(plasmid)
+
+    @classmethod
+    def of(cls, plasmids: Iterable[Any]) -> 'LintGroups':
+        groups = cls()
+        for plasmid in plasmids:
+            groups.add(plasmid)
+        return groups
+
+class InventoryIndex:
+    '''
+    Lint groups of the whole inventory, plasmids by category (sorted by
+    alternate name) and lint groups within each category.
+    '''
+    def __init__(self, plasmids: Iterable[Any]):
+        self.plasmids: List[Any] = []
+        self.lint = LintGroups()
+        self.categories: Dict[str,List[Any]] = {}
+        for plasmid in plasmids:
+            self.plasmids.append(plasmid)
+            self.lint.add(plasmid)
+            category = alt_category(plasmid)
+            if category is not None:
+                self.categories.setdefault(category, []).append(plasmid)
+        self.category_lint: Dict[str,LintGroups] = {}
+        for category, members in self.categories.items():
+            members.sort(key=lambda p: p.alt_name)
+            self.category_lint[category] = LintGroups.of(members)
+
+    def lint_counts(self) -> Dict[Tuple[str,str],int]:
+        '''(category, error or warning type) -> number of findings.'''
+        counts: Dict[Tuple[str,str],int] = {}
+        for category, groups in self.category_lint.items():
+            for lint_type, members in [*groups.errors.items(), *groups.warnings.items()]:
+                counts[category, lint_type] = counts.get((category, lint_type), 0) + len(members)
+        return counts
@@ -0,0 +1,274 @@
+'''
+Renders the generated plasmid pages straight to HTML, without Sphinx.
+
+The pages reproduce the markup sphinx_rtd_theme produces for the RST that
+build.py generates, and link the theme and custom.css assets from the
+Sphinx build, so they look the same as the Sphinx-built pages around them.
+Templates are compiled once per process and pages are rendered in a
+process pool.
+'''
+import functools
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import jinja2
+
+from .aggregate import LintGroups
+
+# Page context: a plain dict so it can be pickled to worker processes
+Page = Dict[str,Any]
+# A link as (href relative to the site root, label)
+Link = Tuple[str,str]
+
+class SiteInfo(NamedTuple):
+    '''Site-wide values every page needs.'''
+    project: str
+    copyright: str
+    # Sidebar entries, as links relative to the site root
+    nav: List[Link]
+
+LAYOUT = '''<!DOCTYPE html>
+<html class="writer-html5" lang="en" >
+<head>
+  <meta charset="utf-8" />
+  <meta name="viewport" content="width=device-width, initial-scale=1.0" />
+  <title>{{ page.title }} &mdash; {{ site.project }}  documentation</title>
+  <link rel="stylesheet" href="{{ root }}_static/css/theme.css" type="text/css" />
+  <link rel="stylesheet" href="{{ root }}_static/pygments.css" type="text/css" />
+  <link rel="stylesheet" href="{{ root }}_static/css/custom.css" type="text/css" />
+  <script data-url_root="{{ root }}" id="documentation_options" src="{{ root }}_static/documentation_options.js"></script>
+  <script src="{{ root }}_static/jquery.js"></script>
+  <script src="{{ root }}_static/underscore.js"></script>
+  <script src="{{ root }}_static/doctools.js"></script>
+  <script type="text/javascript" src="{{ root }}_static/js/theme.js"></script>
+  <link rel="index" title="Index" href="{{ root }}genindex.html" />
+  <link rel="search" title="Search" href="{{ root }}search.html" />
+</head>
+<body class="wy-body-for-nav">
+  <div class="wy-grid-for-nav">
+    <nav data-toggle="wy-nav-shift" class="wy-nav-side">
+      <div class="wy-side-scroll">
+        <div class="wy-side-nav-search"  style="background: #2c6854" >
+          <a href="{{ root }}index.html" class="icon icon-home"> {{ site.project }}</a>
+<div role="search">
+  <form id="rtd-search-form" class="wy-form" action="{{ root }}plasmid_search.html" method="get">
+    <input type="text" name="q" placeholder="Search plasmids" />
+  </form>
+</div>
+        </div>
+        <div class="wy-menu wy-menu-vertical" data-spy="affix" role="navigation" aria-label="main navigation">
+          <ul{% if page.section %} class="current"{% endif %}>
+{% for href, label in site.nav %}<li class="toctree-l1{% if href == page.section %} current{% endif %}"><a class="reference internal" href="{{ root }}{{ href }}">{{ label }}</a></li>
+{% endfor %}</ul>
+        </div>
+      </div>
+    </nav>
+    <section data-toggle="wy-nav-shift" class="wy-nav-content-wrap">
+      <nav class="wy-nav-top" aria-label="top navigation">
+        <i data-toggle="wy-nav-top" class="fa fa-bars"></i>
+        <a href="{{ root }}index.html">{{ site.project }}</a>
+      </nav>
+      <div class="wy-nav-content">
+        <div class="rst-content">
+<div role="navigation" aria-label="breadcrumbs navigation">
+  <ul class="wy-breadcrumbs">
+    <li><a href="{{ root }}index.html" class="icon icon-home"></a> &raquo;</li>
+{% for href, label in page.breadcrumbs %}    <li><a href="{{ root }}{{ href }}">{{ label }}</a> &raquo;</li>
+{% endfor %}    <li> {{ page.title }}</li>
+  </ul>
+  <hr/>
+</div>
+          <div role="main" class="document" itemscope="itemscope" itemtype="http://schema.org/Article">
+           <div itemprop="articleBody">
+  <section id="{{ page.title|make_id }}">
+<h1>{% block heading %}{{ page.title }}{% endblock %}<a class="headerlink" href="#{{ page.title|make_id }}" title="Permalink to this headline">¶</a></h1>
+{% block body %}{% endblock %}
+</section>
+           </div>
+          </div>
+          <footer>
+  <hr/>
+  <div role="contentinfo">
+    <p>
+        &#169; Copyright {{ site.copyright }}.
+    </p>
+  </div>
+    Built with <a href="https://www.sphinx-doc.org/">Sphinx</a> using a
+    <a href="https://github.com/readthedocs/sphinx_rtd_theme">theme</a>
+    provided by <a href="https://readthedocs.org">Read the Docs</a>.
+</footer>
+        </div>
+      </div>
+    </section>
+  </div>
+  <script type="text/javascript">
+      jQuery(function () {
+          SphinxRtdTheme.Navigation.enable(true);
+      });
+  </script>
+</body>
+</html>
+'''
+
+MACROS = '''
+{% macro bullets(entries) %}<ul class="simple">
+{% for entry in entries %}<li><p>{{ entry }}</p></li>
+{% endfor %}</ul>{% endmacro %}
+
+{% macro lint_table(kind, title, count, groups) %}{% if count > 0 %}<div class="admonition {{ kind }}">
+<p class="admonition-title">{{ title }}</p>
+<p>There are {{ count }} plasmids with {{ kind }}s.</p>
+<table class="docutils align-default">
+<colgroup>
+<col style="width: 50%" />
+<col style="width: 50%" />
+</colgroup>
+<tbody>
+{% for category, links in groups %}<tr class="row-{{ loop.cycle('odd', 'even') }}"><td><p>{{ category }}</p></td>
+<td><p>{% for href, label in links %}<a class="reference internal" href="{{ root }}{{ href }}"><span class="doc">{{ label }}</span></a>{% if not loop.last %}, {% endif %}{% endfor %}</p></td>
+</tr>
+{% endfor %}</tbody>
+</table>
+</div>
+{% endif %}{% endmacro %}
+
+{% macro lint_summary(lint) %}{{ lint_table('error', 'Error', lint.n_errors, lint.errors) }}{{ lint_table('warning', 'Warning', lint.n_warnings, lint.warnings) }}{% endmacro %}
+'''
+
+PLASMID = '''{% extends "layout.html" %}
+{% from "macros.html" import bullets with context %}
+{% block heading %}{% if page.warnings %}<img alt="fa_warning" src="{{ root }}_static/files/fa_warning.svg" width="20px" /> (W) {% endif %}{% if page.errors %}<img alt="fa_error" src="{{ root }}_static/files/fa_error.svg" width="20px" /> (E) {% endif %}{{ page.name }}{% endblock %}
+{% block body %}{% if page.alt_name %}<p><strong>{{ page.alt_name }}</strong></p>
+{% endif %}{% if page.errors %}<div class="admonition error">
+<p class="admonition-title">Error</p>
+{{ bullets(page.errors) }}
+</div>
+{% endif %}{% if page.warnings %}<div class="admonition warning">
+<p class="admonition-title">Warning</p>
+{{ bullets(page.warnings) }}
+</div>
+{% endif %}<ul class="simple">
+<li><p><strong>Species</strong>: {{ page.species }}</p></li>
+<li><p><strong>Stock date</strong>: {{ page.date_stored }}</p></li>
+</ul>
+<section id="resistances">
+<h2>Resistances<a class="headerlink" href="#resistances" title="Permalink to this headline">¶</a></h2>
+{{ bullets(page.resistances) }}
+</section>
+<section id="plasmid-type">
+<h2>Plasmid type<a class="headerlink" href="#plasmid-type" title="Permalink to this headline">¶</a></h2>
+{{ bullets(page.plasmid_types) }}
+</section>{% endblock %}
+'''
+
+LIST = '''{% extends "layout.html" %}
+{% from "macros.html" import lint_summary with context %}
+{% block body %}{% if page.lint %}{{ lint_summary(page.lint) }}{% endif %}{% if page.simple %}<ul class="simple">
+{% for href, label in page.links %}<li><p><a class="reference internal" href="{{ root }}{{ href }}"><span class="doc">{{ label }}</span></a></p></li>
+{% endfor %}</ul>{% else %}<div class="toctree-wrapper compound">
+<ul>
+{% for href, label in page.links %}<li class="toctree-l1"><a class="reference internal" href="{{ root }}{{ href }}">{{ label }}</a></li>
+{% endfor %}</ul>
+</div>{% endif %}{% endblock %}
+'''
+
+TEMPLATES = {
+    'layout.html': LAYOUT,
+    'macros.html': MACROS,
+    'plasmid.html': PLASMID,
+    'list.html': LIST,
+}
+
+def make_id(title: str) -> str:
+    '''Section id the way docutils derives it from a title.'''
+    return re.sub(r'[^a-z0-9]+', '-', title.lower()).strip('-')
+
+@functools.lru_cache(maxsize=None)
+def _environment() -> jinja2.Environment:
+    '''Compiles the templates. Cached, so each process compiles them once.'''
+    env = jinja2.Environment(loader=jinja2.DictLoader(TEMPLATES), autoescape=True,
+        trim_blocks=False, keep_trailing_newline=True)
+    env.filters['make_id'] = make_id
+    for name in TEMPLATES:
+        env.get_template(name)
+    return env
+
+def plasmid_title(plasmid: Any) -> str:
+    '''Plain-text page title, as Sphinx shows it in lists and the browser title.'''
+    title = f'pKG{plasmid.pKG} - {plasmid.name}'
+    if len(plasmid.errors) > 0:
+        title = '(E) ' + title
+    if len(plasmid.warnings) > 0:
+        title = '(W) ' + title
+    return title
+
+def page_path(filename: str) -> str:
+    '''Site path of the page for a plasmid filename.'''
+    return 'plasmids/' + filename.rsplit('.', 1)[0] + '.html'
+
+def plasmid_page(plasmid: Any, breadcrumbs: List[Link]) -> Page:
+    '''Page context for a single plasmid, under the given parent pages.'''
+    return {
+        'template': 'plasmid.html',
+        'path': page_path(plasmid.filename),
+        'title': plasmid_title(plasmid),
+        'name': f'pKG{plasmid.pKG} - {plasmid.name}',
+        'section': 'plasmids/index.html',
+        'breadcrumbs': breadcrumbs,
+        'alt_name': plasmid.alt_name,
+        'errors': [message for _, message in plasmid.errors],
+        'warnings': [message for _, message in plasmid.warnings],
+        'species': plasmid.species,
+        'date_stored': str(plasmid.date_stored),
+        'resistances': list(plasmid.resistances),
+        'plasmid_types': list(plasmid.plasmid_type),
+    }
+
+def lint_summary(lint: LintGroups) -> Dict[str,Any]:
+    '''Links each plasmid of the prebuilt lint groups.'''
+    def links(groups: Dict[str,List[Any]]) -> List[Tuple[str,List[Link]]]:
+        return [(lint_type, [(page_path(plasmid.filename), f'pKG{plasmid.pKG}') for plasmid in plasmids])
+            for lint_type, plasmids in groups.items()]
+    return {
+        'n_errors': lint.n_errors,
+        'errors': links(lint.errors),
+        'n_warnings': lint.n_warnings,
+        'warnings': links(lint.warnings),
+    }
+
+def list_page(path: str, title: str, links: List[Link], lint: Optional[Dict[str,Any]]=None,
+        simple: bool=False, section: Optional[str]=None, breadcrumbs: Optional[List[Link]]=None) -> Page:
+    '''Page context for a page that lists links, optionally under a lint summary.'''
+    return {
+        'template': 'list.html',
+        'path': path,
+        'title': title,
+        'section': section,
+        'breadcrumbs': breadcrumbs or [],
+        'links': links,
+        'lint': lint,
+        'simple': simple,
+    }
+
+def render_page(site: SiteInfo, page: Page) -> str:
+    root = '../' * page['path'].count('/')
+    return _environment().get_template(page['template']).render(site=site, page=page, root=root)
+
+def _render_chunk(site: SiteInfo, pages: List[Page]) -> List[Tuple[str,str]]:
+    return [(page['path'], render_page(site, page)) for page in pages]
+
+def render_pages(site: SiteInfo, pages: List[Page], processes: Optional[int]=None,
+        chunk_size: int=500) -> Iterator[Tuple[str,str]]:
+    '''
+    Renders pages, yielding (site path, HTML) in page order. Batches larger
+    than chunk_size are rendered in a process pool of the given size
+    (default: one worker per core); processes=1 renders in this process.
+    '''
+    if processes == 1 or len(pages) <= chunk_size:
+        yield from _render_chunk(site, pages)
+        return
+    chunks = [pages[i:i + chunk_size] for i in range(0, len(pages), chunk_size)]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for rendered in pool.map(functools.partial(_render_chunk, site), chunks):
+            yield from rendered
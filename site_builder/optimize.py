@@ -0,0 +1,359 @@
+'''
+Post-build optimization of the HTML output for serving with long-lived caching.
+
+- Pages are minified and the plasmid search index (_search/*.json) is
+  re-encoded compactly.
+- Every asset in _static (and _images, where Sphinx copies the images of the
+  RST pages, such as the fa_*.svg icons) is replaced by a fingerprinted copy,
+  <name>.<hash>.<ext>, and pages and stylesheets are pointed at the copies,
+  so they can be cached indefinitely. No script of the site builds asset
+  URLs at runtime, so the originals are not needed. Assets a later build
+  does not copy in again keep the copy recorded in the manifest.
+- Text files get .gz and (if the brotli package is installed) .br siblings
+  for servers that serve precompressed files.
+
+A manifest keeps the content hash of every file as it was left (and the
+bytes its optimization saved), so the next run only minifies and compresses
+files whose content changed since. Files are processed in a process pool.
+Pages that build.py renders itself go through PageOptimizer as they are
+written, so unchanged ones still compare equal to the optimized pages on disk.
+'''
+import functools
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from .search_index import dumps
+
+try:
+    import brotli
+except ImportError: # Optional; only gzip siblings are written without it
+    brotli = None # type: ignore
+
+MANIFEST_VERSION = 1
+ASSET_DIRS = ['_static', '_images']
+SEARCH_DIR = '_search'
+# Hex digits of the content hash in fingerprinted asset names
+HASH_LENGTH = 10
+FINGERPRINT = re.compile(r'\.[0-9a-f]{%d}(?=\.[^./]+$)' % HASH_LENGTH)
+COMPRESSED_SUFFIXES = ['.gz', '.br']
+COMPRESSIBLE = {'.html', '.css', '.js', '.json', '.svg', '.txt', '.xml'}
+# Smaller files gain too little from compression to be worth a sibling
+MIN_COMPRESS_SIZE = 512
+
+# Whitespace is kept verbatim inside these elements
+PRESERVED = re.compile(r'(<(pre|textarea|script|style)\b.*?</\2\s*>)', re.S | re.I)
+# Comments, except conditional comments
+COMMENT = re.compile(r'<!--(?!\[if).*?-->', re.S)
+# Patterns that start with a literal are searched much faster. Explicit ASCII
+# whitespace: \s would also collapse non-breaking spaces
+INDENT = re.compile(r'\n[ \t\r\n\f]+')
+SPACES = re.compile(r'  +')
+# The path of a reference to an asset, up to a query or fragment
+ASSET_REF = re.compile(r'''(?:%s)/[^"'()\s?#<>]+''' % '|'.join(ASSET_DIRS))
+CSS_URL = re.compile(r'''url\((['"]?)([^'")]+)\1\)''')
+
+class FileResult(NamedTuple):
+    '''
+    The content hash a file was left with and the bytes its optimization
+    saves: by minifying, and of the compressed siblings over the file.
+    changed is whether it was optimized this run.
+    '''
+    path: str
+    digest: str
+    changed: bool
+    minify_saved: int
+    gzip_saved: int
+    brotli_saved: int
+
+class Savings:
+    def __init__(self):
+        self.minify = 0
+        self.gzip = 0
+        self.brotli = 0
+
+    def add(self, result: FileResult) -> None:
+        self.minify += result.minify_saved
+        self.gzip += result.gzip_saved
+        self.brotli += result.brotli_saved
+
+    def summary(self) -> str:
+        brotli_saved = f'brotli {_size(self.brotli)}' if brotli is not None else 'no brotli (not installed)'
+        return f'minify {_size(self.minify)}, gzip {_size(self.gzip)}, {brotli_saved}'
+
+class OptimizeStats:
+    '''Bytes saved by the files optimized this run, and by all files of the site.'''
+    def __init__(self):
+        self.n_files = 0
+        self.n_changed = 0
+        self.n_assets = 0
+        self.n_removed = 0
+        self.run = Savings()
+        self.total = Savings()
+
+    def add(self, result: FileResult) -> None:
+        self.n_files += 1
+        self.total.add(result)
+        if result.changed:
+            self.n_changed += 1
+            self.run.add(result)
+
+    def summary(self) -> str:
+        return (f'{self.n_changed} of {self.n_files} files changed, saving {self.run.summary()}; '
+            f'site total saved {self.total.summary()}; '
+            f'{self.n_assets} assets fingerprinted, {self.n_removed} stale files removed')
+
+def _size(n_bytes: int) -> str:
+    return f'{n_bytes / 1e6:.2f} MB' if n_bytes >= 100_000 else f'{n_bytes / 1e3:.1f} kB'
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def minify_html(html: str) -> str:
+    '''
+    Drops comments and shortens whitespace runs to one space or line break
+    outside <pre>, <textarea>, <script> and <style>, which keeps rendering
+    unchanged.
+    '''
+    parts = PRESERVED.split(html)
+    # split() yields text, element, tag name, text, ...
+    for i in range(0, len(parts), 3):
+        text = COMMENT.sub('', parts[i])
+        parts[i] = INDENT.sub('\n', SPACES.sub(' ', text)).replace(' \n', '\n')
+    return ''.join(part for i, part in enumerate(parts) if i % 3 != 2)
+
+def minify_json(text: str) -> str:
+    '''Re-encodes JSON the way the search index writes it, so its own shards are left as they are.'''
+    return dumps(json.loads(text))
+
+def optimize_page(html: str, assets: Dict[str,str]) -> str:
+    return minify_html(rewrite_asset_refs(html, assets))
+
+def fingerprinted_name(name: str, digest: str) -> str:
+    stem, dot, suffix = name.rpartition('.')
+    return f'{stem}.{digest[:HASH_LENGTH]}.{suffix}' if dot else f'{name}.{digest[:HASH_LENGTH]}'
+
+def rewrite_asset_refs(text: str, assets: Dict[str,str]) -> str:
+    '''
+    Points references to assets (relative or absolute) at the fingerprinted
+    copies. assets maps asset site paths to their fingerprinted names;
+    references to copies of earlier runs are updated as well.
+    '''
+    def replace(match: 're.Match[str]') -> str:
+        path = match.group(0)
+        if path not in assets:
+            path = FINGERPRINT.sub('', path)
+        fingerprinted = assets.get(path)
+        if fingerprinted is None:
+            return match.group(0)
+        return posixpath.join(posixpath.dirname(path), fingerprinted)
+    return ASSET_REF.sub(replace, text)
+
+def _rewrite_css_urls(css: str, css_path: str, assets: Dict[str,str]) -> str:
+    '''Points url()s in the stylesheet at site path css_path at the fingerprinted assets.'''
+    def replace(match: 're.Match[str]') -> str:
+        url = match.group(2)
+        if re.match(r'^([a-z]+:|/|#)', url):
+            return match.group(0)
+        # Keep query strings and fragments, e.g. the cache busters of the theme fonts
+        path = re.split(r'[?#]', url, 1)[0]
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(css_path), path))
+        fingerprinted = assets.get(target)
+        if fingerprinted is None:
+            return match.group(0)
+        new_url = posixpath.join(posixpath.dirname(path), fingerprinted) + url[len(path):]
+        return f'url({match.group(1)}{new_url}{match.group(1)})'
+    return CSS_URL.sub(replace, css)
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+def _compress(path: Path, data: bytes) -> Tuple[int,int]:
+    '''Writes the compressed siblings of path. Returns the bytes they save over data.'''
+    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+    _write_atomic(path.with_name(path.name + '.gz'), compressed)
+    gzip_saved = len(data) - len(compressed)
+    brotli_saved = 0
+    if brotli is not None:
+        compressed = brotli.compress(data, quality=11)
+        _write_atomic(path.with_name(path.name + '.br'), compressed)
+        brotli_saved = len(data) - len(compressed)
+    else:
+        # Left by a run with brotli installed, and stale now
+        path.with_name(path.name + '.br').unlink(missing_ok=True)
+    return gzip_saved, brotli_saved
+
+def _siblings_missing(path: Path) -> bool:
+    return not path.with_name(path.name + '.gz').is_file() or \
+        (brotli is not None and not path.with_name(path.name + '.br').is_file())
+
+def optimize_file(root: Path, assets: Dict[str,str], known: Dict[str,List[Any]], minified: Dict[str,int],
+        force: bool, path: str) -> FileResult:
+    '''
+    Minifies a page or search index file and writes the compressed siblings
+    of a text file, unless the file was left as it is since the run that
+    recorded it in known. With force, pages are rewritten regardless (e.g.
+    because assets changed). minified holds the bytes PageOptimizer saved.
+    '''
+    file_path = root / path
+    data = file_path.read_bytes()
+    digest = content_hash(data)
+    previous = known.get(path)
+    unchanged = previous is not None and digest == previous[0]
+    minify_saved = previous[1] if unchanged else minified.get(path, 0)
+    if not unchanged or force:
+        optimized = data
+        if path.endswith('.html'):
+            optimized = optimize_page(data.decode('utf-8'), assets).encode('utf-8')
+        elif path.startswith(SEARCH_DIR + '/') and path.endswith('.json'):
+            optimized = minify_json(data.decode('utf-8')).encode('utf-8')
+        if optimized != data:
+            _write_atomic(file_path, optimized)
+            minify_saved += len(data) - len(optimized)
+            data = optimized
+            digest = content_hash(data)
+    compress = file_path.suffix in COMPRESSIBLE and len(data) >= MIN_COMPRESS_SIZE
+    # E.g. a page Sphinx wrote again, which minifies to what it was
+    if previous is not None and digest == previous[0] and not (compress and _siblings_missing(file_path)):
+        return FileResult(path, digest, False, *previous[1:])
+    gzip_saved = brotli_saved = 0
+    if compress:
+        gzip_saved, brotli_saved = _compress(file_path, data)
+    else:
+        # Siblings of a larger earlier version would be served instead of the file
+        _remove_siblings(file_path)
+    return FileResult(path, digest, True, minify_saved, gzip_saved, brotli_saved)
+
+def _optimize_chunk(root: Path, assets: Dict[str,str], known: Dict[str,List[Any]], minified: Dict[str,int],
+        force: bool, paths: List[str]) -> List[FileResult]:
+    return [optimize_file(root, assets, known, minified, force, path) for path in paths]
+
+def _site_files(root: Path) -> Iterator[str]:
+    '''Site paths of the output files, without compressed siblings and hidden files (e.g. Sphinx's .doctrees).'''
+    for directory, dirnames, filenames in os.walk(root):
+        dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith('.')]
+        for filename in filenames:
+            if filename.startswith('.') or os.path.splitext(filename)[1] in COMPRESSED_SUFFIXES:
+                continue
+            yield Path(directory, filename).relative_to(root).as_posix()
+
+def fingerprint_assets(root: Path, known_assets: Dict[str,str], stats: Optional[OptimizeStats]=None) -> Dict[str,str]:
+    '''
+    Replaces every asset of the site in root with a fingerprinted copy,
+    removing copies of earlier versions. Returns the fingerprinted name of
+    each asset site path. Assets replaced by an earlier run (known_assets)
+    and not copied in again since keep their copy. Stylesheets are copied
+    last, pointing their url()s at the other copies.
+    '''
+    stats = stats if stats is not None else OptimizeStats()
+    paths = {f'{directory}/{path}' for directory in ASSET_DIRS if (root / directory).is_dir()
+        for path in _site_files(root / directory)}
+    originals = {path for path in paths if FINGERPRINT.sub('', path) == path}
+    assets = {path: name for path, name in known_assets.items()
+        if path not in originals and posixpath.join(posixpath.dirname(path), name) in paths}
+    for path in sorted(originals, key=lambda path: (path.endswith('.css'), path)):
+        data = (root / path).read_bytes()
+        if path.endswith('.css'):
+            data = _rewrite_css_urls(data.decode('utf-8'), path, assets).encode('utf-8')
+        assets[path] = fingerprinted_name(posixpath.basename(path), content_hash(data))
+        copy = root / posixpath.dirname(path) / assets[path]
+        if not copy.is_file():
+            _write_atomic(copy, data)
+        (root / path).unlink()
+        _remove_siblings(root / path)
+    current = {posixpath.join(posixpath.dirname(path), name) for path, name in assets.items()}
+    # Copies of earlier versions, or of assets that are gone
+    for path in paths - originals - current:
+        _remove(root / path, stats)
+    stats.n_assets = len(assets)
+    return assets
+
+def _remove(path: Path, stats: OptimizeStats) -> None:
+    path.unlink()
+    stats.n_removed += 1 + _remove_siblings(path)
+
+def _remove_siblings(path: Path) -> int:
+    '''Removes the compressed siblings of path. Returns how many there were.'''
+    n_removed = 0
+    for suffix in COMPRESSED_SUFFIXES:
+        sibling = path.with_name(path.name + suffix)
+        if sibling.is_file():
+            sibling.unlink()
+            n_removed += 1
+    return n_removed
+
+class PageOptimizer:
+    '''
+    Optimizes pages before they are written, like optimize_site would, and
+    remembers the bytes that saved for optimize_site to report. Fingerprints
+    the assets right away, so it takes the manifest of the previous run.
+    '''
+    def __init__(self, root: Path, manifest_path: Path):
+        self.stats = OptimizeStats()
+        self.assets = fingerprint_assets(root, load_manifest(manifest_path)[1], self.stats)
+        self.minified: Dict[str,int] = {}
+
+    def optimize(self, path: str, html: str) -> str:
+        optimized = optimize_page(html, self.assets)
+        self.minified[path] = len(html.encode('utf-8')) - len(optimized.encode('utf-8'))
+        return optimized
+
+def load_manifest(manifest_path: Path) -> Tuple[Dict[str,List[Any]],Dict[str,str]]:
+    '''
+    The files a previous run left, as path -> [content hash, minify, gzip and
+    brotli bytes saved], and its assets. Empty if there is no usable manifest.
+    '''
+    try:
+        with manifest_path.open() as manifest_file:
+            manifest = json.load(manifest_file)
+    except (FileNotFoundError, ValueError):
+        return {}, {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}, {}
+    return manifest['files'], manifest['assets']
+
+def optimize_site(root: Path, manifest_path: Path, processes: Optional[int]=None,
+        pages: Optional[PageOptimizer]=None, chunk_size: int=200) -> OptimizeStats:
+    '''
+    Optimizes the built site in root in place, remembering content hashes in
+    manifest_path. pages is the PageOptimizer that pages were written through,
+    if any; the assets it fingerprinted are used. More files than chunk_size are processed in a process pool of the
+    given size (default: one worker per core); processes=1 processes them in
+    this process.
+    '''
+    known, known_assets = load_manifest(manifest_path)
+    stats = pages.stats if pages is not None else OptimizeStats()
+    assets = pages.assets if pages is not None else fingerprint_assets(root, known_assets, stats)
+    # Pages that were left as they are still reference the old copies
+    force = assets != known_assets
+    paths = sorted(_site_files(root))
+    minified = pages.minified if pages is not None else {}
+    optimize = functools.partial(_optimize_chunk, root, assets, known, minified, force)
+    if processes == 1 or len(paths) <= chunk_size:
+        results = optimize(paths)
+    else:
+        chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = [result for chunk in pool.map(optimize, chunks) for result in chunk]
+    for result in results:
+        stats.add(result)
+    # Siblings of files that are gone, e.g. pages of deleted plasmids
+    for path in known.keys() - {result.path for result in results}:
+        stats.n_removed += _remove_siblings(root / path)
+
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    _write_atomic(manifest_path, json.dumps({
+        'version': MANIFEST_VERSION,
+        'files': {result.path: [result.digest, result.minify_saved, result.gzip_saved, result.brotli_saved]
+            for result in results},
+        'assets': assets,
+    }, separators=(',', ':')).encode('utf-8'))
+    return stats
@@ -0,0 +1,93 @@
+'''
+Prebuilt, sharded inverted index over the searchable plasmid fields.
+
+The index is written as small JSON files under _search/ in the HTML output:
+
+- manifest.json: format version, document count, chunk size and shard keys
+- t_<key>.json: token -> delta-encoded sorted document ids, for every token
+  whose first SHARD_PREFIX characters are key
+- d_<n>.json: [page path, title, details] for documents n*DOC_CHUNK onwards
+
+The search page (docs/_static/js/plasmid_search.js) fetches the manifest,
+then only the token shards matching the query terms and the document chunks
+holding the results it shows.
+'''
+import itertools
+import json
+import re
+from typing import Any, Dict, Iterator, List, Set, Tuple
+
+SEARCH_INDEX_VERSION = 1
+# Number of leading token characters that select a shard
+SHARD_PREFIX = 2
+# Number of document records per chunk file
+DOC_CHUNK = 1000
+
+TOKEN = re.compile(r'[a-z0-9]+')
+# pKG numbers are indexed as bare numbers without leading zeros, so "pKG12",
+# "pKG00012" (as in page file names) and "12" find the same plasmids
+PKG_TOKEN = re.compile(r'^pkg(?=[0-9])')
+PKG_NUMBER = re.compile(r'^pkg([0-9]+)$')
+
+def tokenize(text: str) -> List[str]:
+    '''Lowercase alphanumeric words. Kept in step with tokenize() in plasmid_search.js.'''
+    return [_pkg_token(token) for token in TOKEN.findall(text.lower())]
+
+def _pkg_token(token: str) -> str:
+    number = PKG_NUMBER.match(token)
+    if number is not None:
+        return str(int(number.group(1)))
+    return PKG_TOKEN.sub('', token)
+
+def plasmid_tokens(plasmid: Any) -> Set[str]:
+    '''Search tokens for the pKG number, names, vendor, resistances, plasmid types and species.'''
+    tokens = {str(plasmid.pKG)}
+    for text in itertools.chain(
+            [plasmid.name, plasmid.alt_name, plasmid.vendor or '', plasmid.species],
+            plasmid.resistances, plasmid.plasmid_type):
+        tokens.update(tokenize(text))
+    return tokens
+
+class SearchIndex:
+    '''Accumulates plasmids as they stream past, then writes the index files.'''
+    def __init__(self):
+        # (page path, title, details, tokens), in arrival order
+        self.entries: List[Tuple[str,str,str,Set[str]]] = []
+
+    def add(self, plasmid: Any, path: str) -> None:
+        details = ', '.join(part for part in [
+            f'{plasmid.vendor or ""} {plasmid.alt_name}'.strip(),
+            ', '.join(plasmid.resistances),
+            plasmid.species] if part)
+        self.entries.append((path, f'pKG{plasmid.pKG} - {plasmid.name}', details, plasmid_tokens(plasmid)))
+
+    def files(self) -> Iterator[Tuple[str,str]]:
+        '''
+        Yields (file name, JSON content) for every index file. Documents are
+        numbered in page path order so ids, and the shard files that hold
+        them, stay stable when unrelated plasmids change.
+        '''
+        entries = sorted(self.entries, key=lambda entry: entry[0])
+        shards: Dict[str,Dict[str,List[int]]] = {}
+        for doc_id, (_, _, _, tokens) in enumerate(entries):
+            for token in tokens:
+                shards.setdefault(token[:SHARD_PREFIX], {}).setdefault(token, []).append(doc_id)
+
+        for key, postings in shards.items():
+            yield f't_{key}.json', dumps({token: _delta_encode(ids) for token, ids in sorted(postings.items())})
+        for start in range(0, len(entries), DOC_CHUNK):
+            yield f'd_{start // DOC_CHUNK}.json', dumps([list(entry[:3]) for entry in entries[start:start + DOC_CHUNK]])
+        yield 'manifest.json', dumps({
+            'version': SEARCH_INDEX_VERSION,
+            'n_docs': len(entries),
+            'doc_chunk': DOC_CHUNK,
+            'shard_prefix': SHARD_PREFIX,
+            'shards': sorted(shards),
+        })
+
+def _delta_encode(ids: List[int]) -> List[int]:
+    '''Sorted ids as the first id followed by successive gaps, which serialize shorter.'''
+    return [ids[0]] + [b - a for a, b in zip(ids, ids[1:])]
+
+def dumps(obj: Any) -> str:
+    return json.dumps(obj, separators=(',', ':'))
@@ -0,0 +1,155 @@
+'''
+Builds the docs of several branches and tags from one shared inventory snapshot.
+
+Each version is built in its own git worktree with `build.py --offline
+--snapshot <shared snapshot>`, and its HTML is cached under
+<cache>/<version>/html together with a key made from the commit it was built
+from and the snapshot fingerprint. Versions whose key is unchanged are
+reused as they are; the rest are built in parallel.
+'''
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+from quartzy_parser.snapshot import SNAPSHOT_VERSION
+
+KEY_FILE = 'build_key'
+SNAPSHOT_MODULE = 'quartzy_parser/snapshot.py'
+# Refs the nightly build never publishes
+EXCLUDED_REFS = {'HEAD', 'gh-pages'}
+
+class Version(NamedTuple):
+    name: str
+    commit: str
+
+def _git(repo: Path, *args: str) -> str:
+    return subprocess.run(['git', *args], cwd=repo, check=True, capture_output=True, text=True).stdout
+
+def list_versions(repo: Path) -> List[str]:
+    '''Names of the remote branches and tags, as the nightly workflow publishes them.'''
+    refs = _git(repo, 'for-each-ref', '--format=%(refname:lstrip=-1)', 'refs/remotes/origin/', 'refs/tags').split()
+    return list(dict.fromkeys(ref for ref in refs if ref not in EXCLUDED_REFS))
+
+def _has_file(repo: Path, commit: str, path: str) -> bool:
+    return subprocess.run(['git', 'cat-file', '-e', f'{commit}:{path}'], cwd=repo, capture_output=True).returncode == 0
+
+def resolve_versions(repo: Path, names: List[str]) -> List[Version]:
+    '''
+    Resolves version names to commits, trying remote branches before local
+    refs. Versions without a docs/conf.py are skipped, like in the workflow.
+    '''
+    versions: List[Version] = []
+    for name in names:
+        for candidate in (f'origin/{name}', name):
+            result = subprocess.run(['git', 'rev-parse', '--verify', '--quiet', f'{candidate}^{{commit}}'],
+                cwd=repo, capture_output=True, text=True)
+            if result.returncode == 0:
+                commit = result.stdout.strip()
+                break
+        else:
+            raise ValueError(f'Unknown version {name}!')
+        if not _has_file(repo, commit, 'docs/conf.py'):
+            print(f'{name}: no docs/conf.py, skipped')
+            continue
+        versions.append(Version(name, commit))
+    return versions
+
+def build_key(commit: str, snapshot_fingerprint: str) -> str:
+    return hashlib.sha256(f'{commit} {snapshot_fingerprint}'.encode('utf-8')).hexdigest()
+
+def cached_key(cache_dir: Path, name: str) -> Optional[str]:
+    try:
+        return (cache_dir / name / KEY_FILE).read_text().strip()
+    except FileNotFoundError:
+        return None
+
+class VersionBuilder:
+    '''Builds versions into the cache, serializing the git worktree bookkeeping.'''
+    def __init__(self, repo: Path, cache_dir: Path, snapshot_path: Path, snapshot_fingerprint: str):
+        self.repo = repo
+        self.cache_dir = cache_dir
+        self.snapshot_path = snapshot_path
+        self.snapshot_fingerprint = snapshot_fingerprint
+        self._git_lock = threading.Lock()
+
+    def is_current(self, version: Version) -> bool:
+        return cached_key(self.cache_dir, version.name) == build_key(version.commit, self.snapshot_fingerprint)
+
+    def _command(self, version: Version) -> List[str]:
+        command = [sys.executable, 'build.py', '--force-rebuild']
+        # Versions that predate --offline, or that read another snapshot
+        # format, fetch the inventory themselves
+        build_script = _git(self.repo, 'show', f'{version.commit}:build.py')
+        if "'--offline'" in build_script and self._reads_snapshot(version.commit):
+            command += ['--offline', '--snapshot', str(self.snapshot_path)]
+        return command
+
+    def _reads_snapshot(self, commit: str) -> bool:
+        '''Whether the snapshot code at commit reads the current snapshot format.'''
+        if not _has_file(self.repo, commit, SNAPSHOT_MODULE):
+            return False
+        return f'SNAPSHOT_VERSION = {SNAPSHOT_VERSION}\n' in _git(self.repo, 'show', f'{commit}:{SNAPSHOT_MODULE}')
+
+    def build(self, version: Version) -> None:
+        '''Builds one version in a temporary worktree and swaps its HTML into the cache.'''
+        log_path = self.cache_dir / f'{version.name}.log'
+        with tempfile.TemporaryDirectory() as tmp:
+            worktree = Path(tmp) / 'src'
+            try:
+                with self._git_lock:
+                    _git(self.repo, 'worktree', 'add', '--detach', str(worktree), version.commit)
+                env = dict(os.environ, current_version=version.name, current_language='en')
+                with log_path.open('w') as log:
+                    subprocess.run(self._command(version), cwd=worktree, env=env, check=True,
+                        stdout=log, stderr=subprocess.STDOUT)
+                staging = self.cache_dir / f'.{version.name}.tmp'
+                shutil.rmtree(staging, ignore_errors=True)
+                staging.mkdir()
+                shutil.move(str(worktree / 'output' / 'html'), str(staging / 'html'))
+                (staging / KEY_FILE).write_text(build_key(version.commit, self.snapshot_fingerprint) + '\n')
+                shutil.rmtree(self.cache_dir / version.name, ignore_errors=True)
+                os.replace(staging, self.cache_dir / version.name)
+            finally:
+                with self._git_lock:
+                    # Not checked, so a failed add or a half-removed worktree
+                    # doesn't hide the build's own error; prune drops whatever
+                    # bookkeeping is left
+                    subprocess.run(['git', 'worktree', 'remove', '--force', str(worktree)], cwd=self.repo,
+                        capture_output=True)
+                    subprocess.run(['git', 'worktree', 'prune'], cwd=self.repo, capture_output=True)
+
+def build_versions(builder: VersionBuilder, versions: List[Version], jobs: Optional[int]=None) -> Dict[str,str]:
+    '''
+    Brings the cache up to date for versions. Returns each version's status:
+    'cached', 'built' or 'failed' (the previous cached build is kept).
+    '''
+    builder.cache_dir.mkdir(parents=True, exist_ok=True)
+    status = {version.name: 'cached' for version in versions if builder.is_current(version)}
+    stale = [version for version in versions if version.name not in status]
+
+    def build(version: Version) -> None:
+        try:
+            builder.build(version)
+            status[version.name] = 'built'
+        except (subprocess.CalledProcessError, OSError) as e:
+            # A failing build, or e.g. a full disk while swapping in its output
+            status[version.name] = 'failed'
+            print(f'{version.name}: build failed ({e}), see {builder.cache_dir / (version.name + ".log")}')
+
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+        list(pool.map(build, stale))
+    return {version.name: status[version.name] for version in versions}
+
+def publish(cache_dir: Path, names: List[str], target: Path) -> None:
+    '''Copies the cached HTML of each version to target/<version>/.'''
+    for name in names:
+        html = cache_dir / name / 'html'
+        if html.is_dir():
+            shutil.copytree(html, target / name, dirs_exist_ok=True)